@@ -1816,7 +1816,7 @@ class Page(object):
         # forget in-memory page text
         self.set_raw_body(None)
 
-        self.request.graphdata.cache = dict()
+        self.request.graphdata.cachedel(self.page_name)
 
         # clean the cache
         for formatter_name in self.request.cfg.caching_formats:
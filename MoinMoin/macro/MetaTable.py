@@ -36,9 +36,12 @@ from MoinMoin.wikiutil import form_writer
 
 from MoinMoin.metadata.constants import PROPERTIES
 from MoinMoin.metadata.util import url_escape
-from MoinMoin.metadata.query import (metatable_parseargs, get_metas,
-                                     get_properties, add_matching_redirs)
+from MoinMoin.metadata.query import (metatable_query, get_metas,
+                                     get_properties, add_matching_redirs,
+                                     fetch_pages)
 from MoinMoin.metadata.wikitextutil import format_wikitext
+from MoinMoin.metadata.depcache import (get_output, start_output, set_output,
+                                        metatable_dependencies)
 
 try:
     import simplejson as json
@@ -82,7 +85,7 @@ COLORS = ['aliceblue', 'antiquewhite', 'aqua', 'aquamarine',
           'whitesmoke', 'yellow', 'yellowgreen']
 
 
-def wrap_span(request, pageobj, key, data, id):
+def wrap_span(request, pageobj, key, data, id, pages=None):
     pagename = pageobj.page_name
     fdata = format_wikitext(request, data)
 
@@ -97,7 +100,7 @@ def wrap_span(request, pageobj, key, data, id):
     if '->' in key:
         # Get indirection data, the same function get_metas uses
         linkdata = add_matching_redirs(request, request.page, {}, {}, {},
-                                       key, pagename, key)
+                                       key, pagename, key, pages=pages)
 
         # Broken link, do not give anything editable as this will not
         # work in any case.
@@ -189,7 +192,7 @@ def t_cell(request, cache, pageobj, vals, head=0,
                 out.append(formatter.listitem(1))
 
             out.append(wrap_span(request, pageobj, key, data,
-                                 i))
+                                 i, cache.get("pages")))
 
             if cellstyle == 'list':
                 out.append(formatter.listitem(0))
@@ -197,7 +200,8 @@ def t_cell(request, cache, pageobj, vals, head=0,
         first_val = False
 
     if not vals:
-        out.append(wrap_span(request, pageobj, key, '', 0))
+        out.append(wrap_span(request, pageobj, key, '', 0,
+                             cache.get("pages")))
 
     if cellstyle == 'list':
         out.append(formatter.bullet_list(1))
@@ -206,9 +210,19 @@ def t_cell(request, cache, pageobj, vals, head=0,
     return out
 
 
+def int_option(options, name):
+    value = options.get(name, 0)
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value < 0:
+        value = 0
+    return value
+
 def construct_table(request, cache, pagelist, metakeys, legend='',
                     checkAccess=True, styles=dict(),
-                    options=dict()):
+                    options=dict(), pages=None, total=None):
     request.page.formatter = request.formatter
     formatter = request.formatter
     _ = request.getText
@@ -256,14 +270,13 @@ def construct_table(request, cache, pagelist, metakeys, legend='',
     # Transpose table, i.e. make table lanscape instead of portrait
     transpose = options.get('transpose', 0)
 
-    # Limit the maximum number of pages displayed
+    # Limit the maximum number of pages displayed. The pages may have
+    # been limited by the query already, out of total pages.
     maxpages = len(pagelist)
-    limit = options.get('limit', 0)
-    try:
-        limit = int(limit)
-    except ValueError:
-        limit = 0
-    if limit > maxpages or limit < 0:
+    if total is not None:
+        maxpages = total
+    limit = int_option(options, 'limit')
+    if limit > maxpages:
         limit = 0
     if limit:
         pagelist = pagelist[:limit]
@@ -341,14 +354,21 @@ def construct_table(request, cache, pagelist, metakeys, legend='',
 
         return out
 
+    # Fetch the rows, and the pages of their indirection keys, in
+    # batches instead of one by one
+    if pages is None:
+        pages = fetch_pages(request, pagelist, metakeys)
+    # The cells resolve their indirection keys through the same pages
+    cache["pages"] = pages
+
     def page_rev_metas(request, page, metakeys, checkAccess):
         if '-gwikirevision-' in page:
             metas = get_metas(request, page, metakeys,
-                              checkAccess=checkAccess)
+                              checkAccess=checkAccess, pages=pages)
             page, revision = page.split('-gwikirevision-')
         else:
             metas = get_metas(request, page, metakeys,
-                              checkAccess=checkAccess)
+                              checkAccess=checkAccess, pages=pages)
             revision = ''
 
         return metas, page, revision
@@ -480,14 +500,41 @@ def construct_table(request, cache, pagelist, metakeys, legend='',
 
 
 def do_macro(request, args, **kw):
+    # Tables can be cached until the pages, keys etc. they depend on
+    # change, see MoinMoin.metadata.depcache
+    if not getattr(request.cfg, 'gwiki_metatable_cache', False):
+        return render_macro(request, args, **kw)[0]
+
+    pagename = request.page.page_name
+    cacheargs = (args, sorted(kw.items()))
+
+    out = get_output(request, 'metatable', pagename, cacheargs)
+    if out is not None:
+        return out
+
+    token = start_output(request)
+    out, deps = render_macro(request, args, **kw)
+    set_output(request, 'metatable', pagename, cacheargs, out, deps, token)
+    return out
+
+def render_macro(request, args, **kw):
+    """
+    Return the output of the macro and its dependencies.
+    """
     formatter = request.formatter
     _ = request.getText
     out = list()
     cache = dict()
 
-    # Note, metatable_parseargs deals with permissions
-    pagelist, metakeys, styles = metatable_parseargs(request, args,
-                                                     get_all_keys=True)
+    # Only the pages shown are ordered and returned by the query
+    limit = int_option(kw, 'limit') or None
+    offset = int_option(kw, 'offset')
+
+    # Note, metatable_query deals with permissions
+    pagelist, metakeys, styles, total = metatable_query(request, args,
+                                                        get_all_keys=True,
+                                                        limit=limit,
+                                                        offset=offset)
 
     # No data -> bail out quickly, Scotty
     if not pagelist:
@@ -499,15 +546,16 @@ def do_macro(request, args, **kw):
             out.extend(t_cell(request, cache, request.page,
                               ["%s '%s'" % (_("No matches for"), args)]))
         out.append(formatter.table(0) + u'</div>')
-        return "".join(out)
+        return "".join(out), metatable_dependencies(request, args)
 
     options = dict({'args': args}.items() + kw.items())
     divfmt = {'class': "metatable", 'data-options': quote(json.dumps(options))}
     out.append(formatter.div(1, **divfmt))
     # We're sure the user has the access to the page, so don't check
+    pages = fetch_pages(request, pagelist, metakeys)
     out.extend(construct_table(request, cache, pagelist, metakeys,
                                checkAccess=False, styles=styles,
-                               options=options))
+                               options=options, pages=pages, total=total))
 
     def action_link(action, linktext, args):
         req_url = request.script_root + "/" + \
@@ -523,7 +571,8 @@ def do_macro(request, args, **kw):
     out.append(action_link('metaCSV', 'csv', args))
     out.append(action_link('metaPackage', 'zip', args))
     out.append(formatter.div(0))
-    return "".join(out)
+    return "".join(out), metatable_dependencies(request, args, pages.pages,
+                                                metakeys)
 
 
 def execute(macro, args):
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+    MoinMoin - MoinMoin.metadata.backend Tests
+
+    The same writes are made on each graph data backend, and the
+    results read back have to be the same.
+
+    @license: GNU GPL, see COPYING for details.
+"""
+import shutil
+import tempfile
+
+from MoinMoin.metadata.util import doctest_request
+from MoinMoin.metadata.backend import shelvedb, sqlitedb
+
+BACKENDS = [shelvedb.GraphData, sqlitedb.GraphData]
+
+PAGES = {
+    u'PageA': {u'meta': {u'status': [u'open'], u'size': [u'10', u'2']},
+               u'out': {u'friend': [u'PageB', u'PageC'],
+                        u'gwikicategory': [u'CategoryTest']},
+               u'acl': u'All:read'},
+    u'PageB': {u'meta': {u'status': [u'closed']},
+               u'out': {u'': [u'PageA']}},
+}
+
+def dump(graphdata):
+    """
+    Return everything the graph data tells about its pages, leaving
+    out the modification times.
+    """
+    pages = dict()
+    for pagename in graphdata:
+        pagedata = dict(graphdata.getpage(pagename))
+        pagedata.pop(u'mtime', None)
+        pages[pagename] = pagedata
+
+    many = graphdata.getpages(pages)
+    for pagename, pagedata in many.iteritems():
+        pagedata = dict(pagedata)
+        pagedata.pop(u'mtime', None)
+        assert pagedata == pages[pagename]
+
+    keys = sorted(graphdata.metakeys())
+    index = dict((key, sorted(graphdata.pages_with_key(key)))
+                 for key in keys)
+    orders = dict((pagename, graphdata.get_order(pagename))
+                  for pagename in pages)
+    return pages, keys, index, orders
+
+class TestGraphData(object):
+    def setup_method(self, method):
+        self.dirs = list()
+
+    def teardown_method(self, method):
+        for path in self.dirs:
+            shutil.rmtree(path, True)
+
+    def new_request(self):
+        request = doctest_request()
+        request.cfg.data_dir = tempfile.mkdtemp()
+        self.dirs.append(request.cfg.data_dir)
+        return request
+
+    def save(self, request, graphdata, pages):
+        for pagename in sorted(pages):
+            graphdata.set_page(request, pagename, {pagename: pages[pagename]})
+
+    def each(self, *steps):
+        """
+        Run the steps on a fresh graph data of each backend, reopening
+        the graph data between the steps. Return the dumps of the
+        backends after each step.
+        """
+        results = list()
+        for backend in BACKENDS:
+            request = self.new_request()
+            dumps = list()
+            for step in steps:
+                graphdata = backend(request)
+                step(request, graphdata)
+                graphdata.close()
+
+                graphdata = backend(request)
+                dumps.append(dump(graphdata))
+                graphdata.close()
+            results.append(dumps)
+        return results
+
+    def test_set_page(self):
+        def save(request, graphdata):
+            self.save(request, graphdata, PAGES)
+            graphdata.commit()
+
+        shelve, sqlite = self.each(save)
+        assert shelve == sqlite
+
+        pages, keys, index, orders = sqlite[0]
+        assert sorted(pages) == [u'CategoryTest', u'PageA',
+                                 u'PageB', u'PageC']
+        assert pages[u'PageA'][u'saved']
+        assert pages[u'PageC'] == {u'in': {u'friend': [u'PageA']}}
+        assert index[u'status'] == [u'PageA', u'PageB']
+        assert orders[u'PageA'][u'size'] == [(10, ''), (2, '')]
+
+    def test_clear_page(self):
+        def save(request, graphdata):
+            self.save(request, graphdata, PAGES)
+            graphdata.commit()
+
+        def clear(request, graphdata):
+            graphdata.clear_page(request, u'PageA')
+            graphdata.commit()
+
+        shelve, sqlite = self.each(save, clear)
+        assert shelve == sqlite
+
+        pages, keys, index, orders = sqlite[1]
+        # Still linked from PageB
+        assert u'PageA' in pages
+        assert not pages[u'PageA'].get(u'saved', False)
+        assert pages[u'PageC'] == {}
+        assert index[u'status'] == [u'PageB']
+
+    def test_abort(self):
+        def save(request, graphdata):
+            self.save(request, graphdata, PAGES)
+            graphdata.commit()
+
+        def change(request, graphdata):
+            pages = {u'PageA': {u'meta': {u'status': [u'closed']}}}
+            self.save(request, graphdata, pages)
+            graphdata.clear_page(request, u'PageB')
+            graphdata.abort()
+
+        def set_acl(request, graphdata):
+            graphdata.set_acl(u'PageA', u'All:')
+            graphdata.set_saved(u'PageB', False, 0.0)
+            graphdata.set_page_meta(u'PageC', {u'status': [u'open']})
+            graphdata.abort()
+
+        for results in self.each(save, change, set_acl):
+            assert results[0] == results[1] == results[2]
+
+    def test_generations(self):
+        generations = list()
+
+        def save(request, graphdata):
+            self.save(request, graphdata, PAGES)
+            graphdata.commit()
+
+        def set_acl(request, graphdata):
+            generations.append(graphdata.get_generations(['*'])['*'])
+            graphdata.set_acl(u'PageA', u'All:')
+            graphdata.commit()
+
+        def check(request, graphdata):
+            generations.append(graphdata.get_generations(['*'])['*'])
+
+        shelve, sqlite = self.each(save, set_acl, check)
+        assert shelve == sqlite
+        assert sqlite[1][0][u'PageA'][u'acl'] == u'All:'
+        assert generations[0] < generations[1]
+        assert generations[2] < generations[3]
+
+    def test_cacheset(self):
+        revision = {u'meta': {u'status': [u'draft']}, u'saved': True}
+
+        def save(request, graphdata):
+            self.save(request, graphdata, PAGES)
+            graphdata.commit()
+
+        def cacheset(request, graphdata):
+            # Shown for this request only
+            graphdata.cacheset(u'PageA-gwikirevision-1', revision)
+            graphdata.cacheset(u'PageB', revision)
+            for pagename in [u'PageA-gwikirevision-1', u'PageB']:
+                assert graphdata.has_key(pagename)
+                assert pagename in graphdata
+                assert graphdata.getpage(pagename) == revision
+                assert graphdata.get_meta(pagename) == revision[u'meta']
+                assert graphdata.is_saved(pagename)
+            pages = graphdata.getpages([u'PageA', u'PageB'])
+            assert pages[u'PageB'] == revision
+            assert pages[u'PageA'][u'meta'][u'status'] == [u'open']
+
+            graphdata.cachedel(u'PageB')
+            assert graphdata.get_meta(u'PageB') == {u'status': [u'closed']}
+
+        shelve, sqlite = self.each(save, cacheset)
+        assert shelve == sqlite
+        assert shelve[0] == shelve[1]
+
+    def test_load_pages(self):
+        from MoinMoin.metadata.edit import merge_graphdata
+
+        def save(request, graphdata):
+            self.save(request, graphdata, PAGES)
+            graphdata.commit()
+
+        def load(request, graphdata):
+            parsed = sorted(PAGES.items())
+            graphdata.load_pages(merge_graphdata(request, parsed, 1.0))
+            graphdata.commit()
+
+        shelve, sqlite = self.each(save, load)
+        assert shelve == sqlite
+        assert sqlite[0] == sqlite[1]
+
+    def test_get_changes(self):
+        journals = list()
+
+        def save(request, graphdata):
+            self.save(request, graphdata, PAGES)
+            graphdata.commit()
+
+        def change(request, graphdata):
+            pages = {u'PageA': {u'meta': {u'status': [u'closed']}}}
+            self.save(request, graphdata, pages)
+            graphdata.clear_page(request, u'PageB')
+            graphdata.commit()
+
+        def check(request, graphdata):
+            position = graphdata.journal_position()
+            changes = graphdata.get_changes(0)
+            assert [change[0] for change in changes] == \
+                range(1, position + 1)
+
+            # Windows following the last sequence number add up to
+            # the whole journal
+            for limit in [1, 2, 5]:
+                windows = list()
+                since = 0
+                while True:
+                    window = graphdata.get_changes(since, limit)
+                    assert len(window) <= limit
+                    if not window:
+                        break
+                    windows.extend(window)
+                    since = window[-1][0]
+                assert windows == changes
+
+            assert graphdata.get_changes(position) == []
+            assert graphdata.get_changes(position + 1) is None
+            journals.append(changes)
+
+        shelve, sqlite = self.each(save, change, check)
+        assert shelve == sqlite
+        assert journals[0] == journals[1]
+        assert (u'PageA', u'status', [u'closed'], [u'open']) in \
+            [tuple(change[1:]) for change in journals[0]]
+
+    def test_journal_size(self):
+        def save(request, graphdata):
+            graphdata.journal_size = 2
+            self.save(request, graphdata, PAGES)
+            graphdata.commit()
+
+        def check(request, graphdata):
+            position = graphdata.journal_position()
+            assert position > 2
+            # Only the latest entries are kept
+            assert graphdata.get_changes(0) is None
+            assert graphdata.get_changes(position - 3) is None
+            changes = graphdata.get_changes(position - 2)
+            assert [change[0] for change in changes] == \
+                [position - 1, position]
+
+        self.each(save, check)
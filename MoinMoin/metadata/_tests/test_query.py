@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+    MoinMoin - MoinMoin.metadata.query Tests
+
+    @license: GNU GPL, see COPYING for details.
+"""
+import py
+
+from MoinMoin.metadata.util import doctest_request
+from MoinMoin.metadata.query import (metatable_parseargs, metatable_window,
+                                     CursorError, PAGE_BATCH)
+
+ARGS = u'prio=/.+/, >>prio'
+
+class Page(object):
+    page_name = u'FrontPage'
+
+def make_request(count=10):
+    pages = dict()
+    for i in range(count):
+        pages[u'Page%d' % (i,)] = {u'saved': True,
+                                   u'meta': {u'prio': [unicode(i % 4)]}}
+    request = doctest_request(pages)
+    request.page = Page()
+    return request
+
+def windows(request, limit, between=lambda request, pagelist: None):
+    """
+    Return the pages of all the windows in order, calling between
+    with the pages so far after each window.
+    """
+    pagelist = list()
+    after = None
+    while True:
+        window, _, after = metatable_window(request, ARGS, limit, after)
+        pagelist.extend(window)
+        if after is None:
+            return pagelist
+        between(request, pagelist)
+
+class TestMetatableWindow(object):
+    def test_all_pages(self):
+        request = make_request()
+        everything, _, _ = metatable_parseargs(request, ARGS)
+        for limit in [1, 3, 5, 10, 20]:
+            assert windows(request, limit) == everything
+
+    def test_removed_cursor_page(self):
+        request = make_request()
+        everything, _, _ = metatable_parseargs(request, ARGS)
+        removed = list()
+
+        def remove(request, pagelist):
+            if not removed:
+                removed.append(pagelist[-1])
+                del request.graphdata.data[pagelist[-1]]
+
+        assert windows(request, 3, remove) == everything
+
+    def test_changed_page(self):
+        request = make_request()
+        everything, _, _ = metatable_parseargs(request, ARGS)
+        changed = everything[-1]
+
+        def change(request, pagelist):
+            # Moves the page before the windows read so far
+            request.graphdata.data[changed][u'meta'][u'prio'] = [u'9']
+
+        pagelist = windows(request, 3, change)
+        assert pagelist == [x for x in everything if x != changed]
+
+    def test_same_keys(self):
+        request = make_request()
+        request.graphdata.data[u'Page0'][u'meta'][u'owner'] = [u'Alice']
+        _, everything, _ = metatable_parseargs(request, ARGS)
+        assert u'owner' in everything
+
+        for limit in [1, 3, 20]:
+            after = None
+            while True:
+                _, metakeys, after = metatable_window(request, ARGS,
+                                                      limit, after)
+                assert metakeys == everything
+                if after is None:
+                    break
+
+    def test_invalid_cursor(self):
+        request = make_request()
+        py.test.raises(CursorError, metatable_window,
+                       request, ARGS, 3, 'not a cursor')
+
+        # A cursor of other args
+        _, _, after = metatable_window(request, u'prio=/.+/', 3)
+        py.test.raises(CursorError, metatable_window,
+                       request, ARGS, 3, after)
+
+    def test_stops_early(self):
+        # More pages than are checked for access in one batch
+        count = 2 * PAGE_BATCH
+        request = make_request(count)
+        everything, _, _ = metatable_parseargs(request, ARGS)
+
+        read = list()
+        is_saved = request.graphdata.is_saved
+
+        def counted(pagename):
+            read.append(pagename)
+            return is_saved(pagename)
+        request.graphdata.is_saved = counted
+
+        # Only the pages up to the first ones in order are filtered
+        for offset in [0, 3]:
+            del read[:]
+            pagelist, _, _ = metatable_parseargs(request, ARGS, limit=3,
+                                                 offset=offset)
+            assert pagelist == everything[offset:offset + 3]
+            assert 0 < len(read) < count
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+    MoinMoin - MoinMoin.metadata.util Tests
+
+    @license: GNU GPL, see COPYING for details.
+"""
+from MoinMoin.user import User
+from MoinMoin.metadata.util import may_read_many
+
+from MoinMoin._tests import wikiconfig, create_page, nuke_page
+
+class TestMayReadMany(object):
+    """
+    may_read_many has to give the pages may.read allows, whatever the
+    ACLs of the pages and their parents.
+    """
+    pages = [
+        (u'ReadManyMain', u"#acl JoeDoe:\n#acl JaneDoe:read,write\nFoo!"),
+        (u'ReadManyMain/SubPage', u"FooFoo!"),
+        (u'ReadManyMain/Public', u"#acl All:read\nBar!"),
+        (u'ReadManyOther', u"#acl JaneDoe:\nBaz!"),
+        (u'ReadManyPlain', u"Quux!"),
+    ]
+    # Pages without any page data
+    missing = [u'ReadManyMissing', u'ReadManyMain/Missing']
+
+    class Config(wikiconfig.Config):
+        acl_rights_before = u"WikiAdmin:admin,read,write,delete,revert"
+        acl_rights_default = u"JaneDoe,JoeDoe:read,write"
+        acl_rights_after = u""
+        acl_hierarchic = False
+
+    def setup_class(self):
+        self.savedUser = self.request.user
+        self.request.user = User(self.request, auth_username=u'WikiAdmin')
+        self.request.user.valid = True
+
+        for pagename, content in self.pages:
+            create_page(self.request, pagename, content)
+
+    def teardown_class(self):
+        self.request.user = User(self.request, auth_username=u'WikiAdmin')
+        self.request.user.valid = True
+        self.request.cfg.acl_hierarchic = False
+
+        for pagename, _ in self.pages:
+            nuke_page(self.request, pagename)
+
+        self.request.user = self.savedUser
+
+    def test_same_as_read(self):
+        pagenames = [pagename for pagename, _ in self.pages] + self.missing
+
+        # The ACLs are read from the graph data, not from the pages
+        pagedata = self.request.graphdata.getpage(u'ReadManyOther')
+        assert pagedata.get(u'acl')
+
+        for hierarchic in [False, True]:
+            self.request.cfg.acl_hierarchic = hierarchic
+            for username in [u'WikiAdmin', u'JaneDoe', u'JoeDoe', u'Nobody']:
+                user = User(self.request, auth_username=username)
+                user.valid = True
+                self.request.user = user
+
+                expected = set(pagename for pagename in pagenames
+                               if user.may.read(pagename))
+                assert may_read_many(self.request, pagenames) == expected
@@ -1,5 +1,67 @@
 import UserDict
 
+from MoinMoin.metadata.util import order_metas, ordervalue, OPERATORS
+
+class IndexView(UserDict.DictMixin):
+    """
+    Read-only mapping on top of one of the meta indexes of a graph
+    data backend. Only the looked up items are fetched.
+    """
+
+    def __init__(self, lookup, enumerate):
+        self._lookup = lookup
+        self._enumerate = enumerate
+
+    def __getitem__(self, item):
+        result = self._lookup(item)
+        if not result:
+            raise KeyError(item)
+        return result
+
+    def __contains__(self, item):
+        return bool(self._lookup(item))
+
+    def __iter__(self):
+        # The lookup may filter out some of the enumerated items
+        for item in self._enumerate():
+            if self._lookup(item):
+                yield item
+
+    def iteritems(self):
+        for item in self._enumerate():
+            result = self._lookup(item)
+            if result:
+                yield item, result
+
+    def keys(self):
+        return list(self)
+
+def meta_changes(old_meta, new_meta):
+    """
+    Return the journal entries (key, added values, removed values) of
+    the metas of a page changing from old_meta to new_meta.
+
+    >>> meta_changes({u'a': [u'1', u'2'], u'b': [u'x']},
+    ...              {u'a': [u'2', u'3'], u'c': [u'y']})
+    [(u'a', [u'3'], [u'1']), (u'b', [], [u'x']), (u'c', [u'y'], [])]
+    """
+    changes = list()
+    for key in sorted(set(old_meta) | set(new_meta)):
+        old = old_meta.get(key, list())
+        new = new_meta.get(key, list())
+        added = [value for value in _unique(new) if value not in old]
+        removed = [value for value in _unique(old) if value not in new]
+        if added or removed:
+            changes.append((key, added, removed))
+    return changes
+
+def _unique(values):
+    seen = set()
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            yield value
+
 class GraphDataBase(UserDict.DictMixin):
     # Does this backend promise that operations provided by
     # this API are ACID and commit/abort work?
@@ -8,6 +70,9 @@ class GraphDataBase(UserDict.DictMixin):
 
     def __init__(self, request, **kw):
         self.request = request
+        # Number of the latest journal entries kept
+        self.journal_size = getattr(request.cfg, 'gwiki_journal_size',
+                                    100000)
 
     def __getitem__(self, item):
         raise NotImplementedError()
@@ -43,6 +108,28 @@ class GraphDataBase(UserDict.DictMixin):
         # they should be handled elsewhere.
         return self.get(pagename, dict())
 
+    def getpages(self, pagenames):
+        """
+        Return a dict of the page data (as in getpage) of the given
+        pages. Backends override this to fetch the pages in one go.
+        """
+        return dict((pagename, self.getpage(pagename))
+                    for pagename in pagenames)
+
+    def get_metas_many(self, pagenames, keys=None):
+        """
+        Return a dict of the metas (as in get_meta) of the given
+        pages, limited to the given keys if keys is not None.
+        """
+        result = dict()
+        for pagename, pagedata in self.getpages(pagenames).iteritems():
+            metas = pagedata.get(u'meta', dict())
+            if keys is not None:
+                metas = dict((key, metas[key]) for key in keys
+                             if key in metas)
+            result[pagename] = metas
+        return result
+
     def is_saved(self, pagename):
         raise NotImplementedError()
 
@@ -58,6 +145,13 @@ class GraphDataBase(UserDict.DictMixin):
     def get_meta(self, pagename):
         raise NotImplementedError()
 
+    def get_order(self, pagename):
+        """
+        Return the order keys (see ordervalue) of the page's meta
+        values, in the same order as in get_meta.
+        """
+        return order_metas(self.get_meta(pagename))
+
     def get_in(self, pagename):
         return self.getpage(pagename).get(u'in', {})
        
@@ -67,6 +161,65 @@ class GraphDataBase(UserDict.DictMixin):
     def post_save(self, pagename):
         pass
 
+    def get_generations(self, deps):
+        """
+        Return a dict of the generations of the given dependencies
+        (see MoinMoin.metadata.depcache), None for the ones changed
+        during this request. Returns None if the backend does not keep
+        generations.
+        """
+        return None
+
+    def bump_generations(self, deps):
+        """
+        Mark the given dependencies changed, along with ANY_DEPENDENCY.
+        """
+        pass
+
+    def get_state(self, name, default=None):
+        """
+        Return a value stored with set_state, or default.
+        """
+        return default
+
+    def set_state(self, name, value):
+        """
+        Store a small value along with the graph data, eg. how far in
+        the edit log the graph data is known to be up to date.
+        """
+        pass
+
+    def writelock(self):
+        """
+        Keep other writers out until the changes are committed, eg.
+        to check and save a page without racing with its editors.
+        """
+        pass
+
+    def get_changes(self, since=0, limit=None):
+        """
+        Return the journal entries (seq, pagename, key, added values,
+        removed values) of the meta changes after the sequence number
+        since, oldest first and at most limit of them. Returns None if
+        the journal does not reach back to since, or the backend keeps
+        no journal, and the consumer has to start over from the current
+        data and journal_position.
+        """
+        return None
+
+    def journal_position(self):
+        """
+        Return the sequence number of the latest journal entry, 0 if
+        there are none, or None if the backend keeps no journal.
+        """
+        return None
+
+    def cachedel(self, pagename):
+        """
+        Forget any page data of the page cached for this request.
+        """
+        pass
+
     def get_vals_on_keys(self):
         self.reverse_meta()
         return self.vals_on_keys
@@ -75,33 +228,121 @@ class GraphDataBase(UserDict.DictMixin):
         self.reverse_meta()
         return self.vals_on_pages
 
-    def clear_page(self, pagename):
+    def clear_page(self, request, pagename):
         raise NotImplementedError()
 
     def clear_metas(self):
         pass
 
+    def load_pages(self, pages):
+        """
+        Replace all the graph data with the given dict of page data,
+        whose in-links must match the out-links, eg. when rehashing
+        the whole wiki. Backends override this to write in bulk.
+        """
+        for pagename in self.keys():
+            del self[pagename]
+        for pagename, pagedata in pages.iteritems():
+            self.savepage(pagename, pagedata)
+
     def __repr__(self):
         return "<%s instance %x>" % (str(self.__class__), id(self))
 
     def reverse_meta(self):
+        """
+        Set keys_on_pages (key -> pages), vals_on_pages (value ->
+        pages) and vals_on_keys (key -> values) as mappings on top of
+        the meta indexes. Template pages are left out of the pages.
+        """
         if hasattr(self, 'keys_on_pages'):
             return
-        self.keys_on_pages = dict()
-        self.vals_on_pages = dict()
-        self.vals_on_keys = dict()
 
-        for page in self:
-            if page.endswith('Template'):
-                continue
+        def no_templates(lookup):
+            return lambda x: set(page for page in lookup(x)
+                                 if not page.endswith('Template'))
+
+        self.keys_on_pages = IndexView(no_templates(self.pages_with_key),
+                                       self.metakeys)
+        self.vals_on_pages = IndexView(no_templates(self.pages_with_any_value),
+                                       self.metavalues)
+        self.vals_on_keys = IndexView(self.values_of_key, self.metakeys)
 
+    # Meta index lookups. Backends with persistent indexes override
+    # these, the defaults scan all the pages once per instance.
+
+    def pages_with_key(self, key):
+        return self._scan_meta()[0].get(key, set())
+
+    def pages_with_value(self, key, value):
+        return self._scan_meta()[1].get((key, value), set())
+
+    def keys_with_value(self, value):
+        return self._scan_meta()[2].get(value, set())
+
+    def values_of_key(self, key):
+        return self._scan_meta()[3].get(key, set())
+
+    def pages_with_any_value(self, value):
+        pages = set()
+        for key in self.keys_with_value(value):
+            pages.update(self.pages_with_value(key, value))
+        return pages
+
+    def pages_with_order(self, key, op, orderkey):
+        """
+        Return the pages with a value of key whose order key compares
+        true against orderkey with op, one of '<', '<=', '==', '>=',
+        '>'.
+        """
+        compare = OPERATORS[op]
+        pages = set()
+        for value in self.values_of_key(key):
+            if compare(ordervalue(value), orderkey):
+                pages.update(self.pages_with_value(key, value))
+        return pages
+
+    def pages_by_order(self, key, reverse=False):
+        """
+        Iterate (order key, page) pairs of the values of key in the
+        order of the order keys, descending if reverse. Pages with
+        several values come up once per value.
+        """
+        values = sorted((ordervalue(value), value)
+                        for value in self.values_of_key(key))
+        if reverse:
+            values.reverse()
+
+        for orderkey, value in values:
+            for page in sorted(self.pages_with_value(key, value)):
+                yield orderkey, page
+
+    def metakeys(self):
+        return self._scan_meta()[0].keys()
+
+    def metavalues(self):
+        return self._scan_meta()[2].keys()
+
+    def _scan_meta(self):
+        if hasattr(self, '_meta_scan'):
+            return self._meta_scan
+
+        key_pages = dict()
+        keyval_pages = dict()
+        val_keys = dict()
+        key_vals = dict()
+
+        for page in self:
             value = self[page]
 
             for key in value.get('meta', dict()):
-                self.keys_on_pages.setdefault(key, set()).add(page)
+                key_pages.setdefault(key, set()).add(page)
                 for val in value['meta'][key]:
-                    self.vals_on_pages.setdefault(val, set()).add(page)
-                    self.vals_on_keys.setdefault(key, set()).add(val)
+                    keyval_pages.setdefault((key, val), set()).add(page)
+                    val_keys.setdefault(val, set()).add(key)
+                    key_vals.setdefault(key, set()).add(val)
+
+        self._meta_scan = key_pages, keyval_pages, val_keys, key_vals
+        return self._meta_scan
 
     def set_page(self, request, pagename, new_data):
         raise NotImplementedError()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+Process-wide cache of page records for the graph data backends
+
+The cache is shared by the graph data instances, and thus the
+requests, of a worker process. The records in it are shared too and
+must not be modified. Each entry carries the generation of the page
+it was read at and the generation of the whole store it was last
+checked against, the backend decides whether it is still valid.
+"""
+import threading
+
+# Fields of the links of the LRU list
+PREV, NEXT, KEY, VALUE = range(4)
+
+class PageCache(object):
+    """
+    Size-bounded LRU of page records.
+
+    >>> cache = PageCache(2)
+    >>> cache.set('a', {u'meta': {}}, 1, 5)
+    >>> cache.set('b', {}, 2, 5)
+    >>> cache.get('a')
+    ({u'meta': {}}, 1, 5)
+    >>> cache.set('c', {}, 3, 5)
+    >>> cache.get('b') is None
+    True
+    >>> cache.validate('a', 6)
+    >>> cache.get('a')
+    ({u'meta': {}}, 1, 6)
+    >>> cache.discard('a')
+    >>> cache.set('d', {}, 4, 6)
+    >>> sorted(cache._links)
+    ['c', 'd']
+    """
+
+    def __init__(self, size):
+        self.size = size
+        # key -> [prev, next, key, entry], the links of a circular
+        # list from the least recently used to the most recently used
+        self._links = dict()
+        self._root = root = [None, None, None, None]
+        root[PREV] = root[NEXT] = root
+        self._lock = threading.Lock()
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _append(self, link):
+        root = self._root
+        last = root[PREV]
+        link[PREV], link[NEXT] = last, root
+        last[NEXT] = root[PREV] = link
+
+    def get(self, key):
+        """
+        Return (record, page generation, checked generation) of the
+        key, or None if it is not cached.
+        """
+        self._lock.acquire()
+        try:
+            link = self._links.get(key, None)
+            if link is None:
+                return None
+            # Most recently used last
+            self._unlink(link)
+            self._append(link)
+            return tuple(link[VALUE])
+        finally:
+            self._lock.release()
+
+    def set(self, key, record, pagegen, checked):
+        self._lock.acquire()
+        try:
+            link = self._links.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+            link = [None, None, key, [record, pagegen, checked]]
+            self._append(link)
+            self._links[key] = link
+
+            while len(self._links) > self.size:
+                oldest = self._root[NEXT]
+                self._unlink(oldest)
+                del self._links[oldest[KEY]]
+        finally:
+            self._lock.release()
+
+    def validate(self, key, checked):
+        """
+        Mark the entry as valid in the store generation checked.
+        """
+        self._lock.acquire()
+        try:
+            link = self._links.get(key, None)
+            if link is not None:
+                link[VALUE][2] = checked
+        finally:
+            self._lock.release()
+
+    def discard(self, key):
+        self._lock.acquire()
+        try:
+            link = self._links.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._links.clear()
+            root = self._root
+            root[PREV] = root[NEXT] = root
+        finally:
+            self._lock.release()
+
+_caches = dict()
+_caches_lock = threading.Lock()
+
+def shared_cache(path, size):
+    """
+    Return the process-wide PageCache of the graph store at path,
+    or None if size is not positive.
+    """
+    if size <= 0:
+        return None
+
+    _caches_lock.acquire()
+    try:
+        cache = _caches.get(path, None)
+        if cache is None:
+            cache = _caches[path] = PageCache(size)
+        cache.size = size
+        return cache
+    finally:
+        _caches_lock.release()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact page records for the shelve backend
+
+A record stores the meta, order, out-link and in-link sections of the
+page data separately, so that eg. reading the metas of a category page
+does not decode its in-links. The order section holds the order keys
+of the metas (see get_order) and is not part of the page data. The
+key names of the sections are stored once per record and interned
+when read, so the records cached by a process share them.
+
+Records are versioned tuples:
+
+    (RECORD_VERSION, header, keys, meta, order, out, in)
+
+where header holds the rest of the page data (acl, mtime, saved),
+keys the key names and each section is None if the page data does
+not have it, or a marshalled list of (key index, values). Empty
+sections and a false saved flag are left out, as in the page data of
+the SQLite backend.
+"""
+import marshal
+
+from MoinMoin.metadata.util import order_metas
+
+RECORD_VERSION = 1
+
+SECTIONS = (u'meta', u'order', u'out', u'in')
+
+_interned = dict()
+
+def _intern(key):
+    return _interned.setdefault(key, key)
+
+def encode_record(pagedata):
+    """
+    Return the record of the page data.
+
+    >>> pagedata = {u'meta': {u'k': [u'1']}, u'in': {u'k': [u'A', u'B']},
+    ...             u'saved': True}
+    >>> record = encode_record(pagedata)
+    >>> record[:3]
+    (1, {u'saved': True}, (u'k',))
+    >>> record[5] is None
+    True
+    >>> PageRecord(record).pagedata() == pagedata
+    True
+    >>> PageRecord(record).get(u'order')
+    {u'k': [(1, '')]}
+    >>> encode_record({u'meta': {}, u'saved': False})
+    (1, {}, (), None, None, None, None)
+    """
+    keys = list()
+    indices = dict()
+
+    def index(key):
+        if key not in indices:
+            indices[key] = len(keys)
+            keys.append(key)
+        return indices[key]
+
+    sections = list()
+    for name in SECTIONS:
+        if name == u'order':
+            section = pagedata.get(u'meta', None)
+            if section is not None:
+                section = order_metas(section)
+        else:
+            section = pagedata.get(name, None)
+        if not section:
+            sections.append(None)
+            continue
+
+        items = [(index(key), values) for key, values in section.iteritems()]
+        try:
+            sections.append(marshal.dumps(items, 2))
+        except ValueError:
+            # Values of unexpected types, store as is
+            return pagedata
+
+    header = dict((key, value) for key, value in pagedata.iteritems()
+                  if key not in SECTIONS)
+    if not header.get(u'saved', True):
+        del header[u'saved']
+    return (RECORD_VERSION, header, tuple(keys)) + tuple(sections)
+
+class PageRecord(object):
+    """
+    Page data of a record, with the sections decoded on first use.
+    Also reads the plain page data dicts of the older shelves, leaving
+    out the order keys some of them have among the page data.
+
+    The records can be shared between requests, and the page data
+    read from them must not be modified.
+
+    >>> record = PageRecord(encode_record({u'meta': {u'k': [u'1']},
+    ...                                    u'in': {u'k': [u'A']},
+    ...                                    u'acl': u''}))
+    >>> record.get(u'meta')
+    {u'k': [u'1']}
+    >>> sorted(record._sections)
+    [u'meta']
+    >>> record.get(u'out', {})
+    {}
+    >>> PageRecord({u'meta': {u'k': [u'1']}}).get(u'meta')
+    {u'k': [u'1']}
+    >>> PageRecord({u'order': {u'k': [(1, u'')]}}).pagedata()
+    {}
+    """
+    __slots__ = ['_header', '_keys', '_raw', '_sections', '_pagedata']
+
+    def __init__(self, record):
+        if isinstance(record, dict):
+            if u'order' in record:
+                record = dict(record)
+                del record[u'order']
+            self._pagedata = record
+            return
+
+        if record[0] != RECORD_VERSION:
+            raise ValueError("unknown page record version %r" % (record[0],))
+
+        self._pagedata = None
+        self._header = record[1]
+        self._keys = [_intern(key) for key in record[2]]
+        self._raw = dict(zip(SECTIONS, record[3:]))
+        self._sections = dict()
+
+    def get(self, name, default=None):
+        if self._pagedata is not None:
+            return self._pagedata.get(name, default)
+        if name not in SECTIONS:
+            return self._header.get(name, default)
+
+        section = self._sections.get(name, None)
+        if section is not None:
+            return section
+
+        raw = self._raw[name]
+        if raw is None:
+            return default
+
+        keys = self._keys
+        section = dict((keys[index], values)
+                       for index, values in marshal.loads(raw))
+        self._sections[name] = section
+        return section
+
+    def __contains__(self, name):
+        return self.get(name, None) is not None
+
+    def pagedata(self):
+        """
+        Return the whole page data as a dict.
+        """
+        if self._pagedata is None:
+            pagedata = dict(self._header)
+            for name in SECTIONS:
+                if name == u'order':
+                    continue
+                section = self.get(name, None)
+                if section is not None:
+                    pagedata[name] = section
+            self._pagedata = pagedata
+        return self._pagedata
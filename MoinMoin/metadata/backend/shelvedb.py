@@ -9,18 +9,45 @@ Needless to say, it doesn't do ACID.
 
 """
 import shelve
+import anydbm
+import copy
 import random
 import errno
 import fcntl
 import os
 
-from basedb import GraphDataBase
-from MoinMoin.metadata.constants import NO_TYPE
+from basedb import GraphDataBase, meta_changes
+from pagecache import shared_cache
+from record import PageRecord, encode_record
+from MoinMoin.metadata.constants import NO_TYPE, ANY_DEPENDENCY
 from MoinMoin.metadata.util import (encode_page, decode_page, 
-                                    node_type, log)
+                                    node_type, order_metas, log)
 
 from time import time, sleep
 
+INDEX_BUILT = '\0built'
+# Incremented on every write, see close
+GENERATION = '\0generation'
+# Generation of the last load_pages, the default of the page and
+# dependency generations
+EPOCH = '\0epoch'
+# Sequence numbers of the latest and the oldest kept journal entry
+JOURNAL = '\0journal'
+JOURNAL_START = '\0journal-start'
+
+def _ikey(kind, *parts):
+    # Index entries: 'k' key -> pages, 'v' (key, value) -> pages,
+    # 'r' value -> keys, 'kv' key -> values, 'g' page -> generation,
+    # 'd' dependency -> generation, 's' name -> value of set_state,
+    # 'j' sequence number -> journal entry
+    return '\0'.join((kind,) + tuple(encode_page(x) for x in parts))
+
+def _jkey(seq):
+    return _ikey('j', u'%d' % (seq,))
+
+def _is_journal(ikey):
+    return ikey in (JOURNAL, JOURNAL_START) or ikey.startswith('j\0')
+
 class LockTimeout(Exception):
     pass
 
@@ -101,6 +128,7 @@ class GraphData(GraphDataBase):
         if not os.path.isdir(gddir):
             os.mkdir(gddir)
         self.graphshelve = os.path.join(gddir, 'graphdata.shelve')
+        self.indexshelve = os.path.join(gddir, 'graphdata-index.shelve')
 
         self.use_sq_dict = getattr(request.cfg, 'use_sq_dict', False)
         if self.use_sq_dict:
@@ -115,10 +143,24 @@ class GraphData(GraphDataBase):
             db = self.shelveopen(self.graphshelve, 'c')
             db.close()
 
+        # Shelves from before the meta indexes get theirs built on
+        # first use
+        self._index_built = False
+        self._meta_dirty = set()
+        self._bumped = set()
+        self._state = dict()
+
         self.db = None
+        self.idb = None
         self.cache = dict()
         self.out = dict()
 
+        # Decoded pages shared by the requests of this process,
+        # validated against the generations of the store and page
+        cache_size = getattr(request.cfg, 'gwiki_graphdata_cache_size', 10000)
+        self.shared = shared_cache(self.graphshelve, cache_size)
+        self._generation = None
+
         lock_path = os.path.join(gddir, "graphdata-lock")
         self._lock_timeout = getattr(request.cfg, 'graphdata_lock_timeout', None)
         self._readlock = _Lock(lock_path, exclusive=False)
@@ -132,12 +174,108 @@ class GraphData(GraphDataBase):
                 raise KeyError(page)
             return self.out[page]
 
-        if page in self.cache:
-            return self.cache[page]
+        return self._record(page).pagedata()
+
+    def _record(self, page):
+        # The caches keep PageRecords, which decode only the sections
+        # that are used
+        record = self.cache.get(page, None)
+        if record is not None:
+            return record
 
         self.readlock()
-        self.cache[page] = self.db[page]
-        return self.cache[page]
+        record = self._shared_get(page)
+        if record is None:
+            record = PageRecord(self.db[page])
+            self._shared_set(page, record)
+        self.cache[page] = record
+        return record
+
+    def _section(self, pagename, name, default):
+        page = encode_page(pagename)
+
+        if page in self.out:
+            if self.out[page] is self.UNDEFINED:
+                return default
+            return self.out[page].get(name, default)
+
+        try:
+            return self._record(page).get(name, default)
+        except KeyError:
+            return default
+
+    def _page_generation(self, page):
+        return self.idb.get(_ikey('g', decode_page(page)),
+                            self.idb.get(EPOCH, 0))
+
+    def _shared_get(self, page):
+        if self.shared is None or self._generation is None:
+            return None
+
+        entry = self.shared.get(page)
+        if entry is None:
+            return None
+
+        record, pagegen, checked = entry
+        if checked != self._generation:
+            # Something has been written since, see if it was this page
+            if self._page_generation(page) != pagegen:
+                self.shared.discard(page)
+                return None
+            self.shared.validate(page, self._generation)
+        return record
+
+    def _shared_set(self, page, record):
+        if self.shared is None or self._generation is None:
+            return
+        self.shared.set(page, record, self._page_generation(page),
+                        self._generation)
+
+    def _writable(self, pagename):
+        # Pages read from the caches are shared, modify a copy
+        page = encode_page(pagename)
+        if page in self.out and self.out[page] is not self.UNDEFINED:
+            return self.out[page]
+        return copy.deepcopy(self.get(pagename, dict()))
+
+    def getpages(self, pagenames):
+        result = dict()
+        missing = dict()
+        for pagename in pagenames:
+            page = encode_page(pagename)
+            if page in self.out:
+                if self.out[page] is not self.UNDEFINED:
+                    result[pagename] = self.out[page]
+                else:
+                    result[pagename] = dict()
+            elif page in self.cache:
+                result[pagename] = self.cache[page].pagedata()
+            else:
+                missing[page] = pagename
+
+        if missing:
+            self.readlock()
+            for page in missing.keys():
+                record = self._shared_get(page)
+                if record is not None:
+                    self.cache[page] = record
+                    result[missing.pop(page)] = record.pagedata()
+
+        if missing:
+            self.readlock()
+            # Fetch in key order, which is also the on-disk order of
+            # the btree based dbm modules
+            for page in sorted(missing):
+                try:
+                    record = PageRecord(self.db[page])
+                except KeyError:
+                    result[missing[page]] = dict()
+                    continue
+                self._shared_set(page, record)
+                self.cache[page] = record
+                result[missing[page]] = record.pagedata()
+
+        return result
 
     def __setitem__(self, item, value):
         self.savepage(item, value)
@@ -150,26 +288,32 @@ class GraphData(GraphDataBase):
         self.cache.pop(page, None)
 
     def is_saved(self, pagename):
-        return self.getpage(pagename).get('saved', False)
+        return self._section(pagename, u'saved', False)
 
     def get_out(self, pagename):
-        return self.getpage(pagename).get(u'out', {})
+        return self._section(pagename, u'out', {})
 
     def get_in(self, pagename):
-        return self.getpage(pagename).get(u'in', {})
+        return self._section(pagename, u'in', {})
 
     def get_meta(self, pagename):
-        return self.getpage(pagename).get(u'meta', {})
+        return self._section(pagename, u'meta', {})
+
+    def get_order(self, pagename):
+        order = self._section(pagename, u'order', None)
+        # Pages saved before order keys were stored
+        if order is None:
+            return order_metas(self.get_meta(pagename))
+        return order
 
     def get_metakeys(self, name):
         """
         Return the complete set of page's (non-link) meta keys, plus gwiki category.
         """
 
-        page = self.getpage(name)
-        keys = set(page.get('meta', dict()))
+        keys = set(self.get_meta(name))
 
-        if page.get('out', dict()).has_key('gwikicategory'):
+        if self.get_out(name).has_key('gwikicategory'):
             keys.add('gwikicategory')
 
         return keys
@@ -180,7 +324,12 @@ class GraphData(GraphDataBase):
     def cacheset(self, item, value):
         page = encode_page(item)
 
-        self.cache[page] = value
+        self.cache[page] = PageRecord(value)
+
+    def cachedel(self, item):
+        page = encode_page(item)
+
+        self.cache.pop(page, None)
 
     def __delitem__(self, item):
         self.delpage(item)
@@ -189,6 +338,7 @@ class GraphData(GraphDataBase):
         log.debug("delpage %s" % (repr(pagename),))
         page = encode_page(pagename)
 
+        self._meta_dirty.add(decode_page(page))
         self.out[page] = self.UNDEFINED
         self.cache.pop(page, None)
 
@@ -216,26 +366,33 @@ class GraphData(GraphDataBase):
         return page in self.db
 
     def set_page_meta(self, pagename, newmeta):
-        pagedata = self.getpage(pagename)
+        self._meta_dirty.add(pagename)
+        pagedata = self._writable(pagename)
         pagedata[u'meta'] = newmeta
         self.savepage(pagename, pagedata)
 
     def set_acl(self, pagename, acl):
-        pagedata = self.getpage(pagename)
+        pagedata = self._writable(pagename)
         pagedata[u'acl'] = acl
         self.savepage(pagename, pagedata)
 
     def set_saved(self, pagename, saved, mtime):
-        pagedata = self.getpage(pagename)
+        pagedata = self._writable(pagename)
         pagedata[u'mtime'] = mtime
         pagedata[u'saved'] = saved
         self.savepage(pagename, pagedata)
 
-    def clear_page(self, pagename):
+    def clear_page(self, request, pagename):
+        # Remove the out-links along with the in-links they made
+        self._change_links(*self._changed_meta(request, pagename,
+                                               self.get_out(pagename),
+                                               {pagename: dict()}))
+
         if self.get_in(pagename):
-            pagedata = self.getpage(pagename)
+            pagedata = self._writable(pagename)
             pagedata[u'saved'] = False
             pagedata[u'meta'] = dict()
+            self._meta_dirty.add(pagename)
             pagedata[u'out'] = dict()
             self.savepage(pagename, pagedata)
         else:
@@ -257,15 +414,20 @@ class GraphData(GraphDataBase):
         log.debug("got a read lock for %r" % (self.graphshelve,))
 
         self.db = self.shelveopen(self.graphshelve, "r")
+        try:
+            self.idb = self.shelveopen(self.indexshelve, "r")
+        except anydbm.error:
+            self.idb = None
+            self._generation = None
+        else:
+            self._generation = self.idb.get(GENERATION, 0)
 
     def writelock(self):
         if self._writelock.is_locked():
             return
 
         if self._readlock.is_locked():
-            if self.db is not None:
-                self.db.close()
-                self.db = None
+            self._close_dbs()
             self._readlock.release()
             log.debug("released a write lock for %r" % (self.graphshelve,))
 
@@ -279,24 +441,99 @@ class GraphData(GraphDataBase):
         log.debug("got a write lock for %r" % (self.graphshelve,))
 
         self.db = self.shelveopen(self.graphshelve, "c")
+        self.idb = self.shelveopen(self.indexshelve, "c")
+        self._generation = self.idb.get(GENERATION, 0)
 
-    def close(self):
-        if self.out:
-            self.writelock()
+    def _close_dbs(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+        if self.idb is not None:
+            self.idb.close()
+            self.idb = None
+        self._generation = None
 
-            for key, value in self.out.items():
-                if value is self.UNDEFINED:
-                    self.db.pop(key, None)
-                else:
-                    self.db[key] = value
+    def get_generations(self, deps):
+        self.readlock()
 
-            self.out = dict()
+        result = dict()
+        for dep in deps:
+            if dep in self._bumped:
+                result[dep] = None
+            elif dep == ANY_DEPENDENCY and self.out:
+                result[dep] = None
+            elif self.idb is None:
+                result[dep] = 0
+            elif dep == ANY_DEPENDENCY:
+                result[dep] = self.idb.get(GENERATION, 0)
+            else:
+                result[dep] = self.idb.get(_ikey('d', dep),
+                                           self.idb.get(EPOCH, 0))
+        return result
+
+    def bump_generations(self, deps):
+        # Written on close with the rest
+        self._bumped.update(deps)
+        self._bumped.add(ANY_DEPENDENCY)
+
+    def get_state(self, name, default=None):
+        if name in self._state:
+            return self._state[name]
 
-        self.cache.clear()
+        self.readlock()
+        if self.idb is None:
+            return default
+        return self.idb.get(_ikey('s', name), default)
 
-        if self.db is not None:
-            self.db.close()
-            self.db = None
+    def set_state(self, name, value):
+        # Written on close with the rest
+        self._state[name] = value
+
+    def _write(self):
+        if not (self.out or self._bumped or self._state):
+            return
+
+        self.writelock()
+
+        if self._meta_dirty:
+            self._flush_index()
+            self._write_journal()
+
+        # Readers check their shared cache entries against these
+        generation = self.idb.get(GENERATION, 0) + 1
+
+        for key, value in self.out.items():
+            if value is self.UNDEFINED:
+                self.db.pop(key, None)
+            else:
+                self.db[key] = encode_record(value)
+            self.idb[_ikey('g', decode_page(key))] = generation
+            if self.shared is not None:
+                self.shared.discard(key)
+
+        for dep in self._bumped:
+            if dep != ANY_DEPENDENCY:
+                self.idb[_ikey('d', dep)] = generation
+
+        for name, value in self._state.iteritems():
+            self.idb[_ikey('s', name)] = value
+
+        self.idb[GENERATION] = generation
+        self._generation = generation
+        self._discard()
+
+    def _discard(self):
+        self.out = dict()
+        self._meta_dirty = set()
+        self._bumped = set()
+        self._state = dict()
+
+    def close(self):
+        # Changes that were not aborted are written even without commit
+        self._write()
+
+        self.cache.clear()
+        self._close_dbs()
 
         if self._writelock.release():
             log.debug("released a write lock for %r" % (self.graphshelve,))
@@ -308,6 +545,227 @@ class GraphData(GraphDataBase):
         else:
             log.debug("did not released any read locks for %r" % (self.graphshelve,))
 
+    def load_pages(self, pages):
+        self.writelock()
+
+        # Nothing in the old shelves is valid anymore, but the
+        # generations must still grow for the caches to notice
+        generation = self.idb.get(GENERATION, 0) + 1
+        # The journal continues over the reload, it is not rewritten
+        for db in [self.db, self.idb]:
+            for key in db.keys():
+                if db is self.idb and _is_journal(key):
+                    continue
+                del db[key]
+
+        entries = dict()
+        for pagename, pagedata in pages.iteritems():
+            self.db[encode_page(pagename)] = encode_record(pagedata)
+            self._update_index(entries, pagename, dict(),
+                               pagedata.get(u'meta', dict()))
+        self._write_index(entries)
+
+        self.idb[INDEX_BUILT] = True
+        self.idb[EPOCH] = generation
+        self.idb[GENERATION] = generation
+        self._index_built = True
+        self._generation = generation
+
+        self.out = dict()
+        self.cache.clear()
+        self._meta_dirty = set()
+        self._bumped = set()
+        if self.shared is not None:
+            self.shared.clear()
+
+    # Journal of the meta changes, kept in the index shelve and
+    # written on close
+
+    def _write_journal(self):
+        seq = self.idb.get(JOURNAL, 0)
+        for pagename in sorted(self._meta_dirty):
+            key = encode_page(pagename)
+            if key not in self.out:
+                continue
+
+            old_meta = PageRecord(self.db.get(key, dict()))
+            old_meta = old_meta.get(u'meta', dict())
+            new_meta = dict()
+            if self.out[key] is not self.UNDEFINED:
+                new_meta = self.out[key].get(u'meta', dict())
+
+            for change in meta_changes(old_meta, new_meta):
+                seq += 1
+                self.idb[_jkey(seq)] = (pagename,) + change
+        self.idb[JOURNAL] = seq
+
+        start = self.idb.get(JOURNAL_START, 1)
+        while seq - start >= self.journal_size:
+            self.idb.pop(_jkey(start), None)
+            start += 1
+        self.idb[JOURNAL_START] = start
+
+    def journal_position(self):
+        self.readlock()
+        if self.idb is None:
+            return 0
+        return self.idb.get(JOURNAL, 0)
+
+    def get_changes(self, since=0, limit=None):
+        last = self.journal_position()
+        start = 1
+        if self.idb is not None:
+            start = self.idb.get(JOURNAL_START, 1)
+        if not start - 1 <= since <= last:
+            return None
+
+        end = last
+        if limit is not None:
+            end = min(last, since + limit)
+
+        changes = list()
+        for seq in xrange(since + 1, end + 1):
+            changes.append((seq,) + self.idb[_jkey(seq)])
+        return changes
+
+    # Meta indexes, kept in a separate shelve under the same lock.
+    # They are updated on close, lookups check the pages changed
+    # during the current request separately.
+
+    def _index(self):
+        self.readlock()
+        if not self._index_built:
+            if self.idb is None or not self.idb.has_key(INDEX_BUILT):
+                self._build_index()
+            self._index_built = True
+        return self.idb
+
+    def _build_index(self):
+        log.info("building meta indexes for %r" % (self.graphshelve,))
+        self.writelock()
+
+        entries = dict()
+        for key in self.db.keys():
+            record = PageRecord(self.db[key])
+            self._update_index(entries, decode_page(key), dict(),
+                               record.get(u'meta', dict()))
+        self._write_index(entries)
+        self.idb[INDEX_BUILT] = True
+
+        self._index_built = True
+
+    def _flush_index(self):
+        if not self._index_built and not self.idb.has_key(INDEX_BUILT):
+            self._build_index()
+
+        entries = dict()
+        for pagename in self._meta_dirty:
+            key = encode_page(pagename)
+            if key not in self.out:
+                continue
+
+            old_meta = PageRecord(self.db.get(key, dict()))
+            old_meta = old_meta.get(u'meta', dict())
+            new_meta = dict()
+            if self.out[key] is not self.UNDEFINED:
+                new_meta = self.out[key].get(u'meta', dict())
+
+            self._update_index(entries, pagename, old_meta, new_meta)
+        self._write_index(entries)
+
+    def _update_index(self, entries, pagename, old_meta, new_meta):
+        def entry(ikey):
+            if ikey not in entries:
+                entries[ikey] = set(self.idb.get(ikey, set()))
+            return entries[ikey]
+
+        old_keys, new_keys = set(old_meta), set(new_meta)
+        for key in old_keys - new_keys:
+            entry(_ikey('k', key)).discard(pagename)
+        for key in new_keys - old_keys:
+            entry(_ikey('k', key)).add(pagename)
+
+        old_pairs = set((key, val) for key in old_meta
+                        for val in old_meta[key])
+        new_pairs = set((key, val) for key in new_meta
+                        for val in new_meta[key])
+
+        for key, val in old_pairs - new_pairs:
+            pages = entry(_ikey('v', key, val))
+            pages.discard(pagename)
+            if not pages:
+                entry(_ikey('r', val)).discard(key)
+                entry(_ikey('kv', key)).discard(val)
+
+        for key, val in new_pairs - old_pairs:
+            entry(_ikey('v', key, val)).add(pagename)
+            entry(_ikey('r', val)).add(key)
+            entry(_ikey('kv', key)).add(val)
+
+    def _write_index(self, entries):
+        for ikey, value in entries.iteritems():
+            if value:
+                self.idb[ikey] = value
+            else:
+                self.idb.pop(ikey, None)
+
+    def _index_enumerate(self, kind):
+        prefix = kind + '\0'
+        return [decode_page(ikey[len(prefix):])
+                for ikey in self._index().keys() if ikey.startswith(prefix)]
+
+    def _dirty_pages(self, pages, match):
+        # The pages changed during this request are not in the
+        # indexes yet, check them against their current metas
+        if not self._meta_dirty:
+            return pages
+
+        pages = set(pages)
+        for pagename in self._meta_dirty:
+            if match(self.get_meta(pagename)):
+                pages.add(pagename)
+            else:
+                pages.discard(pagename)
+        return pages
+
+    def _dirty_items(self, items, found):
+        # As above, but only adds to the items, which can be left with
+        # some that are no longer there
+        if not self._meta_dirty:
+            return items
+
+        items = set(items)
+        for pagename in self._meta_dirty:
+            items.update(found(self.get_meta(pagename)))
+        return items
+
+    def pages_with_key(self, key):
+        return self._dirty_pages(self._index().get(_ikey('k', key), set()),
+                                 lambda metas: key in metas)
+
+    def pages_with_value(self, key, value):
+        return self._dirty_pages(self._index().get(_ikey('v', key, value),
+                                                   set()),
+                                 lambda metas: value in metas.get(key, ()))
+
+    def keys_with_value(self, value):
+        return self._dirty_items(self._index().get(_ikey('r', value), set()),
+                                 lambda metas: [key for key in metas
+                                                if value in metas[key]])
+
+    def values_of_key(self, key):
+        return self._dirty_items(self._index().get(_ikey('kv', key), set()),
+                                 lambda metas: metas.get(key, ()))
+
+    def metakeys(self):
+        return list(self._dirty_items(self._index_enumerate('k'),
+                                      lambda metas: metas.keys()))
+
+    def metavalues(self):
+        return list(self._dirty_items(self._index_enumerate('r'),
+                                      lambda metas: [value for key in metas
+                                                     for value in metas[key]]))
+
     def set_page(self, request, pagename, new_data):
         # Get a copy of current data
         old_outs = self.get_out(pagename)
@@ -495,7 +953,7 @@ class GraphData(GraphDataBase):
     def _remove_in(self, (frm, to), linktype):
         "Remove in-links from local nodes to current node"
 
-        temp = self.getpage(to)
+        temp = self._writable(to)
         if not temp.has_key(u'in'):
             return
 
@@ -520,7 +978,7 @@ class GraphData(GraphDataBase):
     def _remove_out(self, (frm, to), linktype):
         "remove outlinks"
 
-        temp = self.get(frm, {})
+        temp = self._writable(frm)
 
         if not temp.has_key(u'out'):
             return 
@@ -550,7 +1008,7 @@ class GraphData(GraphDataBase):
         if not linktype:
             linktype = NO_TYPE
 
-        temp = self.get(to, {})
+        temp = self._writable(to)
 
         if not temp.has_key(u'in'):
             temp[u'in'] = {linktype: [frm]}
@@ -570,7 +1028,7 @@ class GraphData(GraphDataBase):
         if not linktype:
             linktype = NO_TYPE
 
-        temp = self.get(frm, {})
+        temp = self._writable(frm)
 
         if not temp.has_key(u'out'):
             temp[u'out'] = {linktype: [to]}
@@ -588,8 +1046,11 @@ class GraphData(GraphDataBase):
         self._add_out(edge, linktype)
 
     def commit(self):
-        # Ha, puny gullible humans think I do transactions
-        pass
+        # Not atomic, the changes are just written right away instead
+        # of on close
+        self._write()
 
-    abort = commit
+    def abort(self):
+        # Forget the changes not written yet
+        self._discard()
 
@@ -0,0 +1,796 @@
+# -*- coding: utf-8 -*-
+
+"""
+SQLite backend for gwiki
+
+Stores pages, metas, out-links and in-links in normalised tables of a
+single SQLite database running in WAL mode. Readers never block on
+the writer, page data can be read one section at a time and
+commit/abort are real transactions.
+
+Enable it in the wiki config with:
+
+    dbconfig = {'backend': 'sqlite'}
+
+Optional dbconfig keys: 'path' (database file, defaults to
+data/graphdata/graphdata.sqlite) and 'timeout' (seconds to wait for
+the write lock, defaults to graphdata_lock_timeout or 30).
+"""
+import os
+import marshal
+import sqlite3
+
+from time import time
+
+from basedb import GraphDataBase, meta_changes
+from MoinMoin.metadata.constants import NO_TYPE, ANY_DEPENDENCY
+from MoinMoin.metadata.util import decode_page, node_type, ordervalue, log
+
+SCHEMA_VERSION = 6
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    saved INTEGER NOT NULL DEFAULT 0,
+    mtime REAL,
+    acl TEXT
+);
+CREATE TABLE IF NOT EXISTS metas (
+    page INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    okey,
+    oextra TEXT
+);
+CREATE INDEX IF NOT EXISTS metas_page ON metas (page);
+CREATE INDEX IF NOT EXISTS metas_key_value ON metas (key, value);
+CREATE INDEX IF NOT EXISTS metas_value ON metas (value);
+CREATE INDEX IF NOT EXISTS metas_key_order ON metas (key, okey, oextra);
+CREATE TABLE IF NOT EXISTS outlinks (
+    page INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    dst TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outlinks_page ON outlinks (page);
+CREATE TABLE IF NOT EXISTS inlinks (
+    page INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    src TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS inlinks_page ON inlinks (page);
+CREATE INDEX IF NOT EXISTS inlinks_src ON inlinks (src);
+CREATE TABLE IF NOT EXISTS generations (
+    dep TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS state (
+    name TEXT PRIMARY KEY,
+    value
+);
+CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    page TEXT NOT NULL,
+    key TEXT NOT NULL,
+    added BLOB NOT NULL,
+    removed BLOB NOT NULL
+);
+"""
+
+# Generation of the last load_pages, the default generation of the
+# dependencies
+EPOCH = u'\0epoch'
+
+def _u(name):
+    if isinstance(name, unicode):
+        return name
+    return decode_page(name)
+
+def _orderkey(value):
+    okey, oextra = ordervalue(value)
+    # SQLite integers are 64-bit
+    if isinstance(okey, (int, long)) and not -2**63 <= okey < 2**63:
+        okey = float(okey)
+    return okey, oextra
+
+def _multimap(rows):
+    result = dict()
+    for key, value in rows:
+        result.setdefault(key, list()).append(value)
+    return result
+
+# Stay well below the default limit of 999 query parameters
+BATCH_SIZE = 500
+
+def _batches(items):
+    items = list(items)
+    for i in xrange(0, len(items), BATCH_SIZE):
+        yield items[i:i + BATCH_SIZE]
+
+def _pagedata(saved, mtime, acl, metas, outs, ins):
+    pagedata = dict()
+    for key, section in [(u'meta', metas), (u'out', outs), (u'in', ins)]:
+        if section:
+            pagedata[key] = section
+    if mtime is not None:
+        pagedata[u'mtime'] = mtime
+    if acl is not None:
+        pagedata[u'acl'] = acl
+    if saved:
+        pagedata[u'saved'] = True
+    return pagedata
+
+class GraphData(GraphDataBase):
+    is_acid = True
+
+    def __init__(self, request, path=None, timeout=None, **kw):
+        log.debug("sqlite graphdb init")
+        GraphDataBase.__init__(self, request, **kw)
+
+        if path is None:
+            gddir = os.path.join(request.cfg.data_dir, 'graphdata')
+            if not os.path.isdir(gddir):
+                os.mkdir(gddir)
+            path = os.path.join(gddir, 'graphdata.sqlite')
+        self.dbpath = path
+
+        if timeout is None:
+            timeout = getattr(request.cfg, 'graphdata_lock_timeout', None)
+        if timeout is None:
+            timeout = 30.0
+
+        # Transactions are handled explicitly, see _begin
+        self.db = sqlite3.connect(self.dbpath, timeout=timeout,
+                                  isolation_level=None,
+                                  check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self._in_transaction = False
+        self._bumped = set()
+        self._journaled = False
+        # Page data set with cacheset for this request only, shown
+        # instead of the stored page data
+        self.cache = dict()
+        self.init_db()
+
+    def init_db(self):
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+
+        self._begin()
+        if 0 < version < 3:
+            self.db.execute("ALTER TABLE metas ADD COLUMN okey")
+            self.db.execute("ALTER TABLE metas ADD COLUMN oextra TEXT")
+            rows = self.db.execute("SELECT rowid, value FROM metas")
+            self.db.executemany("UPDATE metas SET okey = ?, oextra = ? " +
+                                "WHERE rowid = ?",
+                                [_orderkey(value) + (rowid,)
+                                 for rowid, value in rows.fetchall()])
+
+        # executescript would commit behind our back
+        for statement in SCHEMA.split(';'):
+            self.db.execute(statement)
+        self.db.execute("PRAGMA user_version=%d" % (SCHEMA_VERSION,))
+        self.commit()
+
+    def _begin(self):
+        # Called first by every method that writes, so that nothing is
+        # written in autocommit mode behind abort and the generations
+        if self._in_transaction:
+            return
+        # Take the write lock right away instead of upgrading a read
+        # lock later, which could deadlock with another writer
+        self.db.execute("BEGIN IMMEDIATE")
+        self._in_transaction = True
+
+    def _page_id(self, pagename, create=False):
+        pagename = _u(pagename)
+        row = self.db.execute("SELECT id FROM pages WHERE name = ?",
+                              (pagename,)).fetchone()
+        if row is not None:
+            return row[0]
+        if not create:
+            return None
+
+        self._begin()
+        cursor = self.db.execute("INSERT INTO pages (name) VALUES (?)",
+                                 (pagename,))
+        return cursor.lastrowid
+
+    def _touch(self, pagenames, mtime):
+        # Notification that the destinations have changed
+        for pagename in pagenames:
+            self.db.execute("UPDATE pages SET mtime = ? WHERE name = ?",
+                            (mtime, pagename))
+
+    def _metas(self, pid):
+        return _multimap(self.db.execute(
+                "SELECT key, value FROM metas WHERE page = ? ORDER BY rowid",
+                (pid,)))
+
+    def _outs(self, pid):
+        return _multimap(self.db.execute(
+                "SELECT key, dst FROM outlinks WHERE page = ? ORDER BY rowid",
+                (pid,)))
+
+    def _ins(self, pid):
+        return _multimap(self.db.execute(
+                "SELECT key, src FROM inlinks WHERE page = ? ORDER BY rowid",
+                (pid,)))
+
+    def _cached(self, pagename):
+        return self.cache.get(_u(pagename), None)
+
+    def cacheset(self, item, value):
+        self.cache[_u(item)] = value
+
+    def cachedel(self, item):
+        self.cache.pop(_u(item), None)
+
+    def __getitem__(self, item):
+        cached = self._cached(item)
+        if cached is not None:
+            return cached
+
+        row = self.db.execute("SELECT id, saved, mtime, acl FROM pages " +
+                              "WHERE name = ?", (_u(item),)).fetchone()
+        if row is None:
+            raise KeyError(item)
+        pid, saved, mtime, acl = row
+
+        return _pagedata(saved, mtime, acl, self._metas(pid),
+                         self._outs(pid), self._ins(pid))
+
+    def __setitem__(self, item, value):
+        self.savepage(item, value)
+
+    def savepage(self, pagename, pagedict):
+        log.debug("savepage %s = %s" % (repr(pagename), repr(pagedict)))
+        self._begin()
+        self.cachedel(pagename)
+        pid = self._page_id(pagename, create=True)
+        self._journal(pagename, self._metas(pid),
+                      pagedict.get(u'meta', dict()))
+        self._clear_rows(pid)
+
+        self._insert_metas(pid, pagedict.get(u'meta', dict()))
+        self._insert_outs(pid, pagedict.get(u'out', dict()))
+        for key, values in pagedict.get(u'in', dict()).iteritems():
+            self.db.executemany("INSERT INTO inlinks (page, key, src) " +
+                                "VALUES (?, ?, ?)",
+                                [(pid, key, _u(src)) for src in values])
+
+        self.db.execute("UPDATE pages SET saved = ?, mtime = ?, acl = ? " +
+                        "WHERE id = ?",
+                        (int(bool(pagedict.get(u'saved', False))),
+                         pagedict.get(u'mtime', None),
+                         pagedict.get(u'acl', None), pid))
+
+    def _clear_rows(self, pid):
+        for table in ['metas', 'outlinks', 'inlinks']:
+            self.db.execute("DELETE FROM %s WHERE page = ?" % (table,),
+                            (pid,))
+
+    def _insert_metas(self, pid, metas):
+        for key, values in metas.iteritems():
+            self.db.executemany("INSERT INTO metas " +
+                                "(page, key, value, okey, oextra) " +
+                                "VALUES (?, ?, ?, ?, ?)",
+                                [(pid, key, value) + _orderkey(value)
+                                 for value in values])
+
+    def _insert_outs(self, pid, outs):
+        for key, values in outs.iteritems():
+            if not key:
+                key = NO_TYPE
+            self.db.executemany("INSERT INTO outlinks (page, key, dst) " +
+                                "VALUES (?, ?, ?)",
+                                [(pid, key, dst) for dst in values])
+
+    def __delitem__(self, item):
+        self.delpage(item)
+
+    def delpage(self, pagename):
+        log.debug("delpage %s" % (repr(pagename),))
+        self._begin()
+        self.cachedel(pagename)
+        pid = self._page_id(pagename)
+        if pid is None:
+            raise KeyError(pagename)
+
+        self._journal(pagename, self._metas(pid), dict())
+        self._clear_rows(pid)
+        self.db.execute("DELETE FROM pages WHERE id = ?", (pid,))
+
+    def __iter__(self):
+        for (name,) in self.db.execute("SELECT name FROM pages"):
+            yield name
+
+    def keys(self):
+        return list(self.__iter__())
+
+    def pagenames(self):
+        return self.__iter__()
+
+    def __contains__(self, item):
+        if self._cached(item) is not None:
+            return True
+        return self._page_id(item) is not None
+
+    has_key = __contains__
+
+    def getpage(self, pagename):
+        try:
+            return self[pagename]
+        except KeyError:
+            return dict()
+
+    def _page_rows(self, pagenames):
+        # name -> (id, saved, mtime, acl) of the existing pages
+        rows = dict()
+        for batch in _batches(set(_u(x) for x in pagenames)):
+            query = ("SELECT name, id, saved, mtime, acl FROM pages " +
+                     "WHERE name IN (%s)" % (",".join("?" * len(batch)),))
+            for row in self.db.execute(query, batch):
+                rows[row[0]] = row[1:]
+        return rows
+
+    def _sections(self, table, column, pids, keys=None):
+        # page id -> {key: [values]} for many pages at a time
+        result = dict()
+        for batch in _batches(pids):
+            query = ("SELECT page, key, %s FROM %s " % (column, table) +
+                     "WHERE page IN (%s)" % (",".join("?" * len(batch)),))
+            args = list(batch)
+            if keys is not None:
+                query += " AND key IN (%s)" % (",".join("?" * len(keys)),)
+                args.extend(keys)
+            query += " ORDER BY rowid"
+
+            for pid, key, value in self.db.execute(query, args):
+                section = result.setdefault(pid, dict())
+                section.setdefault(key, list()).append(value)
+        return result
+
+    def getpages(self, pagenames):
+        pagenames = list(pagenames)
+        rows = self._page_rows(pagenames)
+        pids = [row[0] for row in rows.itervalues()]
+
+        metas = self._sections('metas', 'value', pids)
+        outs = self._sections('outlinks', 'dst', pids)
+        ins = self._sections('inlinks', 'src', pids)
+
+        result = dict()
+        for pagename in pagenames:
+            cached = self._cached(pagename)
+            if cached is not None:
+                result[pagename] = cached
+                continue
+            row = rows.get(_u(pagename), None)
+            if row is None:
+                result[pagename] = dict()
+                continue
+            pid, saved, mtime, acl = row
+            result[pagename] = _pagedata(saved, mtime, acl,
+                                         metas.get(pid, None),
+                                         outs.get(pid, None),
+                                         ins.get(pid, None))
+        return result
+
+    def get_metas_many(self, pagenames, keys=None):
+        pagenames = list(pagenames)
+        rows = self._page_rows(pagenames)
+        pids = [row[0] for row in rows.itervalues()]
+
+        query_keys = None
+        if keys is not None:
+            keys = list(keys)
+            # Leave room for the page ids in the query parameters
+            if len(keys) <= BATCH_SIZE:
+                query_keys = keys
+        metas = self._sections('metas', 'value', pids, query_keys)
+
+        result = dict()
+        for pagename in pagenames:
+            cached = self._cached(pagename)
+            row = rows.get(_u(pagename), None)
+            if cached is not None:
+                pagemetas = cached.get(u'meta', dict())
+            elif row is None:
+                result[pagename] = dict()
+                continue
+            else:
+                pagemetas = metas.get(row[0], dict())
+            if keys is None:
+                result[pagename] = pagemetas
+            else:
+                result[pagename] = dict((key, pagemetas[key])
+                                        for key in keys if key in pagemetas)
+        return result
+
+    def is_saved(self, pagename):
+        cached = self._cached(pagename)
+        if cached is not None:
+            return bool(cached.get(u'saved', False))
+        row = self.db.execute("SELECT saved FROM pages WHERE name = ?",
+                              (_u(pagename),)).fetchone()
+        return bool(row and row[0])
+
+    def get_meta(self, pagename):
+        cached = self._cached(pagename)
+        if cached is not None:
+            return cached.get(u'meta', dict())
+        pid = self._page_id(pagename)
+        if pid is None:
+            return dict()
+        return self._metas(pid)
+
+    def get_order(self, pagename):
+        if self._cached(pagename) is not None:
+            return GraphDataBase.get_order(self, pagename)
+        pid = self._page_id(pagename)
+        if pid is None:
+            return dict()
+
+        result = dict()
+        for key, okey, oextra in self.db.execute(
+                "SELECT key, okey, oextra FROM metas " +
+                "WHERE page = ? ORDER BY rowid", (pid,)):
+            result.setdefault(key, list()).append((okey, oextra))
+        return result
+
+    def get_out(self, pagename):
+        cached = self._cached(pagename)
+        if cached is not None:
+            return cached.get(u'out', dict())
+        pid = self._page_id(pagename)
+        if pid is None:
+            return dict()
+        return self._outs(pid)
+
+    def get_in(self, pagename):
+        cached = self._cached(pagename)
+        if cached is not None:
+            return cached.get(u'in', dict())
+        pid = self._page_id(pagename)
+        if pid is None:
+            return dict()
+        return self._ins(pid)
+
+    def get_metakeys(self, name):
+        """
+        Return the complete set of page's (non-link) meta keys, plus gwiki category.
+        """
+        cached = self._cached(name)
+        if cached is not None:
+            keys = set(cached.get(u'meta', dict()))
+            if u'gwikicategory' in cached.get(u'out', dict()):
+                keys.add('gwikicategory')
+            return keys
+
+        pid = self._page_id(name)
+        if pid is None:
+            return set()
+
+        keys = set(key for (key,) in self.db.execute(
+                "SELECT DISTINCT key FROM metas WHERE page = ?", (pid,)))
+
+        row = self.db.execute("SELECT 1 FROM outlinks " +
+                              "WHERE page = ? AND key = ? LIMIT 1",
+                              (pid, u'gwikicategory')).fetchone()
+        if row is not None:
+            keys.add('gwikicategory')
+
+        return keys
+
+    # Meta index lookups, answered from the metas table indexes
+
+    def _index_query(self, column, where, args):
+        query = ("SELECT DISTINCT %s FROM metas m " % (column,) +
+                 "JOIN pages p ON p.id = m.page WHERE %s" % (where,))
+        return set(row[0] for row in self.db.execute(query, args))
+
+    def pages_with_key(self, key):
+        return self._index_query('p.name', 'm.key = ?', (key,))
+
+    def pages_with_value(self, key, value):
+        return self._index_query('p.name', 'm.key = ? AND m.value = ?',
+                                 (key, value))
+
+    def pages_with_any_value(self, value):
+        return self._index_query('p.name', 'm.value = ?', (value,))
+
+    def keys_with_value(self, value):
+        return self._index_query('m.key', 'm.value = ?', (value,))
+
+    def values_of_key(self, key):
+        return self._index_query('m.value', 'm.key = ?', (key,))
+
+    def pages_with_order(self, key, op, orderkey):
+        if not isinstance(orderkey, tuple):
+            return GraphDataBase.pages_with_order(self, key, op, orderkey)
+
+        okey, oextra = _orderkey(orderkey)
+        # Same as comparing (okey, oextra) tuples. Like in Python 2,
+        # numbers sort before strings in SQLite.
+        if op == '==':
+            return self._index_query('p.name', 'm.key = ? AND ' +
+                                     'm.okey = ? AND m.oextra = ?',
+                                     (key, okey, oextra))
+        strict = op.rstrip('=')
+        where = ('m.key = ? AND (m.okey %s ? OR ' % (strict,) +
+                 '(m.okey = ? AND m.oextra %s ?))' % (op,))
+        return self._index_query('p.name', where, (key, okey, okey, oextra))
+
+    def pages_by_order(self, key, reverse=False):
+        # Walks the metas_key_order index
+        direction = reverse and 'DESC' or 'ASC'
+        rows = self.db.execute("SELECT m.okey, m.oextra, p.name " +
+                               "FROM metas m JOIN pages p " +
+                               "ON p.id = m.page WHERE m.key = ? " +
+                               "ORDER BY m.okey %s, m.oextra %s" %
+                               (direction, direction), (key,))
+        for okey, oextra, name in rows:
+            yield (okey, oextra), name
+
+    def metakeys(self):
+        return self._index_query('m.key', '1', ())
+
+    def metavalues(self):
+        return self._index_query('m.value', '1', ())
+
+    def set_page_meta(self, pagename, newmeta):
+        self._begin()
+        pid = self._page_id(pagename, create=True)
+        self._journal(pagename, self._metas(pid), newmeta)
+        self.db.execute("DELETE FROM metas WHERE page = ?", (pid,))
+        self._insert_metas(pid, newmeta)
+
+    def set_acl(self, pagename, acl):
+        self._begin()
+        pid = self._page_id(pagename, create=True)
+        self.db.execute("UPDATE pages SET acl = ? WHERE id = ?", (acl, pid))
+
+    def set_saved(self, pagename, saved, mtime):
+        self._begin()
+        pid = self._page_id(pagename, create=True)
+        self.db.execute("UPDATE pages SET saved = ?, mtime = ? WHERE id = ?",
+                        (int(bool(saved)), mtime, pid))
+
+    def _set_links(self, request, pagename, pid, new_outs, cur_time):
+        pagename = _u(pagename)
+
+        old_ins = self._local_links(request, self._outs(pid))
+        new_ins = self._local_links(request, new_outs)
+
+        self.db.execute("DELETE FROM outlinks WHERE page = ?", (pid,))
+        self._insert_outs(pid, new_outs)
+
+        if old_ins == new_ins:
+            return
+
+        # In-links do not have any sensible order, so only the pages
+        # whose in-links from this page truly changed are touched
+        changed = set()
+        for dst in set(old_ins) | set(new_ins):
+            if sorted(old_ins.get(dst, [])) != sorted(new_ins.get(dst, [])):
+                changed.add(dst)
+
+        self.db.execute("DELETE FROM inlinks WHERE src = ?", (pagename,))
+        for dst, keys in new_ins.iteritems():
+            dst_id = self._page_id(dst, create=True)
+            self.db.executemany("INSERT INTO inlinks (page, key, src) " +
+                                "VALUES (?, ?, ?)",
+                                [(dst_id, key, pagename) for key in keys])
+
+        self._touch(changed, cur_time)
+
+    def _local_links(self, request, outs):
+        # Only save in-links to local pages, not eg. url or interwiki
+        links = dict()
+        for key, values in outs.iteritems():
+            if not key:
+                key = NO_TYPE
+            for dst in values:
+                if node_type(request, dst) == 'page':
+                    links.setdefault(_u(dst), list()).append(key)
+        return links
+
+    def set_page(self, request, pagename, new_data):
+        pagedata = new_data.get(pagename, dict())
+        cur_time = time()
+
+        self._begin()
+        pid = self._page_id(pagename, create=True)
+
+        self.set_page_meta(pagename, pagedata.get(u'meta', dict()))
+        self._set_links(request, pagename, pid,
+                        pagedata.get(u'out', dict()), cur_time)
+        self.db.execute("UPDATE pages SET saved = 1, mtime = ?, acl = ? " +
+                        "WHERE id = ?",
+                        (cur_time, pagedata.get(u'acl', ''), pid))
+
+    def clear_page(self, request, pagename):
+        self._begin()
+        self.cachedel(pagename)
+        pid = self._page_id(pagename)
+        if pid is None:
+            return
+
+        self._set_links(request, pagename, pid, dict(), time())
+
+        if self.get_in(pagename):
+            self._journal(pagename, self._metas(pid), dict())
+            self.db.execute("DELETE FROM metas WHERE page = ?", (pid,))
+            self.db.execute("UPDATE pages SET saved = 0 WHERE id = ?", (pid,))
+        else:
+            self.delpage(pagename)
+
+    # Generations of the dependencies of cached output, changed
+    # along with the data in the same transaction
+
+    def _epoch(self):
+        row = self.db.execute("SELECT generation FROM generations " +
+                              "WHERE dep = ?", (EPOCH,)).fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def get_generations(self, deps):
+        deps = set(deps)
+        result = dict.fromkeys(deps, self._epoch())
+        for batch in _batches(deps):
+            query = ("SELECT dep, generation FROM generations " +
+                     "WHERE dep IN (%s)" % (",".join("?" * len(batch)),))
+            result.update(self.db.execute(query, batch))
+
+        for dep in deps & self._bumped:
+            result[dep] = None
+        if self._in_transaction and ANY_DEPENDENCY in deps:
+            result[ANY_DEPENDENCY] = None
+        return result
+
+    def _bump(self, deps):
+        epoch = self._epoch()
+        self.db.executemany("INSERT OR IGNORE INTO generations " +
+                            "(dep, generation) VALUES (?, ?)",
+                            [(dep, epoch) for dep in deps])
+        self.db.executemany("UPDATE generations " +
+                            "SET generation = generation + 1 WHERE dep = ?",
+                            [(dep,) for dep in deps])
+
+    def bump_generations(self, deps):
+        self._begin()
+        deps = set(deps) - self._bumped
+        self._bump(deps)
+        self._bumped.update(deps)
+
+    def get_state(self, name, default=None):
+        row = self.db.execute("SELECT value FROM state WHERE name = ?",
+                              (name,)).fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+    def set_state(self, name, value):
+        self._begin()
+        self.db.execute("INSERT OR REPLACE INTO state (name, value) " +
+                        "VALUES (?, ?)", (name, value))
+
+    def writelock(self):
+        self._begin()
+
+    # Journal of the meta changes, written in the same transaction
+
+    def _journal(self, pagename, old_meta, new_meta):
+        changes = meta_changes(old_meta, new_meta)
+        if not changes:
+            return
+
+        self._begin()
+        self.db.executemany("INSERT INTO journal " +
+                            "(page, key, added, removed) VALUES (?, ?, ?, ?)",
+                            [(_u(pagename), key,
+                              sqlite3.Binary(marshal.dumps(added)),
+                              sqlite3.Binary(marshal.dumps(removed)))
+                             for key, added, removed in changes])
+        self._journaled = True
+
+    def journal_position(self):
+        row = self.db.execute("SELECT seq FROM sqlite_sequence " +
+                              "WHERE name = 'journal'").fetchone()
+        if row is None:
+            return 0
+        return row[0]
+
+    def get_changes(self, since=0, limit=None):
+        last = self.journal_position()
+        first = self.db.execute("SELECT MIN(seq) FROM journal").fetchone()[0]
+        if first is None:
+            first = last + 1
+        if not first - 1 <= since <= last:
+            return None
+
+        if limit is None:
+            limit = -1
+        rows = self.db.execute("SELECT seq, page, key, added, removed " +
+                               "FROM journal WHERE seq > ? " +
+                               "ORDER BY seq LIMIT ?", (since, limit))
+        return [(seq, page, key,
+                 marshal.loads(str(added)), marshal.loads(str(removed)))
+                for seq, page, key, added, removed in rows]
+
+    def load_pages(self, pages):
+        self._begin()
+        for table in ['pages', 'metas', 'outlinks', 'inlinks']:
+            self.db.execute("DELETE FROM %s" % (table,))
+
+        # The generations must still grow for the caches to notice
+        row = self.db.execute("SELECT MAX(generation) " +
+                              "FROM generations").fetchone()
+        self.db.execute("DELETE FROM generations")
+        self.db.execute("INSERT INTO generations (dep, generation) " +
+                        "VALUES (?, ?)", (EPOCH, (row[0] or 0) + 1))
+        self._bumped = set()
+
+        self.db.executemany("INSERT INTO pages (name, saved, mtime, acl) " +
+                            "VALUES (?, ?, ?, ?)",
+                            [(_u(pagename),
+                              int(bool(pagedata.get(u'saved', False))),
+                              pagedata.get(u'mtime', None),
+                              pagedata.get(u'acl', None))
+                             for pagename, pagedata in pages.iteritems()])
+        ids = dict(self.db.execute("SELECT name, id FROM pages"))
+
+        def rows(section):
+            for pagename, pagedata in pages.iteritems():
+                pid = ids[_u(pagename)]
+                for key, values in pagedata.get(section, dict()).iteritems():
+                    if not key and section != u'meta':
+                        key = NO_TYPE
+                    for value in values:
+                        yield pid, key, value
+
+        self.db.executemany("INSERT INTO metas " +
+                            "(page, key, value, okey, oextra) " +
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (row + _orderkey(row[2])
+                             for row in rows(u'meta')))
+        self.db.executemany("INSERT INTO outlinks (page, key, dst) " +
+                            "VALUES (?, ?, ?)", rows(u'out'))
+        self.db.executemany("INSERT INTO inlinks (page, key, src) " +
+                            "VALUES (?, ?, ?)",
+                            ((pid, key, _u(src))
+                             for pid, key, src in rows(u'in')))
+
+    def commit(self):
+        if not self._in_transaction:
+            return
+        self._bump([ANY_DEPENDENCY])
+        if self._journaled:
+            self.db.execute("DELETE FROM journal WHERE seq <= " +
+                            "(SELECT MAX(seq) FROM journal) - ?",
+                            (self.journal_size,))
+        self.db.execute("COMMIT")
+        self._in_transaction = False
+        self._bumped = set()
+        self._journaled = False
+
+    def abort(self):
+        if not self._in_transaction:
+            return
+        self.db.execute("ROLLBACK")
+        self._in_transaction = False
+        self._bumped = set()
+        self._journaled = False
+
+    def close(self):
+        if self.db is None:
+            return
+        # Anything not explicitly committed is rolled back
+        self.abort()
+        self.cache.clear()
+        self.db.close()
+        self.db = None
@@ -16,5 +16,8 @@ PROPERTIES = ['constraint', 'description', 'hint', 'hidden', 'default']
 
 NO_TYPE = u'_notype'
 
+# Generation bumped on every change of the graph data, see depcache
+ANY_DEPENDENCY = u'*'
+
 NONEDITABLE_ATTRS = ['gwikiinlinks', '-', 'gwikipagename']
 ATTACHMENT_SCHEMAS = ["attachment", "drawing"]
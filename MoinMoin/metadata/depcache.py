@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-"
+"""
+    Caching of output rendered from graph data
+
+    Cached output records the dependencies it was rendered from, ie.
+    the pages, keys and so on it depends on, along with their
+    generations in the graph data. Saving a page bumps the
+    generations of what the save changed (see changed_dependencies),
+    and cache entries with a changed dependency are rendered again on
+    the next use. Other cache entries stay valid.
+
+    Query results are also kept in memory, for the generation of the
+    whole graph data they were computed at (see cached_result).
+
+    Only MetaTable output is cached this way for now. Included pages
+    also depend on page text and macros outside the graph data, and
+    ShowGraph already keeps its layouts by the content of the graph,
+    so both are left for later.
+"""
+import copy
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+from constants import ANY_DEPENDENCY
+from backend.pagecache import PageCache
+
+# Changed when pages are created or deleted
+PAGES_DEPENDENCY = u'pages'
+# Changed when access rights may have changed
+ACL_DEPENDENCY = u'acl'
+
+def page_dependency(pagename):
+    return u'page:' + pagename
+
+def key_dependency(key):
+    return u'key:' + key
+
+def _links(pagedata):
+    return set((key, dst) for key, values in
+               pagedata.get(u'out', dict()).iteritems()
+               for dst in values)
+
+def changed_dependencies(request, pagename, old, new):
+    r"""
+    Return the dependencies changed when the page data of a page
+    changes from old to new.
+
+    >>> from MoinMoin.metadata.util import doctest_request
+    >>> request = doctest_request()
+    >>> old = {u'saved': True, u'meta': {u'status': [u'open']},
+    ...        u'out': {u'gwikicategory': [u'CategoryBug']}}
+    >>> new = {u'saved': True, u'meta': {u'status': [u'closed']},
+    ...        u'out': {u'gwikicategory': [u'CategoryBug']}}
+    >>> sorted(changed_dependencies(request, u'Bug1', old, new))
+    [u'key:status', u'page:Bug1']
+    >>> sorted(changed_dependencies(request, u'Bug1', old, {}))
+    [u'key:gwikicategory', u'key:status', u'page:Bug1', u'page:CategoryBug', u'pages']
+    """
+    deps = set([page_dependency(pagename)])
+
+    old_meta = old.get(u'meta', dict())
+    new_meta = new.get(u'meta', dict())
+    for key in set(old_meta) | set(new_meta):
+        if old_meta.get(key, list()) != new_meta.get(key, list()):
+            deps.add(key_dependency(key))
+
+    # The in-links of the link targets change, too
+    for key, dst in _links(old) ^ _links(new):
+        deps.add(key_dependency(key))
+        deps.add(page_dependency(dst))
+
+    if bool(old.get(u'saved', False)) != bool(new.get(u'saved', False)):
+        deps.add(PAGES_DEPENDENCY)
+
+    group_re = request.cfg.cache.page_group_regexact
+    if (old.get(u'acl', u'') != new.get(u'acl', u'') or
+        group_re.search(pagename)):
+        deps.add(ACL_DEPENDENCY)
+
+    return deps
+
+def track_changes(request, pagename):
+    """
+    Return a function to be called after the page has been changed
+    in the graph data, which bumps the generations of the changed
+    dependencies.
+    """
+    graphdata = request.graphdata
+    old = copy.deepcopy(graphdata.getpage(pagename))
+
+    def bump():
+        new = graphdata.getpage(pagename)
+        graphdata.bump_generations(changed_dependencies(request, pagename,
+                                                        old, new))
+
+    return bump
+
+def _value_filters(limitregexps, limitops):
+    """
+    Return the keys of the filters that only pass pages with values
+    of the key, see _matching_pages. Any page starting to pass those
+    changes the key.
+
+    >>> _value_filters({}, {u'prio': [(u'', '=='), (u'1', '!=')]})
+    []
+    >>> sorted(_value_filters({u'status': set()}, {u'prio': [(u'1', '>')]}))
+    [u'prio', u'status']
+    """
+    keys = set(limitregexps)
+    for key, comparisons in limitops.iteritems():
+        for comp, op in comparisons:
+            if op != '!=' and not (op == '==' and not comp):
+                keys.add(key)
+
+    # The in-links of a page change with the other pages
+    return [key for key in keys if u'gwikiinlinks' not in key.split('->')]
+
+def metatable_dependencies(request, args, pages=(), metakeys=()):
+    """
+    Return the dependencies of a metatable of the given args, showing
+    the keys metakeys of the given pages (including the pages reached
+    through indirection).
+    """
+    # Imported here as the page saving code imports this module
+    from query import _metatable_parseargs
+    from util import category_regex, template_regex, filter_categories
+
+    if not args:
+        # See metatable_parseargs
+        if request.page is not None and request.page.page_name is not None:
+            args = request.page.page_name
+
+    argset, pageargs, _, _, orderspec, limitregexps, limitops, _, _, \
+        limitvalues, page_regexps = \
+        _metatable_parseargs(request, args, category_regex(request),
+                             template_regex(request))
+
+    deps = set([ACL_DEPENDENCY])
+
+    # Pages created or deleted can start or stop matching a selection
+    # by page name regexps or by category, or a selection of all the
+    # pages unless a filter needs values of some key
+    if page_regexps or filter_categories(request, argset):
+        deps.add(PAGES_DEPENDENCY)
+    elif not pageargs and not argset:
+        if not _value_filters(limitregexps, limitops):
+            deps.add(PAGES_DEPENDENCY)
+
+    # Category pages, whose in-links change with the categories
+    for pagename in argset:
+        deps.add(page_dependency(pagename))
+
+    pages = set(pagename.split('-gwikirevision-')[0] for pagename in pages)
+    for pagename in pages:
+        deps.add(page_dependency(pagename))
+
+    # Links to pages are rendered differently if the target exists
+    linkkeys = set(key.split('->')[-1] for key in metakeys)
+    for pagename in pages:
+        out = request.graphdata.get_out(pagename)
+        for key in linkkeys:
+            for dst in out.get(key, ()):
+                deps.add(page_dependency(dst))
+
+    # Pages can start or stop matching the filters without being on
+    # the table, the keys of the filters catch those
+    keys = set(limitregexps) | set(limitops) | set(limitvalues)
+    keys.update(key for _, key in orderspec)
+    for key in keys:
+        for part in key.split('->'):
+            deps.add(key_dependency(part))
+
+    for key in metakeys:
+        deps.add(page_dependency(u'%sProperty' % (key,)))
+
+    return deps
+
+def _cache_entry(request, arena, name, args):
+    from MoinMoin import caching
+
+    user = request.user
+    key = repr((name, args, user.valid and user.name or u'',
+                request.lang, getattr(request.theme, 'name', ''),
+                request.formatter.__module__))
+    key = sha1(key.encode('utf-8')).hexdigest()
+    return caching.CacheEntry(request, arena, key,
+                              scope='wiki', use_pickle=True)
+
+def get_output(request, arena, name, args):
+    """
+    Return the cached output of name (eg. a macro on a page) with the
+    given args for the current user, or None if there is no output
+    with unchanged dependencies.
+    """
+    cache = _cache_entry(request, arena, name, args)
+    if not cache.exists():
+        return None
+
+    try:
+        data = cache.content()
+    except Exception:
+        # Unreadable entries are rendered again
+        return None
+
+    generations = request.graphdata.get_generations(data['generations'])
+    if generations != data['generations']:
+        return None
+    return data['output']
+
+def start_output(request):
+    """
+    Return a token to be given to set_output, marking the state of
+    the graph data before rendering the output.
+    """
+    generations = request.graphdata.get_generations([ANY_DEPENDENCY])
+    if generations is None:
+        return None
+    return generations[ANY_DEPENDENCY]
+
+def set_output(request, arena, name, args, output, deps, token):
+    """
+    Cache output rendered with the given dependencies since
+    start_output returned token. Nothing is cached if the graph data
+    was changed meanwhile.
+    """
+    if token is None:
+        return
+
+    deps = set(deps)
+    deps.add(ANY_DEPENDENCY)
+    generations = request.graphdata.get_generations(deps)
+    if generations is None or None in generations.values():
+        return
+    if generations.pop(ANY_DEPENDENCY) != token:
+        return
+
+    cache = _cache_entry(request, arena, name, args)
+    cache.update({'generations': generations, 'output': output})
+
+def _result_cache(request):
+    size = getattr(request.cfg, 'gwiki_query_cache_size', 100)
+    if size <= 0:
+        return None
+
+    # The config, and its cache, lives as long as the process
+    cache = getattr(request.cfg.cache, 'gwiki_query_cache', None)
+    if cache is None:
+        cache = request.cfg.cache.gwiki_query_cache = PageCache(size)
+    cache.size = size
+    return cache
+
+def cached_result(request, name, args, compute):
+    """
+    Return the result of compute(), a query named name with the
+    (hashable) args, for the current user. The results are kept in a
+    process-wide LRU of gwiki_query_cache_size entries and reused
+    until the graph data changes. The result is shared and must not
+    be modified.
+
+    >>> from MoinMoin.metadata.util import doctest_request
+    >>> request = doctest_request()
+    >>> cached_result(request, 'test', (1,), lambda: [1, 2])
+    [1, 2]
+    """
+    cache = _result_cache(request)
+    token = start_output(request)
+    if cache is None or token is None:
+        return compute()
+
+    user = request.user
+    key = (name, args, user.valid and user.name or u'')
+    entry = cache.get(key)
+    if entry is not None and entry[1] == token:
+        return entry[0]
+
+    result = compute()
+    cache.set(key, result, token, token)
+    return result
@@ -1,6 +1,12 @@
 import os
 
+from MoinMoin import wikiutil
+from MoinMoin.Page import Page
+from MoinMoin.logfile.editlog import EditLog
+
 from wikitextutil import parse_text
+from depcache import track_changes
+from constants import NO_TYPE
 
 def savegraphdata(pagename, request, text, pagedir, pageitem):
     try:
@@ -15,6 +21,9 @@ def savegraphdata(pagename, request, text, pagedir, pageitem):
         # Get new data from parsing the page
         new_data = parse_text(request, pageitem, text)
 
+        # Invalidates the cached output that depends on the changes
+        changed = track_changes(request, pagename)
+
         request.graphdata.set_page(request, pagename, new_data)
 
         ## Remove deleted pages from the backend
@@ -32,12 +41,154 @@ def savegraphdata(pagename, request, text, pagedir, pageitem):
                 if not exists:
                     request.graphdata.clear_page(request, pagename)
 
+        changed()
+
         pageitem.delete_caches()
         request.graphdata.post_save(pagename)
     except:
         request.graphdata.abort()
         raise
 
+def parse_graphdata(request, pagename, text, pageitem):
+    """
+    Return the graph data savegraphdata would save for the page, ie.
+    its part of the parsed data, or None if the page would have none.
+    """
+    if pagename.endswith('/MoinEditorBackup'):
+        return None
+
+    # See savegraphdata on deleted pages
+    if text == 'deleted\n':
+        return None
+    pf, rev, exists = pageitem.get_rev()
+    if rev != 99999999 and not exists:
+        return None
+
+    return parse_text(request, pageitem, text).get(pagename, dict())
+
+def merge_graphdata(request, parsed, mtime):
+    """
+    Return the page data of the whole graph given the (pagename,
+    data) pairs from parse_graphdata, with the in-links of the pages
+    computed from the out-links. The pairs are merged in order, as
+    if the pages were saved one by one.
+
+    >>> from MoinMoin.metadata.util import doctest_request
+    >>> request = doctest_request()
+    >>> parsed = [(u'A', {u'meta': {u'k': [u'1']},
+    ...                   u'out': {u'': [u'B'], u'friend': [u'B', u'C']}}),
+    ...           (u'B', {u'acl': u'All:read'}),
+    ...           (u'D', None)]
+    >>> pages = merge_graphdata(request, parsed, 1.0)
+    >>> sorted(pages)
+    [u'A', u'B', u'C']
+    >>> pages[u'A'] == {u'meta': {u'k': [u'1']}, u'acl': u'', u'saved': True,
+    ...                 u'mtime': 1.0,
+    ...                 u'out': {NO_TYPE: [u'B'], u'friend': [u'B', u'C']}}
+    True
+    >>> sorted(pages[u'B'][u'in'].items())
+    [(u'_notype', [u'A']), (u'friend', [u'A'])]
+    >>> pages[u'C'] == {u'in': {u'friend': [u'A']}, u'mtime': 1.0}
+    True
+    """
+    # Imported here as the page saving code imports this module
+    from util import node_type
+
+    pages = dict()
+    for pagename, data in parsed:
+        if data is None:
+            continue
+
+        pagedata = pages.setdefault(pagename, dict())
+        pagedata[u'meta'] = data.get(u'meta', dict())
+        pagedata[u'acl'] = data.get(u'acl', u'')
+        pagedata[u'saved'] = True
+        pagedata[u'mtime'] = mtime
+
+        outs = dict()
+        for key, values in data.get(u'out', dict()).iteritems():
+            if not key:
+                key = NO_TYPE
+            outs.setdefault(key, list()).extend(values)
+        if outs:
+            pagedata[u'out'] = outs
+
+        for key, values in outs.iteritems():
+            for dst in values:
+                # Only local pages have in-links
+                if node_type(request, dst) != 'page':
+                    continue
+                target = pages.setdefault(dst, dict())
+                ins = target.setdefault(u'in', dict())
+                ins.setdefault(key, list()).append(pagename)
+                target[u'mtime'] = mtime
+
+    return pages
+
+# Position in the edit log up to which the graph data has been
+# checked, see changed_pages
+REHASH_POSITION = 'rehash-position'
+
+def changed_pages(request):
+    """
+    Return the end position of the edit log and the names of the
+    pages changed since the position last stored in the graph data.
+    """
+    editlog = EditLog(request)
+    position = request.graphdata.get_state(REHASH_POSITION, 0)
+    # Start over if the log has been rotated or replaced
+    if position > editlog.size():
+        position = 0
+
+    position, pagenames = editlog.news(position)
+    return position, sorted(set(pagenames))
+
+def graphdata_stale(request, pageitem):
+    """
+    Return whether the graph data of the page is older than its
+    current revision.
+
+    The graph data is saved after the revision, so it is stale if
+    the page exists but the data has not been saved since the
+    revision, or if it does not exist but the data is still there.
+    Saving links to a page also updates the mtime of its data, so a
+    page linked to after a failed save can still pass for current.
+    """
+    pagedata = request.graphdata.getpage(pageitem.page_name)
+    saved = pagedata.get(u'saved', False)
+
+    pf, rev, exists = pageitem.get_rev()
+    if not exists:
+        # See savegraphdata
+        return saved and rev != 99999999
+
+    if not saved:
+        return True
+    mtime = wikiutil.version2timestamp(pageitem.mtime_usecs())
+    return pagedata.get(u'mtime', 0) < mtime
+
+def rehash_page(request, pagename):
+    """
+    Save the graph data of the page if it is stale. Return whether
+    the page was rehashed.
+    """
+    if pagename.endswith('/MoinEditorBackup'):
+        return False
+
+    # Hold off the editors of the page, whose saves would otherwise
+    # race with ours
+    request.graphdata.writelock()
+
+    pageitem = Page(request, pagename)
+    if not graphdata_stale(request, pageitem):
+        return False
+
+    request.page = pageitem
+    pagedir = underlay_to_pages(request, pageitem)
+    savegraphdata(pagename, request, pageitem.get_raw_body(),
+                  pagedir, pageitem)
+    return True
+
 def underlay_to_pages(req, p):
     underlaydir = req.cfg.data_underlay_dir
 
@@ -52,17 +203,27 @@ def underlay_to_pages(req, p):
 
     return pagepath
 
+# Graph data backends selectable with dbconfig['backend']
+GRAPHDATA_BACKENDS = {
+    'shelve': 'MoinMoin.metadata.backend.shelvedb',
+    'sqlite': 'MoinMoin.metadata.backend.sqlitedb',
+}
+
+def graphdata_backend(name):
+    module = __import__(GRAPHDATA_BACKENDS[name], fromlist=['GraphData'])
+    return module.GraphData
+
 # Functions for properly opening, closing, saving and deleting
 # graphdata.
 def graphdata_getter(self):
 #    from graphingwiki.backend.couchdbclient import GraphData
 #    from graphingwiki.backend.durusclient import GraphData
-    from MoinMoin.metadata.backend.shelvedb import GraphData
     if "_graphdata" not in self.__dict__:
-        dbconfig = getattr(self.cfg, 'dbconfig', {})
+        dbconfig = dict(getattr(self.cfg, 'dbconfig', {}))
         if "dbname" not in dbconfig:
             dbconfig["dbname"] = self.cfg.interwikiname
 
+        GraphData = graphdata_backend(dbconfig.pop("backend", "shelve"))
         self.__dict__["_graphdata"] = GraphData(self, **dbconfig)
     return self.__dict__["_graphdata"]
 
@@ -5,38 +5,41 @@
     @copyright: 2006-2016 by Jussi Eronen <exec@iki.fi>
 """
 import re
-import operator
-import socket
+import copy
+import heapq
+import base64
 import string
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from itertools import islice
+
 from MoinMoin.wikiutil import parseAttributes, AbsPageName
 
 from constants import (CATEGORY_KEY, SPECIAL_ATTRS, 
                        PROPERTIES)
 from util import (filter_categories, category_regex, 
-                  template_regex)
+                  template_regex, node_type, ordervalue, OPERATORS,
+                  may_read_many)
 from wikitextutil import is_meta_link
+from depcache import cached_result
 
 REGEX_RE = re.compile('^/.+/$')
 
-# Standard Python operators
-OPERATORS = {'<': operator.lt,
-             '<=': operator.le,
-             '==': operator.eq,
-             '!=': operator.ne,
-             '>=': operator.ge,
-             '>': operator.gt}
-
 def inlinks_key(request, loadedPage, checkAccess=True):
     inLinks = set()
     # Gather in-links regardless of type
     for linktype in loadedPage.get("in", dict()):
         for page in loadedPage['in'][linktype]:
-            if checkAccess:
-                if not request.user.may.read(page):
-                    continue
             inLinks.add((linktype, page))
 
+    if checkAccess:
+        readable = may_read_many(request, [y for x, y in inLinks])
+        inLinks = set((x, y) for x, y in inLinks if y in readable)
+
     inLinks = ['[[%s]]' % (y) for x, y in inLinks]
 
     return inLinks
@@ -87,9 +90,163 @@ def metas_to_abs_links(request, page, values):
 
     return new_values
 
+# Number of pages fetched from the graph data at a time
+PAGE_BATCH = 500
+
+class PageBatch(object):
+    """
+    Page data fetched from the graph data with getpages, a batch of
+    pages at a time, and kept for the lifetime of the object. The
+    read rights of the pages and the pages and values reached through
+    indirection keys are remembered as well.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.graphdata = request.graphdata
+        self.pages = dict()
+        self.readable = dict()
+        self._redirs = dict()
+
+    def fetch(self, pagenames):
+        missing = set(x for x in pagenames if x not in self.pages)
+        if missing:
+            self.pages.update(self.graphdata.getpages(missing))
+
+    def get(self, pagename):
+        if pagename not in self.pages:
+            self.fetch([pagename])
+        return self.pages[pagename]
+
+    def filter_readable(self, pagenames):
+        """
+        Return the given pages the user may read, in order.
+        """
+        unknown = set(x for x in pagenames if x not in self.readable)
+        if unknown:
+            readable = may_read_many(self.request, unknown)
+            for pagename in unknown:
+                self.readable[pagename] = pagename in readable
+        return [x for x in pagenames if self.readable[x]]
+
+    def redirs(self, pagename, key, prev, formatLinks, inlinks):
+        """
+        Return the (page, values) reached from the page through the
+        indirection key, see add_matching_redirs.
+        """
+        # Relative page names depend on the current page
+        memo = (self.request.page.page_name, pagename, key, prev,
+                formatLinks, inlinks)
+        hits = self._redirs.get(memo, None)
+        if hits is None:
+            hits = _resolve_redirs(self.request, self, pagename, key, prev,
+                                   formatLinks, inlinks)
+            self._redirs[memo] = hits
+        return hits
+
+def fetch_pages(request, names, metakeys=(), pages=None):
+    """
+    Return a PageBatch with the given pages, and the pages reached
+    from them through the indirection keys of metakeys, fetched one
+    level of indirection at a time. Pass it to get_metas as pages.
+    """
+    if pages is None:
+        pages = PageBatch(request)
+
+    names = set(names)
+    pages.fetch(names)
+
+    for key in metakeys:
+        args = key.split('->')
+        section = u'out'
+        if args[0] == 'gwikiinlinks':
+            section = u'in'
+            args = args[1:]
+
+        if len(args) < 2:
+            continue
+
+        # The link keys followed by add_matching_redirs
+        links = list()
+        while args:
+            if len(args) == 1:
+                links.append(prev)
+                break
+            links.append(args[0])
+            if len(args) == 2:
+                break
+            prev, args = args[1], args[2:]
+
+        current = set(names)
+        for linked in links:
+            if not current:
+                break
+
+            targets = set()
+            for name in current:
+                links = pages.get(name).get(section, dict())
+                for page in links.get(linked, list()):
+                    targets.add(AbsPageName(request.page.page_name, page))
+
+            pages.fetch(targets)
+            current = targets
+            section = u'out'
+
+    return pages
+
+def get_metas_many(request, names, metakeys, checkAccess=True,
+                   includeGenerated=True, **kw):
+    """
+    Return a dict of the get_metas results of the given pages. The
+    pages, and the pages reached through indirection keys, are
+    fetched from the graph data in batches instead of one by one.
+    """
+    names = list(names)
+    if not includeGenerated:
+        metakeys = [x for x in metakeys if not '->' in x]
+    metakeys = set(metakeys)
+
+    result = dict()
+    if checkAccess:
+        readable = may_read_many(request, names)
+        for name in names:
+            if name not in readable:
+                result[name] = dict((key, list()) for key in metakeys)
+        names = [x for x in names if x not in result]
+
+    pages = fetch_pages(request, names, metakeys)
+
+    for name in names:
+        result[name] = get_metas(request, name, metakeys,
+                                 checkAccess=False,
+                                 includeGenerated=includeGenerated,
+                                 pages=pages, **kw)
+    return result
+
+def iter_metas_many(request, names, metakeys, **kw):
+    """
+    Yield (page, metas) of the given pages in order, as returned by
+    get_metas_many for PAGE_BATCH pages at a time.
+    """
+    batch = list()
+    for name in names:
+        batch.append(name)
+        if len(batch) < PAGE_BATCH:
+            continue
+
+        metas = get_metas_many(request, batch, metakeys, **kw)
+        for name in batch:
+            yield name, metas[name]
+        batch = list()
+
+    if batch:
+        metas = get_metas_many(request, batch, metakeys, **kw)
+        for name in batch:
+            yield name, metas[name]
+
 # Fetch requested metakey value for the given page.
 def get_metas(request, name, metakeys, checkAccess=True, 
-              includeGenerated=True, formatLinks=False, **kw):
+              includeGenerated=True, formatLinks=False, pages=None, **kw):
     if not includeGenerated:
         metakeys = [x for x in metakeys if not '->' in x]
 
@@ -100,16 +257,18 @@ def get_metas(request, name, metakeys, checkAccess=True,
         if not request.user.may.read(name):
             return pageMeta
 
-    loadedPage = request.graphdata.getpage(name)
+    if pages is None:
+        pages = PageBatch(request)
+    loadedPage = pages.get(name)
 
     # Make a real copy of loadedOuts and loadedMeta for tracking indirection
     loadedOuts = dict()
-    outs = request.graphdata.get_out(name)
+    outs = loadedPage.get(u'out', dict())
     for key in outs:
         loadedOuts[key] = list(outs[key])
 
     loadedMeta = dict()
-    metas = request.graphdata.get_meta(name)
+    metas = loadedPage.get(u'meta', dict())
     for key in metas:
         loadedMeta.setdefault(key, list())
         if formatLinks:
@@ -133,7 +292,8 @@ def get_metas(request, name, metakeys, checkAccess=True,
         for key in metakeys:
             add_matching_redirs(request, loadedPage, loadedOuts, 
                                 loadedMeta, metakeys,
-                                key, name, key, formatLinks)
+                                key, name, key, formatLinks,
+                                pages=pages)
 
     # Add values
     for key in metakeys & set(loadedMeta):
@@ -147,11 +307,61 @@ def get_metas(request, name, metakeys, checkAccess=True,
             
     return pageMeta
 
+def get_ordervalues(request, name, metakeys):
+    """
+    Return the order keys (see ordervalue) of the values of the given
+    meta keys of a page. Plain keys use the order keys stored in the
+    graph data when the page was saved.
+    """
+    plain = [key for key in metakeys if _plain_key(key)]
+    other = [key for key in metakeys if not _plain_key(key)]
+
+    pageOrder = dict()
+    if plain:
+        order = request.graphdata.get_order(name)
+        for key in plain:
+            pageOrder[key] = list(order.get(key, list()))
+    if other:
+        metas = get_metas(request, name, other, checkAccess=False)
+        for key in other:
+            pageOrder[key] = map(ordervalue, metas[key])
+
+    return pageOrder
+
 def add_matching_redirs(request, loadedPage, loadedOuts, loadedMeta,
                         metakeys, key, curpage, curkey,
-                        prev='', formatLinks=False, linkdata=None):
+                        prev='', formatLinks=False, linkdata=None,
+                        pages=None):
     if not linkdata:
         linkdata = dict()
+    if pages is None:
+        pages = PageBatch(request)
+
+    for indir_page, values in pages.redirs(curpage, curkey, prev,
+                                           formatLinks,
+                                           'gwikiinlinks' in metakeys):
+        # Handle inlinks separately
+        if indir_page is None:
+            loadedOuts[key] = inlinks_key(request, loadedPage)
+            continue
+
+        linkdata.setdefault(key, dict())
+        if values is None:
+            linkdata[key].setdefault(indir_page, list())
+            continue
+
+        loadedMeta.setdefault(key, list())
+        loadedMeta[key].extend(values)
+        linkdata[key].setdefault(indir_page, list()).extend(values)
+
+    return linkdata
+
+def _resolve_redirs(request, pages, curpage, curkey, prev,
+                    formatLinks, inlinks):
+    # The (page, values) reached from curpage through the key path
+    # curkey, in the order add_matching_redirs adds them. Values are
+    # None for pages without the key, and (None, None) stands for the
+    # in-links of the table page when inlinks is set.
     args = curkey.split('->')
 
     inlink = False
@@ -164,7 +374,7 @@ def add_matching_redirs(request, loadedPage, loadedOuts, loadedMeta,
     last = False
 
     if not args:
-        return
+        return list()
     if len(args) in [1, 2]:
         last = True
 
@@ -174,133 +384,122 @@ def add_matching_redirs(request, loadedPage, loadedOuts, loadedMeta,
         linked, target_key = args[:2]
 
     if inlink:
-        pages = request.graphdata.get_in(curpage).get(linked, set())
+        links = pages.get(curpage).get(u'in', dict())
     else:
-        pages = request.graphdata.get_out(curpage).get(linked, set())
-
-    for indir_page in set(pages):
-        # Relative pages etc
-        indir_page = AbsPageName(request.page.page_name,
-                                 indir_page)
-
-        if request.user.may.read(indir_page):
-            pagedata = request.graphdata.getpage(indir_page)
-
-            outs = pagedata.get('out', dict())
-            metas = pagedata.get('meta', dict())
-
-            # Add matches at first round
-            if last:
-                if target_key in metas:
-                    loadedMeta.setdefault(key, list())
-                    linkdata.setdefault(key, dict())
-                    if formatLinks:
-                        values = metas_to_abs_links(
-                            request, indir_page, metas[target_key])
-                    else:
-                        values = metas[target_key]
-                    loadedMeta[key].extend(values)
-                    linkdata[key].setdefault(indir_page, list()).extend(values)
+        links = pages.get(curpage).get(u'out', dict())
+
+    # Relative pages etc
+    indir_pages = [AbsPageName(request.page.page_name, indir_page)
+                   for indir_page in set(links.get(linked, set()))]
+    indir_pages = pages.filter_readable(indir_pages)
+    pages.fetch(indir_pages)
+
+    hits = list()
+    for indir_page in indir_pages:
+        pagedata = pages.get(indir_page)
+
+        outs = pagedata.get('out', dict())
+        metas = pagedata.get('meta', dict())
+
+        # Add matches at first round
+        if last:
+            if target_key in metas:
+                if formatLinks:
+                    values = metas_to_abs_links(
+                        request, indir_page, metas[target_key])
                 else:
-                    linkdata.setdefault(key, dict())
-                    linkdata[key].setdefault(indir_page, list())
-                continue
-
-            elif not target_key in outs:
-                continue
-
-            # Handle inlinks separately
-            if 'gwikiinlinks' in metakeys:
-                inLinks = inlinks_key(request, loadedPage)
-
-                loadedOuts[key] = inLinks
-                continue
+                    values = metas[target_key]
+                hits.append((indir_page, values))
+            else:
+                hits.append((indir_page, None))
+            continue
 
-            linkdata = add_matching_redirs(request, loadedPage, loadedOuts,
-                                           loadedMeta, metakeys, key,
-                                           indir_page, newkey, target_key,
-                                           formatLinks, linkdata)
+        elif not target_key in outs:
+            continue
 
-    return linkdata
+        if inlinks:
+            hits.append((None, None))
+            continue
 
-def string_aton(value):
-    # Regression: without this, '\d+ ' is an IP according to this func
-    if not '.' in value and not ':' in value:
-        raise TypeError
-
-    # Support for CIDR notation, eg. 10.10.1.0/24
-    end = ''
-    if '/' in value:
-        value, end = value.split('/', 1)
-        end = '/' + end
- 
-    # 00 is stylistic to avoid this: 
-    # >>> sorted(['a', socket.inet_aton('100.2.3.4'), 
-    #             socket.inet_aton('1.2.3.4')]) 
-    # ['\x01\x02\x03\x04', 'a', 'd\x02\x03\x04'] 
-    if '.' in value:
-        return u'00' + unicode(socket.inet_pton(socket.AF_INET, 
-                                                value).replace('\\', '\\\\'), 
-                               "unicode_escape") + end
+        hits.extend(pages.redirs(indir_page, newkey, target_key,
+                                 formatLinks, inlinks))
+
+    return hits
+
+def _is_wikiword(val):
+    from MoinMoin.parser.text_moin_wiki import Parser
+    return re.match(Parser.word_rule_js, val) is not None
+
+def value_regex(val):
+    r"""
+    Return the regexp used for matching the exact value filter
+    key=val against meta values.
+
+    >>> bool(value_regex(u'open').search(u'open'))
+    True
+    >>> bool(value_regex(u'open').search(u'[[open|Open issue]]'))
+    True
+    >>> bool(value_regex(u'open').search(u'reopened'))
+    False
+    >>> bool(value_regex(u'JohnDoe').search(u'JohnDoe is cool'))
+    True
+    """
+    # If the value is a page, make it a non-matching
+    # regexp so that all link variations will generate a
+    # match. An alternative would be to match from links
+    # also, but in this case old-style metalinks, which
+    # cannot be edited, would appear in metatables, which
+    # is not wanted (old-style eg. [[Page| key: Page]])
+
+    # Only allow non-matching regexp for values if they
+    # are WikiWords. Eg. 'WikiWord some text' would match
+    # 'WikiWord', emulating ye olde matching behaviour,
+    # but 'nonwikiword some text' would not match
+    # 'nonwikiword'
+    if _is_wikiword(val):
+        re_val = "(%s|" % (re.escape(val)) 
     else:
-        return u'00' + unicode(socket.inet_pton(socket.AF_INET6, 
-                                                 value).replace('\\', '\\\\'), 
-                               "unicode_escape") + end
-
-def float_parts(part):
-    # 2.1.5 should be treated as a float as people seem to expect
-    # this.
-    part = part.split('.')
-    fp = '.'.join(part[:2])
-    addon = '.'.join(part[2:])
-    if addon:
-        addon = '.%s' % (addon)
-
-    fp = float(fp)
-    return fp, addon
-    
-ORDER_FUNCS = [
-    # (conversion function, ignored exception type(s)) ipv4
-    # addresses. Return values should be unicode strings. The sorting
-    # of numbers is currently a bit hacky.
-    (lambda x: (string_aton(x), ''), 
-     (socket.error, UnicodeEncodeError, TypeError)),
-    # integers
-    (lambda x: (int(x), ''), ValueError),
-    # floats
-    (lambda x: float_parts(x), ValueError),
-    # strings (unicode or otherwise)
-    (lambda x: (x.lower(), ''), AttributeError)
-    ]
-
-def ordervalue(value):
-    extras = ''
-    # treat values prepended with anything accepted by order_funcs:
-    # 2.1 blaa => 2.1, [[2.1 blaa]] => 2.1
-    if value:
-        # Value has already been processed by ordervalue (or faulty
-        # data)
-        if type(value) not in [str, unicode]:
-            return value
-
-        # Strips links syntax and stuff (FIXME does this cover all the
-        # relevant cases?)
-        value = value.lstrip('[').strip(']')
-        value = value.split()
-
-        # Corner case, empty links eg. [[]]
-        if not value:
-            return ('', '')
-
-        extras = ' '.join(value[1:])
-        value = value[0]
-    for func, ignoredExceptionTypes in ORDER_FUNCS:
-        try:
-            out, addon = func(value)
-            return (out, addon + extras)
-        except ignoredExceptionTypes:
-            pass
-    return value
+        re_val = "(^%s$|" % (re.escape(val)) 
+    # or as bracketed link
+    re_val += "(?P<sta>\[\[)%s(?(sta)\]\])|" % (re.escape(val)) 
+
+    # or as commented bracketed link
+    re_val += "(?P<stb>\[\[)%s(?(stb)\|[^\]]*\]\]))" % \
+        (re.escape(val)) 
+
+    return re.compile(re_val, re.UNICODE)
+
+class MatchSet(object):
+    r"""
+    Value filter regexp of a query, which remembers the values it has
+    been searched in. Each distinct value is searched once per query,
+    eg. when both the candidate pages and the pages themselves are
+    checked, and the values seen again are set lookups.
+
+    >>> match = MatchSet(value_regex(u'open'))
+    >>> match.search(u'[[open]]'), match.search(u'reopened')
+    (True, False)
+    >>> sorted(match.matched), sorted(match.unmatched)
+    ([u'[[open]]'], [u'reopened'])
+    """
+    __slots__ = ['regex', 'matched', 'unmatched']
+
+    def __init__(self, regex):
+        self.regex = regex
+        self.matched = set()
+        self.unmatched = set()
+
+    def search(self, value):
+        if value in self.matched:
+            return True
+        if value in self.unmatched:
+            return False
+
+        if self.regex.search(value):
+            self.matched.add(value)
+            return True
+        self.unmatched.add(value)
+        return False
 
 def _metatable_parseargs(request, args, cat_re, temp_re):
     # Arg placeholders
@@ -309,6 +508,7 @@ def _metatable_parseargs(request, args, cat_re, temp_re):
     excluded_keys = list()
     orderspec = list()
     limitregexps = dict()
+    limitvalues = dict()
     limitops = dict()
 
     # Capacity for storing indirection keys in metadata comparisons
@@ -320,6 +520,8 @@ def _metatable_parseargs(request, args, cat_re, temp_re):
 
     # Flag: were there page arguments?
     pageargs = False
+    # Regexps selecting pages by their names
+    page_regexps = list()
 
     # Regex preprocessing
     for arg in (x.strip() for x in args.split(',') if x.strip()):
@@ -396,33 +598,9 @@ def _metatable_parseargs(request, args, cat_re, temp_re):
             # Assume that value limits are regexps, if
             # not, escape them into exact regexp matches
             if not REGEX_RE.match(val):
-                from MoinMoin.parser.text_moin_wiki import Parser
-
-                # If the value is a page, make it a non-matching
-                # regexp so that all link variations will generate a
-                # match. An alternative would be to match from links
-                # also, but in this case old-style metalinks, which
-                # cannot be edited, would appear in metatables, which
-                # is not wanted (old-style eg. [[Page| key: Page]])
-
-                # Only allow non-matching regexp for values if they
-                # are WikiWords. Eg. 'WikiWord some text' would match
-                # 'WikiWord', emulating ye olde matching behaviour,
-                # but 'nonwikiword some text' would not match
-                # 'nonwikiword'
-                if re.match(Parser.word_rule_js, val):
-                    re_val = "(%s|" % (re.escape(val)) 
-                else:
-                    re_val = "(^%s$|" % (re.escape(val)) 
-                # or as bracketed link
-                re_val += "(?P<sta>\[\[)%s(?(sta)\]\])|" % (re.escape(val)) 
-
-                # or as commented bracketed link
-                re_val += "(?P<stb>\[\[)%s(?(stb)\|[^\]]*\]\]))" % \
-                    (re.escape(val)) 
-                
-                limitregexps.setdefault(
-                    key, set()).add(re.compile(re_val, re.UNICODE))
+                re_val = MatchSet(value_regex(val))
+                limitregexps.setdefault(key, set()).add(re_val)
+                limitvalues.setdefault(key, dict())[val] = re_val
 
             # else strip the //:s
             else:
@@ -430,8 +608,8 @@ def _metatable_parseargs(request, args, cat_re, temp_re):
                     val = val[1:-1]
 
                 limitregexps.setdefault(
-                    key, set()).add(re.compile(val, 
-                                               re.IGNORECASE | re.UNICODE))
+                    key, set()).add(MatchSet(re.compile(val, 
+                                               re.IGNORECASE | re.UNICODE)))
             continue
 
         # order spec
@@ -466,6 +644,7 @@ def _metatable_parseargs(request, args, cat_re, temp_re):
             page_re = re.compile("%s" % arg)
         except:
             continue
+        page_regexps.append(page_re)
 
         # Get all pages, check which of them match to the supplied regexp
         for page in request.graphdata:
@@ -473,58 +652,136 @@ def _metatable_parseargs(request, args, cat_re, temp_re):
                 argset.add(page)
 
     return (argset, pageargs, keyspec, excluded_keys, orderspec, 
-            limitregexps, limitops, indirection_keys, styles)
+            limitregexps, limitops, indirection_keys, styles, limitvalues,
+            page_regexps)
+
+def _plain_key(key):
+    # Keys whose values come from the page's own metas only, see
+    # get_metas
+    return not '->' in key and key not in ['gwikiinlinks', CATEGORY_KEY]
+
+def _lookup_value(request, key, val):
+    # Exact values that are plain local page names can be found with
+    # index lookups: either as such or as link values, which are
+    # also saved as links to the page. Other values may match in
+    # ways that need the value regexp.
+    if _is_wikiword(val) or '#' in val:
+        return False
+    if not _plain_key(key) and key != CATEGORY_KEY:
+        return False
+    if val.startswith('/') or val.startswith('./') or val.startswith('../'):
+        return False
+    return node_type(request, val) == 'page'
+
+def _scan_values(request, key, match):
+    # Go through the distinct values of the key instead of the pages
+    graphdata = request.graphdata
+    pages = set()
+    for value in graphdata.values_of_key(key):
+        if match(value):
+            pages.update(graphdata.pages_with_value(key, value))
+    return pages
+
+def plan_candidates(request, limitvalues, limitregexps, limitops,
+                    scan=True):
+    r"""
+    Narrow down the pages that can match the value filters of a
+    query with the meta indexes of the graph data. Returns a
+    superset of the matching pages, or None when all pages need to be
+    evaluated.
+
+    Index lookups are done first, the most selective one first.
+    Scanning the distinct values of a key to evaluate regexps and
+    comparisons is only done if there are no lookups and scan is
+    True, ie. the alternative is to evaluate every page.
+
+    >>> from MoinMoin.metadata.util import doctest_request
+    >>> request = doctest_request({
+    ...     u'A': {u'meta': {u'status': [u'open'], u'prio': [u'1']}},
+    ...     u'B': {u'meta': {u'status': [u'[[open]]'], u'prio': [u'3']}},
+    ...     u'C': {u'meta': {u'status': [u'closed']}}})
+    >>> status = {u'status': {u'open': value_regex(u'open')}}
+    >>> sorted(plan_candidates(request, status, {}, {}))
+    [u'A']
+    >>> request.graphdata[u'open'] = {u'in': {u'status': [u'B']}}
+    >>> sorted(plan_candidates(request, status, {}, {}))
+    [u'A', u'B']
+    >>> sorted(plan_candidates(request, {}, {}, {u'prio': [(u'2', '>')]}))
+    [u'B']
+    >>> plan_candidates(request, {}, {}, {u'prio': [(u'2', '>')]}, False)
+    >>> plan_candidates(request, {}, {}, {u'prio': [(u'2', '!=')]})
+    """
+    graphdata = request.graphdata
+
+    lookups = list()
+    scans = list()
+
+    for key, values in limitvalues.iteritems():
+        for val, re_val in values.iteritems():
+            if not _lookup_value(request, key, val):
+                continue
 
-def metatable_parseargs(request, args,
-                        get_all_keys=False,
-                        get_all_pages=False,
-                        checkAccess=True,
-                        include_unsaved=False,
-                        parsefunc=_metatable_parseargs):
-    if not args:
-        # If called from a macro such as MetaTable,
-        # default to getting the current page
-        req_page = request.page
-        if get_all_pages or req_page is None or req_page.page_name is None:
-            args = ""
-        else:
-            args = req_page.page_name
+            def lookup(key=key, val=val):
+                pages = set(graphdata.get_in(val).get(key, list()))
+                pages.update(graphdata.pages_with_value(key, val))
+                return pages
+            lookups.append(lookup)
 
-    # Category, Template matching regexps
-    cat_re = category_regex(request)
-    temp_re = template_regex(request)
+    for key, re_limits in limitregexps.iteritems():
+        if not _plain_key(key):
+            continue
 
-    argset, pageargs, keyspec, excluded_keys, orderspec, \
-        limitregexps, limitops, indirection_keys, styles = \
-        parsefunc(request, args, cat_re, temp_re)
+        looked_up = set()
+        for val, re_val in limitvalues.get(key, dict()).iteritems():
+            if _lookup_value(request, key, val):
+                looked_up.add(re_val)
 
-    # If there were no page args, default to all pages
-    if not pageargs and not argset:
-        pages = request.graphdata.pagenames()
-    else:
-        pages = set()
-        categories = set(filter_categories(request, argset))
-        other = argset - categories
+        for re_limit in re_limits:
+            if re_limit in looked_up:
+                continue
+            def search(key=key, match=re_limit.search):
+                return _scan_values(request, key, match)
+            scans.append(search)
 
-        for arg in categories:
-            newpages = request.graphdata.get_in(arg).get(CATEGORY_KEY, list())
+    for key, complist in limitops.iteritems():
+        if not _plain_key(key):
+            continue
 
-            for newpage in newpages:
-                # Check that the page is not a category or template page
-                if cat_re.search(newpage) or temp_re.search(newpage):
-                    continue
-                pages.add(newpage)
+        for (comp, op) in complist:
+            # Pages without the key can match these
+            if op == '!=' or (op == '==' and not comp):
+                continue
 
-        pages.update(other)
+            def compare(key=key, op=op, orderkey=ordervalue(comp)):
+                return graphdata.pages_with_order(key, op, orderkey)
+            scans.append(compare)
 
-    pagelist = set()
-    for page in pages:
+    candidates = None
+    if lookups:
+        for pages in sorted((lookup() for lookup in lookups), key=len):
+            if candidates is None:
+                candidates = pages
+            else:
+                candidates.intersection_update(pages)
+            if not candidates:
+                break
+    elif scan:
+        for search in scans:
+            pages = search()
+            if candidates is None:
+                candidates = pages
+            else:
+                candidates.intersection_update(pages)
+            if not candidates:
+                break
+
+    return candidates
+
+def _matching_pages(request, pages, limitregexps, limitops, limitorders):
+    for page, metas in pages:
         clear = True
         # Filter by regexps (if any)
         if limitregexps:
-            # We're sure we have access to read the page, don't check again
-            metas = get_metas(request, page, limitregexps, checkAccess=False)
-
             for key, re_limits in limitregexps.iteritems():
 
                 values = metas[key]
@@ -556,12 +813,12 @@ def metatable_parseargs(request, args,
 
         if limitops:
             # We're sure we have access to read the page, don't check again
-            metas = get_metas(request, page, limitops, checkAccess=False)
+            metas = get_ordervalues(request, page, limitops)
 
-            for key, complist in limitops.iteritems():
+            for key, complist in limitorders.iteritems():
                 values = metas[key]
 
-                for (comp, op) in complist:
+                for (comp, ordercomp, op) in complist:
                     clear = False
 
                     # The non-existance of values is good for not
@@ -576,9 +833,7 @@ def metatable_parseargs(request, args,
 
                     # Must match any
                     for value in values:
-                        value, comp = ordervalue(value), ordervalue(comp)
-
-                        if OPERATORS[op](value, comp):
+                        if OPERATORS[op](value, ordercomp):
                             clear = True
                             break
 
@@ -592,91 +847,523 @@ def metatable_parseargs(request, args,
                             
         # Add page if all the regexps and operators have matched
         if clear:
-            pagelist.add(page)
+            yield page
+
+def iter_metatable_pages(request, args,
+                         get_all_pages=False,
+                         checkAccess=True,
+                         include_unsaved=False,
+                         parsefunc=_metatable_parseargs):
+    """
+    Return an iterator of the pages matching the MetaTable args, in
+    no particular order, and the parsed args. The pages are filtered
+    lazily as the iterator is consumed.
+    """
+    candidates, select, parsed = \
+        _metatable_selection(request, args, get_all_pages, checkAccess,
+                             include_unsaved, parsefunc)
+    if candidates is None:
+        candidates = request.graphdata.pagenames()
+    return select(candidates), parsed
+
+def _metatable_selection(request, args, get_all_pages, checkAccess,
+                         include_unsaved, parsefunc):
+    # Return the candidate pages of the args (None for all the
+    # pages), a function filtering an iterable of pages lazily to the
+    # matching ones in the same order, and the parsed args
+    if not args:
+        # If called from a macro such as MetaTable,
+        # default to getting the current page
+        req_page = request.page
+        if get_all_pages or req_page is None or req_page.page_name is None:
+            args = ""
+        else:
+            args = req_page.page_name
 
-    # Filter to saved pages that can be read by the current user
-    def is_saved(name):
-        if include_unsaved:
-            return True
-        return request.graphdata.is_saved(name)
+    # Category, Template matching regexps
+    cat_re = category_regex(request)
+    temp_re = template_regex(request)
 
-    def can_be_read(name):
-        return request.user.may.read(name)
+    argset, pageargs, keyspec, excluded_keys, orderspec, \
+        limitregexps, limitops, indirection_keys, styles, limitvalues, \
+        _ = parsefunc(request, args, cat_re, temp_re)
 
-    # Only give saved pages
-    pagelist = filter(is_saved, pagelist)
-    # Only give pages that can be read by the current user
-    if checkAccess:
-        pagelist = filter(can_be_read, pagelist)
+    # If there were no page args, default to all pages
+    if not pageargs and not argset:
+        pages = None
+    else:
+        pages = set()
+        categories = set(filter_categories(request, argset))
+        other = argset - categories
 
-    metakeys = set([])
-    if not keyspec:
-        for name in pagelist:
-            # MetaEdit wants all keys by default
-            if get_all_keys:
-                for key in request.graphdata.get_metakeys(name):
-                    metakeys.add(key)
-            else:
-                # For MetaTable etc
-                for key in (x for x in request.graphdata.get_metakeys(name)
-                            if not x in SPECIAL_ATTRS):
-                    metakeys.add(key)
+        for arg in categories:
+            newpages = request.graphdata.get_in(arg).get(CATEGORY_KEY, list())
+
+            for newpage in newpages:
+                # Check that the page is not a category or template page
+                if cat_re.search(newpage) or temp_re.search(newpage):
+                    continue
+                pages.add(newpage)
+
+        pages.update(other)
 
-        # Add gathered indirection metakeys
-        metakeys.update(indirection_keys)
+    # Use the meta indexes to avoid evaluating the filters on pages
+    # that cannot match
+    candidates = plan_candidates(request, limitvalues, limitregexps,
+                                 limitops, scan=pages is None)
+    if candidates is not None:
+        if pages is None:
+            pages = candidates
+        else:
+            pages.intersection_update(candidates)
 
-        # Exclude keys
-        for key in excluded_keys:
-            metakeys.discard(key)
+    # Compare against order keys, see get_ordervalues
+    limitorders = dict()
+    for key, complist in limitops.iteritems():
+        limitorders[key] = [(comp, ordervalue(comp), op)
+                            for (comp, op) in complist]
 
-        metakeys = sorted(metakeys, key=ordervalue)
+    def select(pages):
+        if limitregexps:
+            # We're sure we have access to read the pages, don't
+            # check again
+            pages = iter_metas_many(request, pages, limitregexps,
+                                    checkAccess=False)
+        else:
+            pages = ((page, None) for page in pages)
+
+        pages = _matching_pages(request, pages, limitregexps, limitops,
+                                limitorders)
+
+        # Filter to saved pages that can be read by the current user
+        def is_saved(name):
+            if include_unsaved:
+                return True
+            return request.graphdata.is_saved(name)
+
+        # Only give saved pages
+        pagelist = (page for page in pages if is_saved(page))
+        # Only give pages that can be read by the current user
+        if checkAccess:
+            pagelist = iter_readable(request, pagelist)
+        return pagelist
+
+    parsed = (keyspec, excluded_keys, orderspec, indirection_keys, styles)
+    return pages, select, parsed
+
+def iter_readable(request, pages):
+    """
+    Yield the given pages the user may read, checking the read
+    rights PAGE_BATCH pages at a time.
+    """
+    pages = iter(pages)
+    while True:
+        batch = list(islice(pages, PAGE_BATCH))
+        if not batch:
+            break
+
+        readable = may_read_many(request, batch)
+        for page in batch:
+            if page in readable:
+                yield page
+
+class _Descending(object):
+    """
+    Sort key wrapper reversing the order of the wrapped key. All the
+    comparisons are defined, as the sort keys holding these are also
+    compared with <= and >= (eg. by heapq on Python 2.6).
+
+    >>> _Descending(1) < _Descending(2), _Descending(1) > _Descending(2)
+    (False, True)
+    >>> _Descending(1) <= _Descending(2), _Descending(1) >= _Descending(2)
+    (False, True)
+    >>> (_Descending(1),) <= (_Descending(2),)
+    False
+    >>> _Descending(1) <= _Descending(1), _Descending(1) >= _Descending(1)
+    (True, True)
+    """
+    __slots__ = ['key']
+
+    def __init__(self, key):
+        self.key = key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+    def __ne__(self, other):
+        return self.key != other.key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __gt__(self, other):
+        return other.key > self.key
+
+    def __le__(self, other):
+        return other.key <= self.key
+
+    def __ge__(self, other):
+        return other.key >= self.key
+
+def _index_ordered(request, candidates, direction, key, firstkeys):
+    # Yield the candidate pages (all the pages if candidates is None)
+    # in the order of the index of key, the pages without values of
+    # key last. The first page values seen are the smallest (or
+    # largest) ones of the pages. The order key each page was first
+    # seen with is kept in firstkeys, None for the pages without
+    # values.
+    for orderkey, page in request.graphdata.pages_by_order(key,
+                                                           direction == ">>"):
+        if page in firstkeys:
+            continue
+        if candidates is not None and page not in candidates:
+            continue
+        firstkeys[page] = orderkey
+        yield page
+
+    if candidates is None:
+        candidates = request.graphdata.pagenames()
+    for page in candidates:
+        if page not in firstkeys:
+            firstkeys[page] = None
+            yield page
+
+def _take_top(pages, firstkeys, limit):
+    # Take pages in index order until there are limit of them and the
+    # order key changes, the pages not taken can not sort before them
+    top = list()
+    last = None
+    for page in pages:
+        orderkey = firstkeys[page]
+        if len(top) >= limit and orderkey != last:
+            break
+        top.append(page)
+        last = orderkey
+    return top
+
+def _orderkeys(orderspec):
+    return [key for (direction, key) in orderspec
+            if key != "gwikipagename"]
+
+def _sortkey(orderspec, page, values):
+    # Pages without values for a key go last in both directions, the
+    # ties are sorted by name
+    result = list()
+    for direction, key in orderspec:
+        reverse = direction == ">>"
+        if key == "gwikipagename":
+            value = (not reverse, [page])
+        else:
+            value = sorted(values[key], reverse=reverse)
+            value = (bool(value) == reverse, value)
+
+        if reverse:
+            value = _Descending(value)
+        result.append(value)
+
+    result.append(ordervalue(page))
+    # Names with the same order value, eg. 1 and 01
+    result.append(page)
+    return result
+
+def _page_sortkey(request, page, orderspec):
+    orderkeys = _orderkeys(orderspec)
+    values = dict()
+    if orderkeys:
+        values = get_ordervalues(request, page, orderkeys)
+    return _sortkey(orderspec, page, values)
+
+def _tuples(value):
+    if isinstance(value, list):
+        return tuple(_tuples(x) for x in value)
+    return value
+
+class CursorError(ValueError):
+    pass
+
+def page_cursor(request, page, orderspec):
+    """
+    Return a cursor to the position of the page in the order given
+    by orderspec, see cursor_sortkey. The cursor carries the values
+    the page is sorted by, so it stays valid even if the page is
+    removed or changed.
+    """
+    values = dict()
+    orderkeys = _orderkeys(orderspec)
+    if orderkeys:
+        values = get_ordervalues(request, page, orderkeys)
+    return base64.urlsafe_b64encode(json.dumps([page, values]))
+
+def cursor_sortkey(cursor, orderspec):
+    """
+    Return the sort key (as used by order_pages) of a cursor from
+    page_cursor. Raises CursorError if the cursor is not one of the
+    orderspec.
+
+    >>> cursor = page_cursor(None, u'B', [])
+    >>> cursor_sortkey(cursor, []) == _sortkey([], u'B', {})
+    True
+    >>> cursor_sortkey(cursor, [('<<', u'prio')])
+    Traceback (most recent call last):
+    ...
+    CursorError: invalid cursor
+    """
+    try:
+        page, values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        values = dict((key, _tuples(values[key]))
+                      for key in _orderkeys(orderspec))
+        return _sortkey(orderspec, page, values)
+    except (TypeError, ValueError, KeyError, UnicodeError):
+        raise CursorError("invalid cursor")
+
+def order_pages(request, pages, orderspec, limit=None, after=None,
+                select=None):
+    """
+    Return the pages sorted as given by the orderspec of the
+    MetaTable args, or by name without one. With a limit only the
+    first pages up to the limit are kept while sorting. With after, a
+    sort key from cursor_sortkey, only the pages sorting after it are
+    returned.
+
+    With select, pages are the candidate pages (None for all the
+    pages) and select a function filtering an iterable of pages
+    lazily to the ones to return, in the same order. With a limit and
+    a plain key to order by, the candidates are then walked in the
+    order index of the key, and only filtered until the first pages
+    up to the limit are found.
+
+    >>> from MoinMoin.metadata.util import doctest_request
+    >>> request = doctest_request({
+    ...     u'A': {u'meta': {u'prio': [u'2']}},
+    ...     u'B': {u'meta': {u'prio': [u'10']}},
+    ...     u'C': {u'meta': {}},
+    ...     u'D': {u'meta': {u'prio': [u'2']}}})
+    >>> order_pages(request, [u'D', u'C', u'B', u'A'], [])
+    [u'A', u'B', u'C', u'D']
+    >>> order_pages(request, [u'D', u'C', u'B', u'A'], [('<<', u'prio')])
+    [u'A', u'D', u'B', u'C']
+    >>> order_pages(request, [u'D', u'C', u'B', u'A'], [('>>', u'prio')])
+    [u'B', u'A', u'D', u'C']
+    >>> order_pages(request, [u'D', u'C', u'B', u'A'],
+    ...             [('>>', u'prio'), ('>>', u'gwikipagename')], 2)
+    [u'B', u'D']
+    >>> order_pages(request, [u'D', u'C', u'B', u'A'], [('<<', u'prio')], 2)
+    [u'A', u'D']
+    >>> cursor = page_cursor(request, u'D', [('<<', u'prio')])
+    >>> after = cursor_sortkey(cursor, [('<<', u'prio')])
+    >>> order_pages(request, [u'D', u'C', u'B', u'A'], [('<<', u'prio')],
+    ...             after=after)
+    [u'B', u'C']
+    >>> seen = list()
+    >>> def select(pages):
+    ...     for page in pages:
+    ...         seen.append(page)
+    ...         yield page
+    >>> order_pages(request, None, [('>>', u'prio')], 1, select=select)
+    [u'B']
+    >>> seen
+    [u'B', u'A']
+    """
+    def sortkey(page):
+        return _page_sortkey(request, page, orderspec)
+
+    if select is None:
+        select = lambda pages: pages
+    if pages is not None:
+        pages = set(pages)
+
+    direction, key = orderspec and orderspec[0] or (None, None)
+    if (limit is not None and key is not None and
+        key != "gwikipagename" and _plain_key(key) and
+        (pages is None or len(pages) > limit)):
+        firstkeys = dict()
+        ordered = select(_index_ordered(request, pages, direction, key,
+                                        firstkeys))
+        if after is not None:
+            ordered = (page for page in ordered if after < sortkey(page))
+        pages = _take_top(ordered, firstkeys, limit)
+        after = None
     else:
-        metakeys = keyspec
+        if pages is None:
+            pages = request.graphdata.pagenames()
+        pages = select(pages)
+
+    if after is not None:
+        keyed = list()
+        for page in pages:
+            key = sortkey(page)
+            if after < key:
+                keyed.append((key, page))
+
+        if limit is None:
+            keyed.sort()
+        else:
+            keyed = heapq.nsmallest(limit, keyed)
+        return [page for key, page in keyed]
 
-    # sorting pagelist
-    if not orderspec:
-        pagelist = sorted(pagelist, key=ordervalue)
+    if limit is None:
+        return sorted(pages, key=sortkey)
+
+    # Bounded heap instead of sorting all the pages
+    return heapq.nsmallest(limit, pages, key=sortkey)
+
+def metatable_parseargs(request, args,
+                        get_all_keys=False,
+                        get_all_pages=False,
+                        checkAccess=True,
+                        include_unsaved=False,
+                        parsefunc=_metatable_parseargs,
+                        limit=None, offset=0):
+    """
+    Return the list of pages matching the MetaTable args in order,
+    the meta keys to show and the styles. With a limit only the first
+    pages up to the limit (after skipping offset pages) are returned,
+    and the meta keys are those of the returned pages.
+
+    The results are cached for the user until the graph data
+    changes, see cached_result.
+    """
+    results = _metatable_cached(request, args, get_all_keys, get_all_pages,
+                                checkAccess, include_unsaved, parsefunc,
+                                limit, offset)
+    return results[:3]
+
+def metatable_query(request, args,
+                    get_all_keys=False,
+                    get_all_pages=False,
+                    checkAccess=True,
+                    include_unsaved=False,
+                    parsefunc=_metatable_parseargs,
+                    limit=None, offset=0):
+    """
+    As metatable_parseargs, but also return the number of all the
+    pages matching the args.
+    """
+    results = _metatable_cached(request, args, get_all_keys, get_all_pages,
+                                checkAccess, include_unsaved, parsefunc,
+                                limit, offset, count=True)
+    return results[:4]
+
+def metatable_window(request, args, limit=None, after=None,
+                     get_all_keys=False):
+    """
+    Return the pages matching the MetaTable args that come after the
+    cursor after in their order (from the start if after is None), at
+    most limit of them, the meta keys of all the matching pages and
+    the cursor to the next window. The next cursor is None when the window
+    is the last one, a full window may be followed by an empty one.
+
+    A cursor is a position in the order (see page_cursor), so pages
+    added, removed or changed between the windows do not make the
+    other pages skip or repeat. Raises CursorError for a cursor that
+    is not one of the args.
+    """
+    pagelist, _, _, _, orderspec = \
+        _metatable_cached(request, args, get_all_keys, False, True, False,
+                          _metatable_parseargs, limit, 0, after)
+    # The keys of the whole result, so that every window has the same
+    # keys whatever pages it holds
+    metakeys = _metatable_keys(request, args, get_all_keys)
+
+    next = None
+    if limit is not None and pagelist and len(pagelist) >= limit:
+        next = page_cursor(request, pagelist[-1], orderspec)
+    return pagelist, metakeys, next
+
+def _metatable_cached(request, args, get_all_keys, get_all_pages,
+                      checkAccess, include_unsaved, parsefunc, limit,
+                      offset, after=None, count=False):
+    pagename = None
+    if request.page is not None:
+        # Relative page names in the args
+        pagename = request.page.page_name
+    key = (args, get_all_keys, get_all_pages, checkAccess,
+           include_unsaved, parsefunc, limit, offset, after, count,
+           pagename)
+
+    def compute():
+        pagelist, metakeys, styles, total, orderspec = _metatable_results(
+            request, args, get_all_keys, get_all_pages, checkAccess,
+            include_unsaved, parsefunc, limit, offset, after, count)
+        return (tuple(pagelist), tuple(metakeys), styles, total,
+                tuple(orderspec))
+
+    pagelist, metakeys, styles, total, orderspec = \
+        cached_result(request, 'metatable', key, compute)
+    return (list(pagelist), list(metakeys), copy.deepcopy(styles), total,
+            list(orderspec))
+
+def _metatable_results(request, args, get_all_keys, get_all_pages,
+                       checkAccess, include_unsaved, parsefunc, limit,
+                       offset, after=None, count=False):
+    candidates, select, parsed = \
+        _metatable_selection(request, args, get_all_pages, checkAccess,
+                             include_unsaved, parsefunc)
+    keyspec, excluded_keys, orderspec, indirection_keys, styles = parsed
+    if after is not None:
+        after = cursor_sortkey(after, orderspec)
+
+    if limit is not None:
+        limit += offset
+
+    total = None
+    if count:
+        # Counting needs all the matching pages
+        if candidates is None:
+            candidates = request.graphdata.pagenames()
+        pagelist = list(select(candidates))
+        total = len(pagelist)
+        pagelist = order_pages(request, pagelist, orderspec, limit, after)
     else:
-        orderkeys = [key for (direction, key) in orderspec]
-        orderpages = dict()
-
-        for page in pagelist:
-            ordermetas = get_metas(request, page, orderkeys, checkAccess=False)
-            for key, values in ordermetas.iteritems():
-                values = map(ordervalue, values)
-                ordermetas[key] = values
-            orderpages[page] = ordermetas
-
-        def comparison(page1, page2):
-            for direction, key in orderspec:
-                reverse = False
-                if direction == ">>":
-                    reverse = True
-
-                if key == "gwikipagename":
-                    values1 = [page1]
-                    values2 = [page2]
-                else:
-                    values1 = sorted(orderpages[page1][key], reverse=reverse)
-                    values2 = sorted(orderpages[page2][key], reverse=reverse)
-            
-                result = cmp(values1, values2)
-                if result == 0:
-                    continue
-            
-                if not values1:
-                    return 1
-                if not values2:
-                    return -1
+        pagelist = order_pages(request, candidates, orderspec, limit, after,
+                               select)
+    pagelist = pagelist[offset:]
+
+    metakeys = _result_keys(request, pagelist, keyspec, excluded_keys,
+                            indirection_keys, get_all_keys)
 
-                if reverse:
-                    return -result
-                return result
-            return cmp(ordervalue(page1), ordervalue(page2))
+    return pagelist, metakeys, styles, total, orderspec
 
-        pagelist = sorted(pagelist, cmp=comparison)
+def _result_keys(request, pagelist, keyspec, excluded_keys,
+                 indirection_keys, get_all_keys):
+    if keyspec:
+        return keyspec
 
-    return pagelist, metakeys, styles
+    metakeys = set([])
+    for name in pagelist:
+        # MetaEdit wants all keys by default
+        if get_all_keys:
+            for key in request.graphdata.get_metakeys(name):
+                metakeys.add(key)
+        else:
+            # For MetaTable etc
+            for key in (x for x in request.graphdata.get_metakeys(name)
+                        if not x in SPECIAL_ATTRS):
+                metakeys.add(key)
+
+    # Add gathered indirection metakeys
+    metakeys.update(indirection_keys)
+
+    # Exclude keys
+    for key in excluded_keys:
+        metakeys.discard(key)
+
+    return sorted(metakeys, key=ordervalue)
+
+def _metatable_keys(request, args, get_all_keys):
+    pagename = None
+    if request.page is not None:
+        pagename = request.page.page_name
+    key = (args, get_all_keys, pagename)
+
+    def compute():
+        pagelist, parsed = iter_metatable_pages(request, args,
+                                                parsefunc=_metatable_parseargs)
+        keyspec, excluded_keys, _, indirection_keys, _ = parsed
+        return tuple(_result_keys(request, pagelist, keyspec, excluded_keys,
+                                  indirection_keys, get_all_keys))
+
+    return list(cached_result(request, 'metatable-keys', key, compute))
 
 def get_properties(request, pagename):
     properties = dict()
@@ -6,6 +6,8 @@
                              Jussi Eronen <exec@iki.fi>
 """
 import re
+import socket
+import operator
 
 from codecs import getencoder
 
@@ -115,7 +117,218 @@ def url_escape(text):
     # macros and urls with parameters
     return re.sub('[\]"\?#&+]', lambda mo: '%%%02x' % ord(mo.group()), text)
 
+# Standard Python operators
+OPERATORS = {'<': operator.lt,
+             '<=': operator.le,
+             '==': operator.eq,
+             '!=': operator.ne,
+             '>=': operator.ge,
+             '>': operator.gt}
+
+def string_aton(value):
+    # Regression: without this, '\d+ ' is an IP according to this func
+    if not '.' in value and not ':' in value:
+        raise TypeError
+
+    # Support for CIDR notation, eg. 10.10.1.0/24
+    end = ''
+    if '/' in value:
+        value, end = value.split('/', 1)
+        end = '/' + end
+ 
+    # 00 is stylistic to avoid this: 
+    # >>> sorted(['a', socket.inet_aton('100.2.3.4'), 
+    #             socket.inet_aton('1.2.3.4')]) 
+    # ['\x01\x02\x03\x04', 'a', 'd\x02\x03\x04'] 
+    if '.' in value:
+        return u'00' + unicode(socket.inet_pton(socket.AF_INET, 
+                                                value).replace('\\', '\\\\'), 
+                               "unicode_escape") + end
+    else:
+        return u'00' + unicode(socket.inet_pton(socket.AF_INET6, 
+                                                 value).replace('\\', '\\\\'), 
+                               "unicode_escape") + end
+
+def float_parts(part):
+    # 2.1.5 should be treated as a float as people seem to expect
+    # this.
+    part = part.split('.')
+    fp = '.'.join(part[:2])
+    addon = '.'.join(part[2:])
+    if addon:
+        addon = '.%s' % (addon)
+
+    fp = float(fp)
+    return fp, addon
+    
+ORDER_FUNCS = [
+    # (conversion function, ignored exception type(s)) ipv4
+    # addresses. Return values should be unicode strings. The sorting
+    # of numbers is currently a bit hacky.
+    (lambda x: (string_aton(x), ''), 
+     (socket.error, UnicodeEncodeError, TypeError)),
+    # integers
+    (lambda x: (int(x), ''), ValueError),
+    # floats
+    (lambda x: float_parts(x), ValueError),
+    # strings (unicode or otherwise)
+    (lambda x: (x.lower(), ''), AttributeError)
+    ]
+
+def ordervalue(value):
+    extras = ''
+    # treat values prepended with anything accepted by order_funcs:
+    # 2.1 blaa => 2.1, [[2.1 blaa]] => 2.1
+    if value:
+        # Value has already been processed by ordervalue (or faulty
+        # data)
+        if type(value) not in [str, unicode]:
+            return value
+
+        # Strips links syntax and stuff (FIXME does this cover all the
+        # relevant cases?)
+        value = value.lstrip('[').strip(']')
+        value = value.split()
+
+        # Corner case, empty links eg. [[]]
+        if not value:
+            return ('', '')
+
+        extras = ' '.join(value[1:])
+        value = value[0]
+    for func, ignoredExceptionTypes in ORDER_FUNCS:
+        try:
+            out, addon = func(value)
+            return (out, addon + extras)
+        except ignoredExceptionTypes:
+            pass
+    return value
+
+def order_metas(metas):
+    """
+    Return the order keys of meta values, as stored alongside the
+    metas in the graph data.
+
+    >>> order_metas({u'prio': [u'2', u'10 high', u'[[Low]]']})
+    {u'prio': [(2, ''), (10, u'high'), (u'low', '')]}
+    """
+    return dict((key, map(ordervalue, values))
+                for key, values in metas.iteritems())
+
+def join_acl(lines):
+    """
+    Return the ACL lines of a page as the ACL string stored in the
+    graph data. Each line starts with a newline, so that a page with
+    an empty #acl line can be told apart from a page without any.
+
+    >>> join_acl([u'All:read', u'Known:write'])
+    u'\\nAll:read\\nKnown:write'
+    >>> split_acl(join_acl([u'']))
+    [u'']
+    >>> split_acl(u'')
+    []
+    >>> split_acl(u'All:read') is None
+    True
+    """
+    return u''.join(u'\n' + line for line in lines)
+
+def split_acl(acl):
+    """
+    Return the ACL lines of an ACL string stored by join_acl, or None
+    for the strings stored before it, which joined the lines together.
+    """
+    if not acl:
+        return list()
+    if not acl.startswith(u'\n'):
+        return None
+    return acl.split(u'\n')[1:]
+
+def may_read_many(request, pagenames):
+    """
+    Return the set of the given pages the current user may read.
+
+    Pages are checked like MoinMoin.security checks them, but using
+    the ACLs stored in the graph data when the pages were saved. Each
+    distinct ACL is evaluated once, so pages with the same ACL, eg.
+    the default one, cost a single check. Pages whose ACL is not known
+    from the graph data, and all pages with a custom security policy,
+    are checked one at a time.
+    """
+    from MoinMoin import security
+
+    pagenames = set(pagenames)
+    may = request.user.may
+    if (not isinstance(may, security.Permissions) or
+        getattr(may.__class__, 'read', None) is not None):
+        return set(name for name in pagenames if may.read(name))
+
+    cache = request.cfg.cache
+    username = request.user.name
+    allowed = cache.acl_rights_before.may(request, username, 'read')
+    if allowed is not None:
+        return allowed and pagenames or set()
+
+    hierarchic = request.cfg.acl_hierarchic
+
+    # Pages whose ACL decides, the page itself and with hierarchic
+    # ACLs its parents
+    def acl_pages(name):
+        if not hierarchic:
+            return [name]
+        parts = name.split('/')
+        return ['/'.join(parts[:i]) for i in range(len(parts), 0, -1)]
+
+    lookup = set()
+    for name in pagenames:
+        lookup.update(acl_pages(name))
+    pagedata = request.graphdata.getpages(lookup)
+
+    acls = dict()
+    def page_acl(name):
+        # Only the ACLs of existing pages saved in the current format
+        # are known, deleted pages keep the ACL of their last revision
+        data = pagedata.get(name, dict())
+        if not data.get(u'saved', False):
+            return None
+        lines = split_acl(data.get(u'acl', u''))
+        if lines is None:
+            return None
+
+        key = tuple(lines)
+        if key not in acls:
+            acl = security.AccessControlList(request.cfg, lines)
+            acls[key] = acl, acl.may(request, username, 'read')
+        return acls[key]
+
+    after = cache.acl_rights_after.may(request, username, 'read')
+    default = cache.acl_rights_default.may(request, username, 'read')
+
+    readable = set()
+    for name in pagenames:
+        for aclname in acl_pages(name):
+            entry = page_acl(aclname)
+            if entry is None:
+                allowed = may.read(name)
+                break
+
+            acl, allowed = entry
+            # With hierarchic ACLs the first page with some ACL
+            # entries decides
+            if not hierarchic or acl.acl:
+                break
+        else:
+            allowed = default
+
+        if allowed is None:
+            allowed = after
+        if allowed:
+            readable.add(name)
+
+    return readable
+
 def doctest_request(graphdata=dict(), mayRead=True, mayWrite=True):
+    from MoinMoin.metadata.backend.basedb import GraphDataBase
+
     class Request(object):
         pass
 
@@ -128,15 +341,51 @@ def doctest_request(graphdata=dict(), mayRead=True, mayWrite=True):
     class Cache(object):
         pass
 
-    class GraphData(dict):
-        def getpage(self, page):
-            return self.get(page, dict())
-    
+    class GraphData(GraphDataBase):
+        # In-memory graph data, meta index lookups scan the pages
+        def __init__(self, data):
+            self.data = dict(data)
+
+        def __getitem__(self, item):
+            return self.data[item]
+
+        def savepage(self, pagename, pagedict):
+            self.data[pagename] = pagedict
+
+        __setitem__ = savepage
+
+        def keys(self):
+            return self.data.keys()
+
+        def __iter__(self):
+            return iter(self.data)
+
+        def __contains__(self, item):
+            return item in self.data
+
+        def pagenames(self):
+            return iter(self.data)
+
+        def is_saved(self, pagename):
+            return self.getpage(pagename).get(u'saved', False)
+
+        def get_meta(self, pagename):
+            return self.getpage(pagename).get(u'meta', dict())
+
+        def get_metakeys(self, pagename):
+            keys = set(self.get_meta(pagename))
+            if 'gwikicategory' in self.get_out(pagename):
+                keys.add('gwikicategory')
+            return keys
+
     request = Request()
     request.cfg = Config()
     request.cfg.cache = Cache()
     request.cfg.cache.page_category_regex = category_regex(request)
     request.cfg.cache.page_category_regexact = category_regex(request, act=True)
+    request.cfg.cache.page_group_regexact = \
+        re.compile(u'^%s$' % multiconfig.DefaultConfig.page_group_regex,
+                   re.UNICODE)
     request.graphdata = GraphData(graphdata)
 
     request.user = Object()
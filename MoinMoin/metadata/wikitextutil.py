@@ -109,14 +109,13 @@ def parse_text(request, page, text):
     # Add the page categories as links too
     categories, _, _ = parse_categories(request, text)
 
-    # Process ACL:s
+    # Process ACL:s, imported here as util imports the config which
+    # imports this module
+    from util import join_acl
     pi, _ = get_processing_instructions(text)
-    for verb, args in pi:
-        if verb == u'acl':
-            # Add all ACL:s on multiple lines to an one-lines
-            acls = new_data.get(pagename, dict()).get('acl', '')
-            acls = acls.strip() + args
-            new_data.setdefault(pagename, dict())['acl'] = acls
+    acl_lines = [args for verb, args in pi if verb == u'acl']
+    if acl_lines:
+        new_data.setdefault(pagename, dict())['acl'] = join_acl(acl_lines)
 
     for metakey, value in p.definitions.iteritems():
         for ltype, item in value:
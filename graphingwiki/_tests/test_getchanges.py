@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+    getChangesJSON action Tests
+
+    @license: MIT <http://www.opensource.org/licenses/mit-license.php>
+"""
+import shutil
+import tempfile
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from werkzeug.datastructures import MultiDict
+
+from MoinMoin.metadata.util import doctest_request
+from MoinMoin.metadata.backend import shelvedb, sqlitedb
+from graphingwiki.plugin.action import getChangesJSON
+
+BACKENDS = [shelvedb.GraphData, sqlitedb.GraphData]
+
+class TestGetChanges(object):
+    def setup_method(self, method):
+        self.dirs = list()
+
+    def teardown_method(self, method):
+        for path in self.dirs:
+            shutil.rmtree(path, True)
+
+    def new_request(self, backend, journal_size):
+        request = doctest_request()
+        request.cfg.data_dir = tempfile.mkdtemp()
+        request.cfg.gwiki_journal_size = journal_size
+        self.dirs.append(request.cfg.data_dir)
+
+        graphdata = backend(request)
+        for i in range(4):
+            pagename = u'Page%d' % (i,)
+            meta = {u'prio': [unicode(i)]}
+            graphdata.set_page(request, pagename,
+                               {pagename: {u'meta': meta}})
+        graphdata.commit()
+        request.graphdata = graphdata
+        return request
+
+    def get(self, request, **values):
+        request.values = MultiDict(values)
+        request.status_code = 200
+        output = list()
+        request.write = output.append
+        getChangesJSON.execute(u'FrontPage', request)
+        return request.status_code, "".join(output)
+
+    def rows(self, request, since, limit):
+        status, output = self.get(request, since=str(since),
+                                  limit=str(limit))
+        assert status == 200
+        return [json.loads(line) for line in output.splitlines()]
+
+    def test_windows(self):
+        for backend in BACKENDS:
+            request = self.new_request(backend, 100)
+            position = request.graphdata.journal_position()
+            assert position == 4
+
+            everything = self.rows(request, 0, 100)
+            assert everything[-1] == {'next': position}
+            assert [row['page'] for row in everything[:-1]] == \
+                [u'Page0', u'Page1', u'Page2', u'Page3']
+
+            # Windows following next add up to the whole journal
+            for limit in [1, 3]:
+                rows = list()
+                since = 0
+                while since < position:
+                    window = self.rows(request, since, limit)
+                    assert len(window) <= limit + 1
+                    since = window[-1]['next']
+                    rows.extend(window[:-1])
+                assert rows == everything[:-1]
+            request.graphdata.close()
+
+    def test_gone(self):
+        for backend in BACKENDS:
+            request = self.new_request(backend, 2)
+            position = request.graphdata.journal_position()
+
+            # The journal no longer reaches back to the start
+            status, output = self.get(request, since='0')
+            assert status == 410
+            assert json.loads(output) == {'position': position}
+
+            rows = self.rows(request, position - 2, 10)
+            assert [row['seq'] for row in rows[:-1]] == \
+                [position - 1, position]
+
+            # Nor to the future
+            status, output = self.get(request, since=str(position + 1))
+            assert status == 410
+            request.graphdata.close()
+
+    def test_invalid(self):
+        request = self.new_request(shelvedb.GraphData, 100)
+        for values in [dict(since='x'), dict(since='-1'), dict(limit='0')]:
+            status, _ = self.get(request, **values)
+            assert status == 400
+        request.graphdata.close()
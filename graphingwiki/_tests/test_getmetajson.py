@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+    getMetaJSON action Tests
+
+    @license: MIT <http://www.opensource.org/licenses/mit-license.php>
+"""
+from MoinMoin.metadata.util import doctest_request
+from MoinMoin.metadata.query import PAGE_BATCH
+from graphingwiki.plugin.action import getMetaJSON
+
+class GraphData(object):
+    def __init__(self, closed):
+        self.closed = closed
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.closed.append(self)
+
+class TestJSONRows(object):
+    def test_closed_between_batches(self):
+        request = doctest_request()
+        closed = list()
+        count = 2 * PAGE_BATCH + 1
+
+        def results():
+            for i in range(count):
+                # Reading the results opens the graph data
+                if '_graphdata' not in request.__dict__:
+                    request.__dict__['_graphdata'] = GraphData(closed)
+                yield u'Page%d' % (i,), {u'prio': [unicode(i % 2)]}
+
+        rows = getMetaJSON.json_rows(request, results(), 'cursor',
+                                     u'prio', False, 10)
+        pages = list()
+        for row in rows:
+            # No graph data is open while the rows are written
+            assert '_graphdata' not in request.__dict__
+            pages.append(row.get('page'))
+
+        assert pages == [u'Page%d' % (i,) for i in range(count)] + [None]
+        assert len(closed) == 3
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+    graphingwiki.graph Tests
+
+    The same changes are made on a Graph and a CompactGraph, and the
+    graphs have to look the same afterwards.
+
+    @license: MIT <http://www.opensource.org/licenses/mit-license.php>
+"""
+import random
+
+from graphingwiki.graph import Graph, CompactGraph
+
+NAMES = [u'a', u'b', u'c', u'd', u'e', u'f']
+COLORS = [u'red', u'green', u'blue']
+
+def change(graph, rand):
+    op = rand.randrange(5)
+    name, other = rand.choice(NAMES), rand.choice(NAMES)
+    if op == 0:
+        node = graph.nodes.add(name)
+        node.gwikilabel = name.upper()
+    elif op == 1:
+        graph.nodes.delete(name)
+    elif op == 2:
+        edge = graph.edges.add(name, other)
+        edge.color = rand.choice(COLORS)
+    elif op == 3:
+        graph.edges.delete(name, other)
+    else:
+        node = graph.nodes.get(name)
+        if node is not None:
+            node.gwikicolor = rand.choice(COLORS)
+
+def state(graph):
+    nodes = dict((name, sorted(graph.nodes.get(name)))
+                 for name in graph.nodes)
+    edges = dict((edge, sorted(graph.edges.get(*edge)))
+                 for edge in graph.edges)
+    children = dict((name, graph.edges.children(name)) for name in NAMES)
+    parents = dict((name, graph.edges.parents(name)) for name in NAMES)
+    return (nodes, edges, children, parents,
+            len(graph.nodes), len(graph.edges), bool(graph))
+
+class TestCompactGraph(object):
+    def test_same_as_graph(self):
+        for seed in range(20):
+            graph, compact = Graph(), CompactGraph()
+            # The same random changes on both
+            rand, crand = random.Random(seed), random.Random(seed)
+            for i in range(200):
+                change(graph, rand)
+                change(compact, crand)
+                assert state(graph) == state(compact)
+            assert repr(graph) == repr(compact)
+
+    def test_missing(self):
+        compact = CompactGraph()
+        compact.edges.add(u'a', u'b')
+        assert compact.nodes.get(u'c') is None
+        assert compact.edges.get(u'b', u'a') is None
+        assert compact.edges.children(u'c') == set()
+        compact.edges.delete(u'b', u'a')
+        compact.nodes.delete(u'c')
+        assert sorted(compact.edges) == [(u'a', u'b')]
@@ -27,8 +27,8 @@ from MoinMoin.wikiutil import importPlugin, AbsPageName
 
 from MoinMoin.metadata.wikitextutil import parse_text
 from MoinMoin.metadata.constants import SPECIAL_ATTRS, TEMPLATE_KEY
-from MoinMoin.metadata.query import get_metas, ordervalue
-from MoinMoin.metadata.util import editable_p
+from MoinMoin.metadata.query import get_metas, ordervalue, PAGE_BATCH
+from MoinMoin.metadata.util import editable_p, may_read_many
 from MoinMoin.metadata.wikitextutil import replace_metas
 
 def macro_re(macroname):
@@ -131,24 +131,111 @@ def get_links(request, name, metakeys, checkAccess=True, **kw):
             
     return pageLinks
 
+def _iter_pagedata(request, pagenames=None, checkAccess=False):
+    # Go through the pages of the graph data a batch at a time
+    if pagenames is None:
+        pagenames = request.graphdata.pagenames()
+    pagenames = list(pagenames)
+    for i in xrange(0, len(pagenames), PAGE_BATCH):
+        batch = pagenames[i:i + PAGE_BATCH]
+        if checkAccess:
+            readable = may_read_many(request, batch)
+            batch = [page for page in batch if page in readable]
+        pagedata = request.graphdata.getpages(batch)
+        for page in batch:
+            yield page, pagedata[page]
+
+def _value_candidates(request, key, value):
+    # Pages that have the value on key in the events built by
+    # iter_metas, which adds the page name and category links
+    graphdata = request.graphdata
+    if key == u'gwikipagename':
+        return set([value])
+    if key is None:
+        pages = set(graphdata.pages_with_any_value(value))
+        pages.add(value)
+    else:
+        pages = set(graphdata.pages_with_value(key, value))
+    if key in (None, u'gwikicategory'):
+        pages.update(graphdata.get_in(value).get(u'gwikicategory', ()))
+    return pages
+
+def _rule_candidates(request, rule):
+    """
+    Return the set of pages that can match the abuse-sa rule, looked
+    up from the meta indexes, or None if the rule does not narrow
+    down the pages. The pages still need to be matched against the
+    rule, the candidates are only a superset of the matches.
+
+    The rule classes of abusehelper keep their arguments in private
+    attributes. Rules that do not look like expected are not
+    narrowed down, which is slower but not wrong.
+    """
+    from abusehelper.core import rules
+
+    if isinstance(rule, rules.rules.And):
+        candidates = None
+        for subrule in getattr(rule, '_rules', ()):
+            pages = _rule_candidates(request, subrule)
+            if pages is None:
+                continue
+            if candidates is None:
+                candidates = pages
+            else:
+                candidates &= pages
+        return candidates
+
+    if isinstance(rule, rules.rules.Or):
+        subrules = getattr(rule, '_rules', ())
+        if not subrules:
+            return None
+        candidates = set()
+        for subrule in subrules:
+            pages = _rule_candidates(request, subrule)
+            if pages is None:
+                return None
+            candidates |= pages
+        return candidates
+
+    # NonMatch is a subclass of Match in some versions, and matches
+    # pages without the value
+    if (type(rule) is not rules.rules.Match or
+        not hasattr(rule, '_key') or not hasattr(rule, '_filter')):
+        return None
+
+    key, filter = rule._key, rule._filter
+    if isinstance(filter, rules.atoms.String) and hasattr(filter, 'value'):
+        return _value_candidates(request, key, filter.value)
+
+    # Any other filter needs some value on the key
+    if key is None or key in (u'gwikipagename', u'gwikicategory'):
+        return None
+    return set(request.graphdata.pages_with_key(key))
+
 def iter_metas(request, rule, keys=None, checkAccess=True):
     from abusehelper.core import rules, events
     if type(rule) != rules.rules.Match:
         rule = rules.parse(unicode(rule))
 
-    for page, _meta in request.graphdata.items():
+    # Only the candidate pages of the rule are read, access checked
+    # and matched
+    candidates = _rule_candidates(request, rule)
+    if candidates is not None:
+        candidates = sorted(candidates)
+
+    for page, _meta in _iter_pagedata(request, candidates, checkAccess):
         _page = {u"gwikipagename": page}
         metas = _meta.get(u"meta", None)
 
-        if checkAccess and not request.user.may.read(page):
-            continue
-
         if not metas:
             continue
 
-        _out = request.graphdata.get_out(page)
+        _out = _meta.get(u"out", dict())
         if _out.has_key('gwikicategory'):
-            metas.setdefault(u'gwikicategory', []).extend(_out.get("gwikicategory"))
+            # Do not modify the page data, it may be cached
+            metas = dict(metas)
+            metas[u'gwikicategory'] = (metas.get(u'gwikicategory', []) +
+                                       _out.get("gwikicategory"))
 
         data = events.Event(dict(metas.items() + _page.items()))
         if rule.match(data):
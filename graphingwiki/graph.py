@@ -29,6 +29,7 @@
     DEALINGS IN THE SOFTWARE.
 """
 
+from array import array
 from codecs import getencoder
 
 ## HACK
@@ -307,6 +308,268 @@ class Graph(Node):
 
         return out
 
+# Compact graphs. Instead of an AttrBag per node and edge, the names
+# are interned to integer ids, the adjacency is kept in arrays of ids
+# and the attributes in per-key columns. The node and edge items are
+# views to the columns, made when asked for.
+
+class _Names(object):
+    def __init__(self):
+        self.ids = dict()
+        self.names = list()
+
+    def intern(self, name):
+        id = self.ids.get(name, None)
+        if id is None:
+            id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return id
+
+class _Columns(dict):
+    # Attribute key -> {item id: value}
+    def discard(self, id):
+        for key, column in self.items():
+            column.pop(id, None)
+            if not column:
+                del self[key]
+
+class _Item(object):
+    __slots__ = ['_columns', '_id']
+
+    def __init__(self, columns, id):
+        object.__setattr__(self, '_columns', columns)
+        object.__setattr__(self, '_id', id)
+
+    def __iter__(self):
+        for key, column in self._columns.iteritems():
+            if self._id in column:
+                yield key, column[self._id]
+
+    def __getattr__(self, key):
+        try:
+            return self._columns[key][self._id]
+        except KeyError:
+            raise AttributeError("%r object has no attribute %r" %
+                                 (self.__class__.__name__, key))
+
+    def __setattr__(self, key, value):
+        # Same HACKs as in AttrBag
+        if isinstance(key, unicode):
+            key = encode_page(key)
+        if type(key) == tuple:
+            _, key = key
+        self._columns.setdefault(key, dict())[self._id] = value
+
+    def __delattr__(self, key):
+        if isinstance(key, unicode):
+            key = encode_page(key)
+        try:
+            column = self._columns[key]
+            del column[self._id]
+        except KeyError:
+            raise AttributeError(key)
+        if not column:
+            del self._columns[key]
+
+    def update(self, other):
+        for name, value in other:
+            self.__setattr__(name, value)
+
+class _NodeItem(_Item):
+    __slots__ = ['_identity']
+
+    def __init__(self, columns, id, identity):
+        _Item.__init__(self, columns, id)
+        object.__setattr__(self, '_identity', identity)
+
+    def __unicode__(self):
+        return self._identity
+
+class CompactNodes(object):
+    def __init__(self, graph, names=None):
+        object.__init__(self)
+
+        self.graph = graph
+        self._names = names or _Names()
+        # One byte per interned name, set if the node exists
+        self._present = array('B')
+        self._count = 0
+        self._columns = _Columns()
+
+    def _id(self, identity):
+        id = self._names.ids.get(identity, None)
+        if id is None or id >= len(self._present) or not self._present[id]:
+            return None
+        return id
+
+    def add(self, identity, **keys):
+        id = self._names.intern(identity)
+        if id >= len(self._present):
+            self._present.extend([0] * (id + 1 - len(self._present)))
+        if not self._present[id]:
+            self._present[id] = 1
+            self._count += 1
+
+        node = _NodeItem(self._columns, id, identity)
+        node.update(keys.iteritems())
+        return node
+
+    def delete(self, identity):
+        # Like Nodes.delete, the edges go even if the node does not
+        id = self._id(identity)
+        if id is not None:
+            self._present[id] = 0
+            self._count -= 1
+            self._columns.discard(id)
+        self.graph.edges._delete(identity)
+
+    def get(self, identity):
+        id = self._id(identity)
+        if id is None:
+            return None
+        return _NodeItem(self._columns, id, identity)
+
+    def __iter__(self):
+        names = self._names.names
+        for id, present in enumerate(self._present):
+            if present:
+                yield names[id]
+
+    def __len__(self):
+        return self._count
+
+class CompactEdges(object):
+    # Edges are identified by (parent id << 32) | child id
+    def __init__(self, names=None):
+        object.__init__(self)
+
+        self._names = names or _Names()
+        self._edges = set()
+        self._children = dict()
+        self._parents = dict()
+        self._columns = _Columns()
+
+    def _key(self, parent, child):
+        ids = self._names.ids
+        if parent not in ids or child not in ids:
+            return None
+        return (ids[parent] << 32) | ids[child]
+
+    def add(self, parent, child, **keys):
+        """
+        >>> edges = CompactEdges()
+        >>> e1 = edges.add(1, 2, color='red')
+        >>> e2 = edges.add(1, 3)
+        >>> sorted(edges)
+        [(1, 2), (1, 3)]
+        >>> dict(edges.add(1, 2))
+        {'color': 'red'}
+        """
+        pid = self._names.intern(parent)
+        cid = self._names.intern(child)
+        key = (pid << 32) | cid
+
+        if key not in self._edges:
+            self._edges.add(key)
+            self._children.setdefault(pid, array('l')).append(cid)
+            self._parents.setdefault(cid, array('l')).append(pid)
+
+        edge = _Item(self._columns, key)
+        edge.update(keys.iteritems())
+        return edge
+
+    def delete(self, parent, child):
+        """
+        >>> edges = CompactEdges()
+        >>> _ = edges.add(1, 2, color='red')
+        >>> _ = edges.add(1, 3)
+        >>> edges.delete(1, 2)
+        >>> sorted(edges), sorted(edges.parents(2))
+        ([(1, 3)], [])
+        >>> dict(edges.add(1, 2))
+        {}
+        """
+        key = self._key(parent, child)
+        if key is None or key not in self._edges:
+            return
+
+        pid, cid = key >> 32, key & 0xffffffff
+        self._edges.discard(key)
+        self._columns.discard(key)
+        self._unlink(self._children, pid, cid)
+        self._unlink(self._parents, cid, pid)
+
+    def _unlink(self, adjacency, id, other):
+        ids = adjacency[id]
+        ids.remove(other)
+        if not ids:
+            del adjacency[id]
+
+    def get(self, parent, child):
+        key = self._key(parent, child)
+        if key is None or key not in self._edges:
+            return None
+        return _Item(self._columns, key)
+
+    def children(self, parent):
+        names = self._names.names
+        id = self._names.ids.get(parent, None)
+        return set(names[x] for x in self._children.get(id, ()))
+
+    def parents(self, child):
+        names = self._names.names
+        id = self._names.ids.get(child, None)
+        return set(names[x] for x in self._parents.get(id, ()))
+
+    def _delete(self, node):
+        for child in self.children(node):
+            self.delete(node, child)
+        for parent in self.parents(node):
+            self.delete(parent, node)
+
+    def __iter__(self):
+        names = self._names.names
+        for key in self._edges:
+            yield names[key >> 32], names[key & 0xffffffff]
+
+    def __len__(self):
+        return len(self._edges)
+
+class CompactGraph(Graph):
+    """
+    Graph with the same interface, but a smaller memory footprint
+    for large graphs. The node and edge items are made when asked
+    for, so the same node gives equal but not identical items.
+
+    >>> graph = CompactGraph()
+    >>> node = graph.nodes.add(u'a', gwikilabel=u'A')
+    >>> graph.nodes.get(u'a').gwikilabel
+    u'A'
+    >>> _ = graph.edges.add(u'a', u'b')
+    >>> _ = graph.edges.add(u'b', u'b')
+    >>> graph.edges.children(u'a')
+    set([u'b'])
+    >>> graph.nodes.delete(u'a')
+    >>> sorted(graph.nodes), sorted(graph.edges)
+    ([], [(u'b', u'b')])
+    >>> hasattr(graph.nodes.add(u'a'), 'gwikilabel')
+    False
+    """
+    def __init__(self):
+        names = _Names()
+        self.__dict__['nodes'] = CompactNodes(self, names)
+        self.__dict__['edges'] = CompactEdges(names)
+        Node.__init__(self, '')
+
+def graph_class(request):
+    """
+    Returns the graph class configured for large graphs, see
+    CompactGraph.
+    """
+    if getattr(request.cfg, 'gwiki_compact_graphs', False):
+        return CompactGraph
+    return Graph
+
 def _test():
     import doctest
     doctest.testmod()
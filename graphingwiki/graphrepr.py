@@ -28,7 +28,26 @@
 
 """
 
+import os
 import sys
+import math
+import time
+import errno
+import fcntl
+import resource
+import subprocess
+
+from array import array
+from tempfile import mkstemp
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+from MoinMoin import log
+from MoinMoin import caching
+logging = log.getLogger(__name__)
 
 from MoinMoin.metadata.util import encode_page, decode_page
 from MoinMoin.metadata.query import ordervalue
@@ -48,6 +67,36 @@ try:
 except ImportError:
     igraph = None
 
+# Attributes that affect the layout of the graph items. Graphs whose
+# items and these attributes are the same get the same layout, no
+# matter the colours, URL:s, tooltips and such.
+GRAPH_LAYOUT_ATTRS = set(['rankdir', 'overlap', 'splines', 'size',
+                          'ratio', 'clusterrank', 'compound', 'ranksep',
+                          'nodesep', 'label', 'fontsize', 'fontname'])
+NODE_LAYOUT_ATTRS = set(['label', 'shape', 'image', 'imagescale',
+                         'peripheries', 'fontsize', 'fontname', 'width',
+                         'height', 'fixedsize', 'margin', 'sides',
+                         'regular', 'orientation', 'distortion', 'skew'])
+EDGE_LAYOUT_ATTRS = set(['label', 'headlabel', 'taillabel', 'decorate',
+                         'minlen', 'weight', 'constraint', 'dir',
+                         'arrowhead', 'arrowtail', 'headport', 'tailport',
+                         'samehead', 'sametail', 'len', 'fontsize',
+                         'fontname'])
+SUBGRAPH_LAYOUT_ATTRS = set(['rank'])
+
+# Attributes the layout sets
+GRAPH_POSITION_ATTRS = set(['bb', 'lp'])
+NODE_POSITION_ATTRS = set(['pos', 'width', 'height'])
+EDGE_POSITION_ATTRS = set(['pos', 'lp', 'head_lp', 'tail_lp'])
+
+# Seconds between polls of layout locks and running layouts
+LOCK_POLL = 0.1
+ENGINE_POLL = 0.05
+
+def _pick_attrs(attrs, names):
+    return sorted((key, value) for key, value in attrs
+                  if key in names and value)
+
 def have_gv():
     '''Returns true if gv is imported successfully
 
@@ -69,26 +118,26 @@ class IGraphRepr(object):
     points = None
     gr = None
 
-    def __init__(self, outgraph):
+    def __init__(self, outgraph, request=None):
         # The lgl layout does not represent nodes without edges in
         # any meaningful manner - let's omit them from taking space
-        edges_seen = list()
-        root = [None]
-
-        def map_id(name):
-            if not name in edges_seen:
-                root[0] = len(edges_seen)
-                edges_seen.append(name)
-            idx = edges_seen.index(name)
-            return idx
-
-        # edge ID:s need to be integers
-        self.edges = [(map_id(x[0]), map_id(x[1])) for x in outgraph.edges]
+        ids = dict()
+        root = None
+
+        # edge ID:s need to be integers, in the order the nodes are
+        # seen in the edges
+        edges = array('l')
+        for edge in outgraph.edges:
+            for name in edge:
+                if name not in ids:
+                    root = ids[name] = len(ids)
+                edges.append(ids[name])
+        self.edges = zip(edges[::2], edges[1::2])
 
         if not self.edges:
-            return self.points
+            return
 
-        self.gr = igraph.Graph(self.edges)
+        self.gr = igraph.Graph(n=len(ids), edges=self.edges)
 
         # Not efficient to use node labels as the plotting draws
         # text as paths
@@ -96,7 +145,26 @@ class IGraphRepr(object):
 
         # Need to start lgl from a weakly connected root to avoid
         # heavy clustering of connected components
-        self.points = self.gr.layout_lgl(root=root[0])
+        self.points = self._layout(request, edges, root)
+
+    def _layout(self, request, edges, root):
+        if request is None:
+            return self.gr.layout_lgl(root=root)
+
+        # The layouts of the same edges are cached
+        key = sha1(edges.tostring() + str(root)).hexdigest()
+        entry = caching.CacheEntry(request, 'gwikilayout', 'igraph-' + key,
+                                   scope='wiki', use_pickle=True)
+        if entry.exists():
+            try:
+                return igraph.Layout(entry.content())
+            except Exception:
+                # Unreadable entries are laid out again
+                pass
+
+        points = self.gr.layout_lgl(root=root)
+        entry.update(points.coords)
+        return points
 
     def summary(self, **kw):
         if not self.gr:
@@ -362,6 +430,58 @@ class Graphviz:
         """ Sets root graph attributes. """
         self._setattrs(handle=self.handle, proto=proto, **attrs)
 
+    def layout_signature(self):
+        """ Returns the items of the graph, in the order they were
+        added, with the attributes that affect their layout.
+
+        Graphs with the same signature get the same layout, so the
+        positions of one (see positions) can be used for the other.
+        """
+        def subgraphs(parent):
+            return [(str(subg), _pick_attrs(subg, SUBGRAPH_LAYOUT_ATTRS),
+                     [str(node) for node in subg.nodes], subgraphs(subg))
+                    for subg in parent.subg]
+
+        return (self.engine,
+                _pick_attrs(self._iterattrs(), GRAPH_LAYOUT_ATTRS),
+                [(str(node), _pick_attrs(node, NODE_LAYOUT_ATTRS))
+                 for node in self.nodes],
+                [(edge, _pick_attrs(attrs.iteritems(), EDGE_LAYOUT_ATTRS))
+                 for edge, attrs in self.edges],
+                subgraphs(self))
+
+    def positions(self):
+        """ Lays out the graph if needed, returns the positions of
+        the graph items.
+        """
+        self.layout()
+        return self._positions()
+
+    def _positions(self):
+        return {'graph': dict(_pick_attrs(self._iterattrs(),
+                                          GRAPH_POSITION_ATTRS)),
+                'nodes': dict((decode_page(gv.nameof(node.handle)),
+                               dict(_pick_attrs(node, NODE_POSITION_ATTRS)))
+                              for node in self.nodes),
+                'edges': dict((edge, dict(_pick_attrs(attrs.iteritems(),
+                                                      EDGE_POSITION_ATTRS)))
+                              for edge, attrs in self.edges)}
+
+    def set_positions(self, positions):
+        """ Sets the positions of the graph items from the positions
+        of a graph with the same layout signature. The graph is then
+        drawn as positioned, without laying it out again.
+        """
+        self.set(**positions['graph'])
+        for node, attrs in positions['nodes'].iteritems():
+            self.nodes.set(node, **attrs)
+        for edge, attrs in positions['edges'].iteritems():
+            self.edges.set(edge, **attrs)
+
+        # The nop2 engine (neato -n2) keeps the given positions
+        self.engine = 'nop2'
+        self.changed = 1
+
     # The rest are internal functions, fat and ugly. Use at your own risk!
     def _read(self, string="", fname=""):
         """ Reads a graph from string, file or stdin """
@@ -523,6 +643,130 @@ class Graphviz:
         if item:
             gv.rm(item)
 
+class LayoutError(Exception):
+    """ Raised when a graph can not be laid out within its budget. """
+
+def _try_lock(path):
+    while True:
+        lock = open(path, 'a')
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            return None
+
+        # The previous holder may have removed the file (see
+        # remove_lock), then lock the one now at path
+        try:
+            current = os.stat(path).st_ino
+        except OSError:
+            current = None
+        if current == os.fstat(lock.fileno()).st_ino:
+            return lock
+        lock.close()
+
+def lock_file(path, deadline):
+    """ Returns the file at path exclusively locked, waiting for the
+    lock until deadline (in time.time() seconds). The lock is released
+    when the file is closed.
+    """
+    while True:
+        lock = _try_lock(path)
+        if lock is not None:
+            return lock
+        if time.time() >= deadline:
+            raise LayoutError("Timed out waiting for " + path)
+        time.sleep(LOCK_POLL)
+
+def remove_lock(lock):
+    """ Removes the file of a lock from lock_file and releases the
+    lock.
+    """
+    try:
+        os.unlink(lock.name)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    lock.close()
+
+def _lock_worker(lockdir, workers, deadline):
+    # Each running layout holds one of the worker lock files
+    while True:
+        for worker in range(workers):
+            lock = _try_lock(os.path.join(lockdir, 'worker-%d.lock' % worker))
+            if lock is not None:
+                return lock
+        if time.time() >= deadline:
+            raise LayoutError("Timed out waiting for a layout worker")
+        time.sleep(LOCK_POLL)
+
+def _limits(seconds, memory):
+    def limit():
+        resource.setrlimit(resource.RLIMIT_CPU, (seconds, seconds))
+        if memory:
+            resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    return limit
+
+def external_layout(graphviz, lockdir, deadline, workers=4, memory=0):
+    """ Lays out the graph by running its layout engine as a command
+    and returns the positions of the graph items (see
+    Graphviz.positions).
+
+    At most workers layouts run at a time on the lock files in
+    lockdir. The layout is killed at deadline (in time.time()
+    seconds), counting the wait for a worker, and limited to the
+    memory of bytes, if given. LayoutError is raised if the layout
+    does not finish.
+    """
+    worker = _lock_worker(lockdir, workers, deadline)
+    try:
+        return _run_engine(graphviz, deadline, memory)
+    finally:
+        worker.close()
+
+def _run_engine(graphviz, deadline, memory):
+    infile, inname = mkstemp('.dot')
+    outfile, outname = mkstemp('.dot')
+    os.close(infile)
+    os.close(outfile)
+
+    try:
+        gv.write(graphviz.handle, inname)
+
+        seconds = max(int(math.ceil(deadline - time.time())), 1)
+        devnull = open(os.devnull, 'w')
+        try:
+            proc = subprocess.Popen([graphviz.engine, '-Tdot',
+                                     '-o' + outname, inname],
+                                    stdout=devnull, stderr=devnull,
+                                    close_fds=True,
+                                    preexec_fn=_limits(seconds, memory))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            # No command line tools, lay out as before
+            logging.warning("Graphviz command %r not found, laying out "
+                            "in process" % (graphviz.engine,))
+            return graphviz.positions()
+        finally:
+            devnull.close()
+
+        while proc.poll() is None:
+            if time.time() >= deadline:
+                proc.kill()
+                proc.wait()
+                raise LayoutError("Layout timed out")
+            time.sleep(ENGINE_POLL)
+
+        if proc.returncode != 0:
+            raise LayoutError("Layout failed with status %d" %
+                              (proc.returncode,))
+
+        return Graphviz(fname=outname)._positions()
+    finally:
+        os.remove(inname)
+        os.remove(outname)
+
 class GraphRepr(object):
     def __init__(self, graph, engine):
         object.__init__(self)
@@ -130,6 +130,8 @@ def execute(pagename, request):
 
     graphdata = request.graphdata
     vals_on_keys = graphdata.get_vals_on_keys()
+    # Values not in the meta indexes, eg. from templates
+    extra_vals = dict()
 
     # If we're making a new page based on a template, make sure that
     # the values from the evaluated template are included in the form editor
@@ -139,16 +141,16 @@ def execute(pagename, request):
         for page in data:
             for key in data[page].get('meta', list()):
                 for val in data[page]['meta'][key]:
-                    vals_on_keys.setdefault(key, set()).add(val)
+                    extra_vals.setdefault(key, set()).add(val)
             for key in data[page].get('out', list()):
                 for val in data[page]['out'][key]:
-                    vals_on_keys.setdefault(key, set()).add(val)
+                    extra_vals.setdefault(key, set()).add(val)
 
             pagemeta = graphdata.get_meta(page)
 
             for key in pagemeta:
                 for val in pagemeta[key]:
-                    vals_on_keys.setdefault(key, set()).add(val)
+                    extra_vals.setdefault(key, set()).add(val)
 
     # Form types
     def form_selection(request, pagekey, curval, values, description=''):
@@ -224,8 +226,9 @@ def execute(pagename, request):
         values = list()
 
         # Placeholder key key
-        if key in vals_on_keys:
-            for keyval in sorted(vals_on_keys[key]):
+        keyvals = extra_vals.get(key, set()) | vals_on_keys.get(key, set())
+        if keyvals:
+            for keyval in sorted(keyvals):
                 keyval = keyval.strip()
 # Is this really needed? If so, probably should make the length configurable..
 #                if len(keyval) > 30:
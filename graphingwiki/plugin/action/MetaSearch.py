@@ -108,32 +108,30 @@ def execute(pagename, request):
                 request.write(render_error(_("Bad regexp!")))
 
         graphdata = request.graphdata
-        graphdata.reverse_meta()
-        keys_on_pages = graphdata.keys_on_pages
-        vals_on_pages = graphdata.vals_on_pages
 
         keyhits = set([])
         keys = set([])
-        for key in keys_on_pages:
-            if q:
-                if key == q:
-                    keyhits.update(keys_on_pages[key])
-                    keys.add(key)
-            else:
+        valhits = set([])
+        vals = set([])
+
+        if q:
+            # Exact matches are straight index lookups
+            keyhits.update(graphdata.pages_with_key(q))
+            if keyhits:
+                keys.add(q)
+
+            valhits.update(graphdata.pages_with_any_value(q))
+            if valhits:
+                vals.add(q)
+        else:
+            for key in graphdata.metakeys():
                 if page_re.match(key):
-                    keyhits.update(keys_on_pages[key])
+                    keyhits.update(graphdata.pages_with_key(key))
                     keys.add(key)
 
-        valhits = set([])
-        vals = set([])
-        for val in vals_on_pages:
-            if q:
-                if val == q:
-                    valhits.update(vals_on_pages[val])
-                    vals.add(val)
-            else:
+            for val in graphdata.metavalues():
                 if page_re.match(val):
-                    valhits.update(vals_on_pages[val])
+                    valhits.update(graphdata.pages_with_any_value(val))
                     vals.add(val)
 
         if not q:
@@ -147,7 +145,9 @@ def execute(pagename, request):
         request.write(formatter.bullet_list(1))
         for page in sorted(keyhits):
             # Do not include revisions etc so far, enabling this as per request
-            if not graphdata[page].has_key(u'saved'):
+            if not graphdata.is_saved(page):
+                continue
+            if page.endswith('Template'):
                 continue
 
             request.write(formatter.listitem(1))
@@ -164,7 +164,9 @@ def execute(pagename, request):
         request.write(formatter.bullet_list(1))
         for page in sorted(valhits):
             # Do not include revisions etc so far, enabling this as per request
-            if not graphdata[page].has_key(u'saved'):
+            if not graphdata.is_saved(page):
+                continue
+            if page.endswith('Template'):
                 continue
 
             request.write(formatter.listitem(1))
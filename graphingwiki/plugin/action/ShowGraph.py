@@ -30,6 +30,7 @@
 import os
 import re
 import math
+import time
 import colorsys
 
 try:
@@ -41,6 +42,7 @@ from tempfile import mkstemp
 from random import choice, seed
 
 from MoinMoin.action import cache
+from MoinMoin import caching
 from MoinMoin import config
 from MoinMoin.wikiutil import form_writer
 from MoinMoin.formatter.text_plain import Formatter as TextFormatter
@@ -51,13 +53,14 @@ from MoinMoin.metadata.util import nonguaranteeds_p, category_regex, \
 
 from graphingwiki import actionname, values_to_form
 
-from graphingwiki.graph import Graph
-from graphingwiki.graphrepr import have_gv, have_igraph, GraphRepr, Graphviz, IGraphRepr
+from graphingwiki.graph import graph_class
+from graphingwiki.graphrepr import have_gv, have_igraph, GraphRepr, Graphviz, IGraphRepr, \
+    LayoutError, external_layout, lock_file, remove_lock
 
 from graphingwiki.util import attachment_file, attachment_url, \
     url_parameters, get_url_ns, load_parents, load_children, \
-    form_escape, load_node, make_tooltip, cache_exists, cache_key, \
-    xml_document, xml_node_id_and_text, geoip_init, \
+    form_escape, load_node, NodeBatch, make_tooltip, cache_exists, \
+    cache_key, xml_document, xml_node_id_and_text, geoip_init, \
     geoip_get_coords, render_error, render_warning
 from graphingwiki.editing import verify_coordinates
 
@@ -530,7 +533,7 @@ class GraphShower(object):
         self.allcategories.update(cats)
 
     def build_graph_data(self):
-        self.graphdata = Graph()
+        self.graphdata = graph_class(self.request)()
 
         pagename = self.pagename
 
@@ -567,7 +570,7 @@ class GraphShower(object):
                         self.categories_add(get_categories(newpage))
 
     def build_outgraph(self):
-        outgraph = Graph()        
+        outgraph = graph_class(self.request)()
 
         if self.orderby and self.orderby != '_hier':
             outgraph.clusterrank = 'local'
@@ -873,9 +876,13 @@ class GraphShower(object):
         request = self.request
         urladd = self.urladd
 
+        # The whole level is read at once
+        batch = NodeBatch(request, nodes, urladd)
+
         # This traverses 1 to parents
         for node in nodes:
-            parents = load_parents(request, self.graphdata, node, urladd)
+            parents = load_parents(request, self.graphdata, node, urladd,
+                                   batch)
             nodeitem = self.graphdata.nodes.get(node)
             for parent in parents:
                 parentitem = self.graphdata.nodes.get(parent)
@@ -883,7 +890,8 @@ class GraphShower(object):
 
         # This traverses 1 to children
         for node in nodes:
-            children = load_children(request, self.graphdata, node, urladd)
+            children = load_children(request, self.graphdata, node, urladd,
+                                     batch)
             nodeitem = self.graphdata.nodes.get(node)
             for child in children:
                 childitem = self.graphdata.nodes.get(child)
@@ -1493,7 +1501,91 @@ class GraphShower(object):
 
         return gr
 
+    def cached_positions(self, entry):
+        if (not entry.exists() or
+            getattr(self.request.cfg, 'gwiki_cache_invalidate', False)):
+            return None
+
+        try:
+            return entry.content()
+        except Exception:
+            # Unreadable entries are laid out again
+            return None
+
+    def reuse_layout(self, graphviz):
+        # Layouts are cached by the parts of the graph that affect
+        # them, so that eg. colouring the graph differently does not
+        # lay it out again. New layouts are made by a bounded number
+        # of engine processes with a time budget, raising LayoutError
+        # if the budget runs out.
+        if not graphviz.changed or graphviz.engine == 'nop2':
+            return
+
+        request = self.request
+        key = cache_key(request, [graphviz.layout_signature()])
+        entry = caching.CacheEntry(request, 'gwikilayout', key,
+                                   scope='wiki', use_pickle=True)
+
+        positions = self.cached_positions(entry)
+        if positions is not None:
+            graphviz.set_positions(positions)
+            return
+
+        workers = getattr(request.cfg, 'gwiki_layout_workers', 4)
+        if workers <= 0:
+            entry.update(graphviz.positions())
+            return
+
+        timeout = getattr(request.cfg, 'gwiki_layout_timeout', 60)
+        memory = getattr(request.cfg, 'gwiki_layout_memory', 2048)
+        deadline = time.time() + timeout
+
+        # Requests for the same layout wait for the first one
+        lock = lock_file(os.path.join(entry.arena_dir,
+                                      'layout-%s.lock' % (key,)),
+                         deadline)
+        try:
+            positions = self.cached_positions(entry)
+            if positions is None:
+                positions = external_layout(graphviz, entry.arena_dir,
+                                            deadline, workers,
+                                            memory * 1024 * 1024)
+                entry.update(positions)
+        finally:
+            remove_lock(lock)
+
+        graphviz.set_positions(positions)
+
+    def bounded_layout(self, gr, outgraph, warnings):
+        # Lay out graphs to be drawn before sending anything, showing
+        # the overview instead of graphs that can not be laid out in
+        # time
+        if (self.help or self.format not in self.available_formats or
+            self.format in self.nonwrapped_formats):
+            return gr
+        if cache_exists(self.request,
+                        "%s-%s" % (self.cache_key, self.format)):
+            return gr
+
+        try:
+            self.reuse_layout(gr.graphviz)
+        except LayoutError:
+            _ = self.request.getText
+            warnings.append(_("The graph could not be laid out in time."))
+
+            if have_igraph():
+                self.format = 'igraph'
+                return IGraphRepr(outgraph, self.request)
+
+            # Just the graph info then
+            self.format = 'info'
+
+        return gr
+
     def get_layout(self, grapheng, format, addon=''):
+        if isinstance(grapheng, Graphviz):
+            self.reuse_layout(grapheng)
+
         tmp_fileno, tmp_name = mkstemp(addon)
         grapheng.layout(fname=tmp_name, format=format, 
                         height=self.height, width=self.width)
@@ -1607,6 +1699,12 @@ class GraphShower(object):
         if not legend:
             return
 
+        try:
+            self.reuse_layout(legend)
+        except LayoutError:
+            # Rather no legend than a long wait
+            return
+
         self.send_graph(legend, key=key, text='legend')
 
     def send_map(self, graphviz, key):
@@ -1697,7 +1795,11 @@ class GraphShower(object):
         key = self.cache_key + '-dot'
 
         if not cache_exists(self.request, key):
-            gvdata = self.get_layout(gr.graphviz, 'dot')
+            try:
+                gvdata = self.get_layout(gr.graphviz, 'dot')
+            except LayoutError, e:
+                self.request.write('/* %s */\n' % (e,))
+                return
 
             cache.put(self.request, key, gvdata, 
                       content_type="text/vnd.graphviz")
@@ -1837,13 +1939,14 @@ class GraphShower(object):
 
     def traverse(self, outgraph, nodes):
         newnodes = set()
+        batch = NodeBatch(self.request, nodes, self.urladd)
 
         # Add startpages, even if unconnected
         for node in nodes:
             newnodes.add(node)
 
             # Make sure that startnodes get loaded
-            load_node(self.request, self.graphdata, node, self.urladd)
+            load_node(self.request, self.graphdata, node, self.urladd, batch)
 
             oldnode = self.graphdata.nodes.get(node)
 
@@ -1959,7 +2062,7 @@ class GraphShower(object):
             if (self.format == 'igraph' or 
                 (have_igraph() and self.help == 'test')):
 
-                gr = IGraphRepr(outgraph)
+                gr = IGraphRepr(outgraph, self.request)
 
                 # Graph unique if the following are equal: edges
                 key_parts = [gr.edges]
@@ -1995,6 +2098,7 @@ class GraphShower(object):
             else:
                 # Do the layout
                 gr = self.generate_layout(outgraph)
+                gr = self.bounded_layout(gr, outgraph, warnings)
 
         if self.format not in self.nonwrapped_formats and not self.inline:
             for reason in warnings:
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-"
+"""
+    getChangesJSON action for graphingwiki
+     - streams the journal of meta changes after a sequence number
+
+    @license: MIT <http://www.opensource.org/licenses/mit-license.php>
+
+    Permission is hereby granted, free of charge, to any person
+    obtaining a copy of this software and associated documentation
+    files (the "Software"), to deal in the Software without
+    restriction, including without limitation the rights to use, copy,
+    modify, merge, publish, distribute, sublicense, and/or sell copies
+    of the Software, and to permit persons to whom the Software is
+    furnished to do so, subject to the following conditions:
+
+    The above copyright notice and this permission notice shall be
+    included in all copies or substantial portions of the Software.
+
+    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+    EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+    MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+    NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+    HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+    WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+    DEALINGS IN THE SOFTWARE.
+
+"""
+
+from graphingwiki import values_to_form
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# Entries returned when no limit is given
+DEFAULT_LIMIT = 1000
+
+def change_rows(request, changes, since):
+    # Entries of pages the user may not read are left out, but the
+    # next sequence number to ask for still skips them
+    next = since
+    for seq, page, key, added, removed in changes:
+        next = seq
+        if not request.user.may.read(page):
+            continue
+        yield {'seq': seq, 'page': page, 'key': key,
+               'added': added, 'removed': removed}
+
+    yield {'next': next}
+
+def execute(pagename, request):
+    form = values_to_form(request.values)
+
+    since = form.get('since', ['0'])[0]
+    limit = form.get('limit', [str(DEFAULT_LIMIT)])[0]
+
+    try:
+        since = int(since)
+        limit = int(limit)
+        if since < 0 or limit < 1:
+            raise ValueError(since, limit)
+    except ValueError:
+        request.status_code = 400
+        request.write(u"invalid since or limit")
+        return
+
+    graphdata = request.graphdata
+    changes = graphdata.get_changes(since, limit)
+    if changes is None:
+        # The consumer has to start over from the current data
+        request.status_code = 410
+        request.content_type = "application/json"
+        json.dump({'position': graphdata.journal_position()}, request)
+        return
+
+    request.content_type = "application/json;boundary=NL"
+    for row in change_rows(request, changes, since):
+        request.write(json.dumps(row) + "\n")
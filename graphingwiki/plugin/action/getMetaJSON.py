@@ -27,8 +27,12 @@
 
 """
 
+from itertools import islice
+
 from MoinMoin import wikiutil
 from MoinMoin.metadata.wikitextutil import format_wikitext
+from MoinMoin.metadata.edit import graphdata_close
+from MoinMoin.metadata.query import CursorError, PAGE_BATCH
 
 from graphingwiki import values_to_form
 
@@ -37,46 +41,140 @@ try:
 except ImportError:
     import json
 
-def execute(pagename, request):
-    request.content_type = "application/json"
+def format_values(request, metas):
+    formatted = {}
+    values = []
+    for page, vals in metas.items():
+        # Lists of values with getvalues
+        if not isinstance(vals, dict):
+            values.extend(vals)
+            continue
+
+        values.extend(vals.keys())
+        for val in vals.values():
+            values.extend(val)
+
+    for value in values:
+        f = format_wikitext(request, value)
+        if f != value and value not in formatted:
+            formatted[value] = f
+
+    return formatted
+
+class JSONLines(object):
+    """
+    Response body of one JSON document per line, written as the
+    results are read
+    """
+
+    def __init__(self, request, rows):
+        self.request = request
+        self.rows = rows
+
+    def read(self, *args):
+        if self.rows is None:
+            return ''
+
+        try:
+            return json.dumps(self.rows.next()) + "\n"
+        except StopIteration:
+            self.close()
+            return ''
+
+    def close(self):
+        # Not called by every server when the client goes away, so
+        # the rows do not keep the graph data open in between
+        self.rows = None
+        graphdata_close(self.request)
+
+def json_rows(request, results, next, key, formatted, limit):
+    while True:
+        # Read the results a batch at a time and close the graph data
+        # before the rows are written, so that it is not kept open
+        # (or locked) while waiting on the client
+        batch = list(islice(results, PAGE_BATCH))
+        rows = list()
+        for page, metas in batch:
+            if key:
+                metas = metas.get(key, [])
+                if not metas:
+                    continue
+
+            row = {'page': page, 'metas': metas}
+            if formatted:
+                row['formatted'] = format_values(request, {page: metas})
+            rows.append(row)
+        graphdata_close(request)
+
+        if not batch:
+            break
+        for row in rows:
+            yield row
+
+    if limit is not None:
+        yield {'next': next}
 
+def execute(pagename, request):
     form = values_to_form(request.values)
 
     args = form.get('args', [None])[0]
     key = form.get('getvalues', [None])[0]
     formatted = form.get('formatted', [None])[0]
-
-    do_action = wikiutil.importPlugin(request.cfg, "xmlrpc", "GetMetaStruct",
-                                      "do_action")
+    stream = form.get('stream', [None])[0]
+    after = form.get('after', [None])[0]
+    limit = form.get('limit', [None])[0]
+
+    if limit is not None:
+        try:
+            limit = int(limit)
+            if limit < 1:
+                raise ValueError(limit)
+        except ValueError:
+            request.status_code = 400
+            request.write(u"invalid limit '" + limit + u"'")
+            return
+
+    iter_action = wikiutil.importPlugin(request.cfg, "xmlrpc", "GetMetaStruct",
+                                        "iter_action")
 
     if not args:
         if key:
-            results = do_action(request, "%s=/.+/" % key)
-            metas = dict()
-            for page in results:
-                values = results[page].get(key, [])
-                if values:
-                    metas.setdefault(page, list())
-                    metas[page].extend(values)
+            args = "%s=/.+/" % key
         else:
-            metas = do_action(request, pagename)
-    else:
-        metas = do_action(request, args)
+            args = pagename
+
+    try:
+        results, next = iter_action(request, args, limit, after)
+    except CursorError:
+        # The client has to start over
+        request.status_code = 400
+        request.write(u"invalid cursor '" + after + u"'")
+        return
+
+    if stream:
+        # Pages are sent as they are read, one per line
+        request.content_type = "application/json;boundary=NL"
+        rows = json_rows(request, results, next, key, formatted, limit)
+        graphdata_close(request)
+        request.send_file(JSONLines(request, rows))
 
-    if formatted:
-        formatted = {}
-        values = []
-        for page, vals in metas.items():
-            values.extend(vals.keys())
-            for val in vals.values():
-                values.extend(val)
+    request.content_type = "application/json"
 
-        for value in values:
-            f = format_wikitext(request, value)
-            if f != value and value not in formatted:
-                formatted[value] = f
+    if key:
+        metas = dict()
+        for page, pagemetas in results:
+            values = pagemetas.get(key, [])
+            if values:
+                metas.setdefault(page, list())
+                metas[page].extend(values)
+    else:
+        metas = dict(results)
 
-        metas = {'metas' : metas, 'formatted': formatted}
+    if formatted or limit is not None or after is not None:
+        metas = {'metas' : metas}
+        if formatted:
+            metas['formatted'] = format_values(request, metas['metas'])
+        if limit is not None or after is not None:
+            metas['next'] = next
 
     json.dump(metas, request, indent=2)
-
@@ -89,25 +89,14 @@ def execute(pagename, request):
         dataset.update(data[key])
 
     graphdata = request.graphdata
-    vals_on_keys = graphdata.get_vals_on_keys()
 
     new_data = dict((key, list()) for (key, value) in data.iteritems())
 
-    for ip in ips:
-        if ip not in vals_on_keys.get('ip', list()):
-           new_data['ip'].append(ip)
-    for domain in domains:
-        if domain not in vals_on_keys.get('domain name', list()):
-           new_data['domain name'].append(domain)
-    for url in urls:
-        if url not in vals_on_keys.get('url', list()):
-           new_data['url'].append(url)
-    for email in emails:
-        if email not in vals_on_keys.get('email address', list()):
-           new_data['email address'].append(email)
-    for h in hashes:
-        if h not in vals_on_keys.get('artifact hash', list()):
-           new_data['artifact hash'].append(h)
+    for key, values in data.iteritems():
+        for value in values:
+            pages = graphdata.pages_with_value(key, value)
+            if not [x for x in pages if not x.endswith('Template')]:
+                new_data[key].append(value)
 
     newdataset = list()
     for key in new_data:
@@ -6,7 +6,7 @@
     @copyright: 2007 by Juhani Eronen <exec@iki.fi>
     @license: MIT <http://www.opensource.org/licenses/mit-license.php>
 """
-from MoinMoin.metadata.query import metatable_parseargs, get_metas
+from MoinMoin.metadata.query import metatable_parseargs, iter_metas_many
 
 #Used by action/metaCSV.py
 def do_action(request, args, keysonly=True):
@@ -22,11 +22,11 @@ def do_action(request, args, keysonly=True):
     out.append(metakeys)
 
     # Go through the pages, give list that has
-    # the name of the page followed by the values of the keys
-    for page in pagelist:
-        # We're pretty sure the user has the read access to the pages,
-        # so don't check again
-        metas = get_metas(request, page, metakeys, checkAccess=False)
+    # the name of the page followed by the values of the keys.
+    # We're pretty sure the user has the read access to the pages,
+    # so don't check again
+    for page, metas in iter_metas_many(request, pagelist, metakeys,
+                                       checkAccess=False):
         row = [page]
         for key in metakeys:
             row.append([value for value in metas[key]])
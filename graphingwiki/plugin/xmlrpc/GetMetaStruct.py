@@ -7,22 +7,45 @@
     @copyright: 2009 by Erno Kuusela <erno@iki.fi>
     @license: MIT <http://www.opensource.org/licenses/mit-license.php>
 """
-from MoinMoin.metadata.query import metatable_parseargs, get_metas
+import xmlrpclib
 
-#Used by action/getMetaJSON.py
-def do_action(request, args):
-    # Expects MetaTable arguments
-    pagelist, metakeys, _ = metatable_parseargs(request, args,
+from MoinMoin.metadata.query import (metatable_window, iter_metas_many,
+                                     CursorError)
+
+def iter_action(request, args, limit=None, after=None):
+    """
+    Return an iterator of (page, metas) of the pages matching the
+    MetaTable args and the cursor to continue from, see
+    metatable_window. Raises CursorError for an invalid cursor.
+    """
+    pagelist, metakeys, next = metatable_window(request, args, limit, after,
                                                 get_all_keys=True)
 
-    out = {}
     # We're pretty sure the user has the read access to the pages,
     # so don't check again
-    for page in pagelist:
-        metas = get_metas(request, page, metakeys, checkAccess=False)
-        out[page] = dict(metas)
-    return out
+    results = ((page, dict(metas)) for page, metas in
+               iter_metas_many(request, pagelist, metakeys,
+                               checkAccess=False))
+    return results, next
+
+#Used by action/getMetaJSON.py
+def do_action(request, args, limit=None, after=None):
+    # Expects MetaTable arguments
+    try:
+        results, next = iter_action(request, args, limit, after)
+    except CursorError:
+        # The client has to start over
+        return xmlrpclib.Fault(1, "Invalid cursor: %s" % (after,))
+    out = dict(results)
+
+    # Pages of a result are returned along with the cursor to the
+    # next ones
+    if limit is None and after is None:
+        return out
+    return {'metas': out, 'next': next}
 
-def execute(xmlrpcobj, args):
+def execute(xmlrpcobj, args, limit=None, after=None):
     args = xmlrpcobj._instr(args)
-    return do_action(xmlrpcobj.request, args)
+    if after is not None:
+        after = xmlrpcobj._instr(after)
+    return do_action(xmlrpcobj.request, args, limit, after)
@@ -1,19 +1,46 @@
 """
     Incremental GetMeta (prototype).
 
+    The result last returned for a handle is kept as a snapshot of
+    content hashes of the metas of each page, along with the journal
+    position of the graph data the metas were read at. The metas
+    themselves are stored once per hash and shared by all the handles.
+    Polls return straight away if the graph data has not changed,
+    otherwise only the pages with meta changes in the journal since
+    the snapshot are read and diffed. When the journal does not reach
+    back to the snapshot all the pages are read again.
+
+    The snapshots are plain cache files written with atomic renames,
+    so the pollers do not wait on each other. Handles not polled in
+    gwiki_incgetmeta_max_age seconds are removed along with the metas
+    no handle refers to any more.
+
     @copyright: 2008 by Joachim Viide
     @license: MIT <http://www.opensource.org/licenses/mit-license.php>
 """
 import os
-import struct
+import re
+import time
 import base64
-import shelve
 
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+from MoinMoin import caching
+from MoinMoin.metadata.constants import ANY_DEPENDENCY
 from MoinMoin.metadata.query import get_metas, metatable_parseargs
 
-from MoinMoin.util.lock import WriteLock
 from MoinMoin.Page import Page
 
+ARENA = "getmetas"
+
+handle_re = re.compile(r'^[A-Za-z0-9_-]+=*$')
+
+# Seconds a handle is kept after its last poll
+MAX_AGE = 7 * 24 * 60 * 60
+
 def diff(previous, current):
     removedPages = list()
     updates = dict()
@@ -44,47 +71,172 @@ def diff(previous, current):
             
     return removedPages, updates
 
-def create_new_handle(db):
-    number = db.get("", 0)
-    db[""] = number + 1
-    return base64.b64encode(struct.pack("!Q", number))
+def metas_digest(metas):
+    """
+    Return the content hash of the metas of a page.
+
+    >>> metas_digest({u'a': set([u'1', u'2'])}) == \\
+    ...     metas_digest({u'a': set([u'2', u'1']), u'b': set()})
+    True
+    """
+    items = sorted((key, sorted(values))
+                   for key, values in metas.iteritems() if values)
+    return sha1(repr(items)).hexdigest()
+
+def _entry(request, name):
+    return caching.CacheEntry(request, ARENA, name, scope='wiki',
+                              do_locking=False, use_pickle=True)
+
+def _load(request, name):
+    cache = _entry(request, name)
+    if not cache.exists():
+        return None
+    try:
+        return cache.content()
+    except caching.CacheError:
+        return None
+
+def load_snapshot(request, handle):
+    if not handle or not handle_re.match(handle):
+        return None
+    return _load(request, "handle-" + handle)
+
+def _touch(request, name):
+    try:
+        os.utime(_entry(request, name)._filename(), None)
+    except OSError:
+        pass
+
+def save_snapshot(request, handle, snapshot):
+    _entry(request, "handle-" + handle).update(snapshot)
+
+def load_metas(request, digest):
+    metas = _load(request, "metas-" + digest)
+    if metas is None:
+        return dict()
+    return dict((key, set(values)) for key, values in metas.iteritems())
+
+def save_metas(request, digest, metas):
+    cache = _entry(request, "metas-" + digest)
+    if cache.exists():
+        # Keep the metas from expiring while they are in use
+        _touch(request, "metas-" + digest)
+    else:
+        cache.update(dict((key, sorted(values))
+                          for key, values in metas.iteritems() if values))
+
+def expire(request, max_age):
+    """
+    Remove the handles not polled in max_age seconds, and the metas
+    of at least the same age no remaining handle refers to.
+    """
+    expired = time.time() - max_age
+    names = caching.get_cache_list(request, ARENA, 'wiki')
+
+    digests = set()
+    for name in names:
+        if not name.startswith("handle-"):
+            continue
+        cache = _entry(request, name)
+        if cache.mtime() < expired:
+            cache.remove()
+            continue
+        snapshot = _load(request, name)
+        if snapshot is not None:
+            digests.update(snapshot['pages'].itervalues())
+
+    for name in names:
+        if not name.startswith("metas-"):
+            continue
+        if name[len("metas-"):] in digests:
+            continue
+        cache = _entry(request, name)
+        if cache.mtime() < expired:
+            cache.remove()
+
+def create_new_handle():
+    return base64.urlsafe_b64encode(os.urandom(9))
+
+def _changed_pages(request, since):
+    if since is None:
+        return None
+    changes = request.graphdata.get_changes(since)
+    if changes is None:
+        return None
+    return set(page for _, page, _, _, _ in changes)
 
 def inc_get_metas(request, args, handle=None):
+    user = request.user.valid and request.user.name or u''
+
+    snapshot = load_snapshot(request, handle)
+    if snapshot is not None and (snapshot['args'] != args or
+                                 snapshot['user'] != user or
+                                 'position' not in snapshot):
+        snapshot = None
+
+    # Read before the metas, so that the changes made meanwhile are
+    # seen again on the next poll
+    position = request.graphdata.journal_position()
+    generation = request.graphdata.get_generations([ANY_DEPENDENCY])
+    if generation is not None:
+        generation = generation[ANY_DEPENDENCY]
+
+    if snapshot is not None and generation is not None and \
+            generation == snapshot['generation'] and \
+            position == snapshot['position']:
+        _touch(request, "handle-" + handle)
+        return [True, handle, ([], dict())]
+
     pages, keys, _ = metatable_parseargs(request, args, get_all_keys=True)
 
+    oldpages = dict()
+    changed = None
+    if snapshot is not None:
+        oldpages = snapshot['pages']
+        # Indirected keys depend on other pages as well
+        if snapshot['keys'] == keys and \
+                not [key for key in keys if '->' in key]:
+            changed = _changed_pages(request, snapshot['position'])
+
+    previous = dict()
     current = dict()
+    newpages = dict()
     for page in pages:
+        old = oldpages.get(page, None)
+        if changed is not None and old is not None and page not in changed:
+            newpages[page] = old
+            continue
+
         request.page = Page(request, page)
         # metatable_parseargs checks read permissions, no need to do it again
         metas = get_metas(request, page, keys, checkAccess=False)
+        metas = dict((key, set(metas[key])) for key in keys)
+        digest = metas_digest(metas)
+        newpages[page] = digest
 
-        current[page] = dict()
-        for key in keys:
-            values = set(metas[key])
-            current[page][key] = values
-
-    cachedir = os.path.join(request.cfg.cache_dir, "getmetas")
-    if not os.path.exists(cachedir):
-        os.makedirs(cachedir)
-
-    lock = WriteLock(cachedir, timeout=60.0)
-    success = lock.acquire()
-
-    path = os.path.join(cachedir, request.cfg.siteid + ".shelve")
-    db = shelve.open(path)
+        if old == digest:
+            continue
 
-    incremental = True
-    try:
-        if not handle or handle not in db:
-            incremental = False
-            handle = create_new_handle(db)
-        previous = db.get(handle, dict())
-        db[handle] = current
-    finally:
-        db.close()
-
-    if lock.isLocked():
-        lock.release()
+        save_metas(request, digest, metas)
+        current[page] = metas
+        if old is not None:
+            previous[page] = load_metas(request, old)
+
+    for page in set(oldpages) - set(newpages):
+        previous[page] = dict()
+
+    incremental = snapshot is not None
+    if not incremental:
+        handle = create_new_handle()
+        expire(request, getattr(request.cfg, 'gwiki_incgetmeta_max_age',
+                                MAX_AGE))
+
+    save_snapshot(request, handle, {'args': args,
+                                    'user': user,
+                                    'keys': keys,
+                                    'position': position,
+                                    'generation': generation,
+                                    'pages': newpages})
 
     return [incremental, handle, diff(previous, current)]
 
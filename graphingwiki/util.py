@@ -53,7 +53,7 @@ from MoinMoin.logfile import editlog
 from MoinMoin.metadata.constants import SEPARATOR, SPECIAL_ATTRS, \
     NO_TYPE, ATTACHMENT_SCHEMAS
 from MoinMoin.metadata.util import node_type, category_regex, template_regex, \
-    nonguaranteeds_p
+    nonguaranteeds_p, may_read_many
 from MoinMoin.metadata.wikitextutil import format_wikitext, filter_categories
 
 from graphingwiki import id_escape, actionname
@@ -322,7 +322,52 @@ def attachment_url(request, page, file):
 
 # The load_ -functions try to minimise unnecessary reloading and overloading
 
-def load_node(request, graph, node, urladd):
+class NodeBatch(object):
+    """
+    The neighbourhoods of a set of nodes, eg. the frontier of a graph
+    traversal, read in one go. The pages of the nodes and of their
+    neighbours are read with one getpages call each, and the read
+    rights checked once. Given to load_node, load_parents and
+    load_children, the batch is used for the nodes in it, and each
+    neighbourhood graph is built once.
+    """
+
+    def __init__(self, request, nodes, urladd):
+        graphdata = request.graphdata
+
+        self.request = request
+        self.urladd = urladd
+        self.nodes = set(nodes)
+
+        self.readable = may_read_many(request, self.nodes)
+        self.pages = graphdata.getpages(self.readable)
+
+        linked = set()
+        for pagename, page in self.pages.iteritems():
+            linked.update(_linked_pages(pagename, page))
+        self.pages.update(graphdata.getpages(linked.difference(self.pages)))
+        self.readable.update(may_read_many(request,
+                                           linked.difference(self.nodes)))
+
+        self._graphs = dict()
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def load_graph(self, node):
+        """
+        Return the neighbourhood graph of the node, as load_graph.
+        """
+        if node not in self._graphs:
+            adata = None
+            page = self.pages.get(node, None)
+            if node in self.readable and page:
+                adata = _page_graph(self.request, node, self.urladd,
+                                    page, self.pages)
+            self._graphs[node] = adata
+        return self._graphs[node]
+
+def load_node(request, graph, node, urladd, batch=None):
     load_origin = False
 
     nodeitem = graph.nodes.get(node)
@@ -331,15 +376,18 @@ def load_node(request, graph, node, urladd):
         load_origin = True
 
     # Get new data for current node
-    adata = load_graph(request, node, urladd, load_origin)
+    if batch is not None and node in batch:
+        adata = batch.load_graph(node)
+    else:
+        adata = load_graph(request, node, urladd, load_origin)
 
-    if adata:
+    if adata and load_origin:
         nodeitem.update(adata.nodes.get(node))
 
     return adata
 
-def load_children(request, graph, parent, urladd):
-    adata = load_node(request, graph, parent, urladd)
+def load_children(request, graph, parent, urladd, batch=None):
+    adata = load_node(request, graph, parent, urladd, batch)
 
     # If no data
     if not adata:
@@ -348,6 +396,10 @@ def load_children(request, graph, parent, urladd):
         return list()
 
     children = set()
+    if batch is not None and parent in batch:
+        readable = batch.readable
+    else:
+        readable = may_read_many(request, adata.edges.children(parent))
 
     # Add new nodes, edges that link to/from the current node
     for child in adata.edges.children(parent):
@@ -355,7 +407,7 @@ def load_children(request, graph, parent, urladd):
             newnode = graph.nodes.add(child)
             # Parent knows about links to pages even though they might
             # not see anything about the page being linked to
-            if request.user.may.read(child):
+            if child in readable:
                 newnode.update(adata.nodes.get(child))
             else:
                 newnode.gwikiURL = './\N'
@@ -368,8 +420,8 @@ def load_children(request, graph, parent, urladd):
 
     return children
 
-def load_parents(request, graph, child, urladd):
-    adata = load_node(request, graph, child, urladd)
+def load_parents(request, graph, child, urladd, batch=None):
+    adata = load_node(request, graph, child, urladd, batch)
 
     # If no data
     if not adata:
@@ -378,12 +430,16 @@ def load_parents(request, graph, child, urladd):
         return list()
 
     parents = set()
+    if batch is not None and child in batch:
+        readable = batch.readable
+    else:
+        readable = may_read_many(request, adata.edges.parents(child))
 
     # Add new nodes, edges that are the parents of the current node
     for parent in adata.edges.parents(child):
         if not graph.nodes.get(parent):
             # Do not add link parents if they are not known
-            if not request.user.may.read(parent):
+            if parent not in readable:
                 continue
             newnode = graph.nodes.add(parent)
             newnode.update(adata.nodes.get(parent))
@@ -399,34 +455,39 @@ def load_parents(request, graph, child, urladd):
 
 
 
-def _add_node(request, pagename, graph, urladd="", nodetype=""):
+def _add_node(request, pagename, graph, urladd="", nodetype="",
+              pagedata=None):
     # Don't bother if the node has already been added
     if graph.nodes.get(pagename):
         return graph
 
+    if pagedata is None:
+        pagedata = request.graphdata.getpage(pagename)
+    metas = pagedata.get(u'meta', dict())
+    outs = pagedata.get(u'out', dict())
+
     node = graph.nodes.add(pagename)
-    # Add metadata
-    for key, val in request.graphdata.get_meta(pagename).iteritems():
+    # Add metadata, copying the values as the page data may be cached
+    for key, val in metas.iteritems():
         if key in SPECIAL_ATTRS:
             node.__setattr__(key, ''.join(val))
         else:
-            node.__setattr__(key, val)
+            node.__setattr__(key, list(val))
 
     # Add links as metadata
-    for key, val in request.graphdata.get_out(pagename).iteritems():
+    for key, val in outs.iteritems():
         if key == NO_TYPE:
             continue
         if key in SPECIAL_ATTRS:
             node.__setattr__(key, ''.join(val))
         else:
-            node.__setattr__(key, val)
+            node.__setattr__(key, list(val))
 
     # Shapefile is an extra special case
-    for shape in request.graphdata.get_meta(pagename).get('gwikishapefile', list()):
+    for shape in metas.get('gwikishapefile', list()):
         node.gwikishapefile = shape
     # so is category
-    node.gwikicategory = \
-         request.graphdata.get_out(pagename).get('gwikicategory', list())
+    node.gwikicategory = list(outs.get('gwikicategory', list()))
 
     # Configuration for local pages next, 
     # return known to be something else
@@ -437,7 +498,7 @@ def _add_node(request, pagename, graph, urladd="", nodetype=""):
     if not hasattr(node, 'gwikiURL'):
         node.gwikiURL = './' + pagename
 
-    if request.graphdata.is_saved(pagename):
+    if pagedata.get(u'saved', False):
         node.gwikiURL += urladd
     else:
         # try to be helpful and add editlinks to non-underlay pages
@@ -446,10 +507,32 @@ def _add_node(request, pagename, graph, urladd="", nodetype=""):
 
     return graph
 
+def _linked_pages(pagename, page):
+    linked = set()
+    for links in page.get(u'in', dict()).itervalues():
+        linked.update(links)
+    for links in page.get(u'out', dict()).itervalues():
+        linked.update(links)
+    linked.discard(pagename)
+    return linked
+
 def load_graph(request, pagename, urladd, load_origin=True):
     if not request.user.may.read(pagename):
         return None
 
+    page = request.graphdata.getpage(pagename)
+    if not page:
+        return None
+
+    # Fetch the linked pages in one go
+    pages = request.graphdata.getpages(_linked_pages(pagename, page))
+    pages[pagename] = page
+
+    return _page_graph(request, pagename, urladd, page, pages, load_origin)
+
+def _page_graph(request, pagename, urladd, page, pages, load_origin=True):
+    # The graph of the page and its links, from the page data of the
+    # page and the linked pages
     def add_adata_link(adata, edge, type):
         # Add edge if it does not already exist
         e = adata.edges.get(*edge)
@@ -463,19 +546,15 @@ def load_graph(request, pagename, urladd, load_origin=True):
     cat_re = category_regex(request)
     temp_re = template_regex(request)
 
-    page = request.graphdata.getpage(pagename)
-    if not page:
-        return None
-
     # Make graph, initialise head node
     adata = Graph()
     if load_origin:
-        adata = _add_node(request, pagename, adata, urladd, 'page')
+        adata = _add_node(request, pagename, adata, urladd, 'page', page)
     else:
         adata.nodes.add(pagename)
 
     # Add links to page
-    links = request.graphdata.get_in(pagename)
+    links = page.get(u'in', dict())
     for linktype in links:
         for src in links[linktype]:
             # Filter Category, Template pages
@@ -484,10 +563,11 @@ def load_graph(request, pagename, urladd, load_origin=True):
             # Add page and its metadata
             # Currently pages can have links in them only
             # from local pages, thus nodetype == page
-            adata = _add_node(request, src, adata, urladd, 'page')
+            adata = _add_node(request, src, adata, urladd, 'page',
+                              pages[src])
             adata = add_adata_link(adata, (src, pagename), linktype)
     # Add links from page
-    links = request.graphdata.get_out(pagename)
+    links = page.get(u'out', dict())
     for linktype in links:
         #print "add_node", pagename, dst
         for i, dst in enumerate(links[linktype]):
@@ -550,7 +630,8 @@ def load_graph(request, pagename, urladd, load_origin=True):
                 continue
 
             # Add page and its metadata
-            adata = _add_node(request, dst, adata, urladd, nodetype)
+            adata = _add_node(request, dst, adata, urladd, nodetype,
+                              pages[dst])
             adata = add_adata_link(adata, (pagename, dst), linktype)
             if label or gwikiurl or tooltip:
                 node = adata.nodes.get(dst)